@@ -51,6 +51,259 @@ ADD COLUMN IF NOT EXISTS post_script TEXT; -- Human-readable script explaining h
 -- Create index for post_script (optional, for full-text search if needed)
 -- CREATE INDEX IF NOT EXISTS idx_post_contents_post_script ON post_contents USING gin(to_tsvector('english', post_script));
 
+-- ============================================================
+-- 5. Store the selection-time context vector with each action
+-- ============================================================
+-- context_vector: base64 float16 policy vector (see db.encode_context_vector)
+-- context_projection: projection id it was computed under (NULL = none)
+ALTER TABLE rl_actions
+ADD COLUMN IF NOT EXISTS context_vector TEXT;
+
+ALTER TABLE rl_actions
+ADD COLUMN IF NOT EXISTS context_projection TEXT;
+
+-- ============================================================
+-- 6. Log the sampling probability of each chosen action value
+-- ============================================================
+-- propensity: {"<DIMENSION>": probability of the chosen value, ...}
+-- (the joint propensity of the action is the product)
+ALTER TABLE rl_actions
+ADD COLUMN IF NOT EXISTS propensity JSONB;
+
+-- ============================================================
+-- 7. Business segments for hierarchical preferences
+-- ============================================================
+-- rl_segment: k-means cluster of the profile embedding (segments.py)
+-- rl_preferences.segment: -1 for the global rows, else a segment id
+ALTER TABLE profiles
+ADD COLUMN IF NOT EXISTS rl_segment INT;
+
+ALTER TABLE rl_preferences
+ADD COLUMN IF NOT EXISTS segment INT NOT NULL DEFAULT -1;
+
+ALTER TABLE rl_preferences
+DROP CONSTRAINT IF EXISTS rl_preferences_platform_time_bucket_dimension_action_value_key;
+
+ALTER TABLE rl_preferences
+ADD CONSTRAINT rl_preferences_segment_key
+UNIQUE (segment, platform, time_bucket, dimension, action_value);
+
+-- ============================================================
+-- 8. Provisional rewards predicted from the first 24h of snapshots
+-- ============================================================
+-- provisional_reward: reward_predictor.py estimate of reward_value,
+-- set once the provisional RL update has been applied
+-- provisional_at: when the post was attempted; set without a
+-- provisional_reward for posts that never got a 24h snapshot, so they
+-- drop out of the candidate query
+ALTER TABLE post_rewards
+ADD COLUMN IF NOT EXISTS provisional_reward FLOAT;
+
+ALTER TABLE post_rewards
+ADD COLUMN IF NOT EXISTS provisional_at TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS idx_post_rewards_provisional_candidates
+ON post_rewards(post_created_at)
+WHERE reward_status = 'pending' AND provisional_at IS NULL;
+
+-- ============================================================
+-- 9. Per-(platform, time_bucket, content_type) EMA baselines
+-- ============================================================
+-- One row per key; rl_update_baselines folds rewards in atomically
+-- (b = (1 - beta) * b + beta * reward, a new key starts at its first
+-- reward) and returns the baseline after each reward, in input order.
+ALTER TABLE rl_baselines
+ADD COLUMN IF NOT EXISTS time_bucket TEXT NOT NULL DEFAULT '';
+
+ALTER TABLE rl_baselines
+ADD COLUMN IF NOT EXISTS content_type TEXT NOT NULL DEFAULT 'post';
+
+ALTER TABLE rl_baselines
+ADD COLUMN IF NOT EXISTS num_samples INT NOT NULL DEFAULT 0;
+
+ALTER TABLE rl_baselines
+DROP CONSTRAINT IF EXISTS rl_baselines_platform_key;
+
+ALTER TABLE rl_baselines
+ADD CONSTRAINT rl_baselines_key
+UNIQUE (platform, time_bucket, content_type);
+
+CREATE OR REPLACE FUNCTION rl_update_baselines(updates JSONB, beta FLOAT DEFAULT 0.1)
+RETURNS TABLE (idx INT, baseline FLOAT)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    rec RECORD;
+BEGIN
+    -- keys are locked in a fixed order so concurrent batches cannot deadlock
+    FOR rec IN
+        SELECT e.value AS u, (e.ordinality - 1)::INT AS i
+        FROM jsonb_array_elements(updates) WITH ORDINALITY AS e(value, ordinality)
+        ORDER BY e.value->>'platform', e.value->>'time_bucket', e.value->>'content_type', e.ordinality
+    LOOP
+        INSERT INTO rl_baselines AS b (platform, time_bucket, content_type, value, num_samples, updated_at)
+        VALUES (
+            rec.u->>'platform',
+            COALESCE(rec.u->>'time_bucket', ''),
+            COALESCE(rec.u->>'content_type', 'post'),
+            (rec.u->>'reward')::FLOAT,
+            1,
+            NOW()
+        )
+        ON CONFLICT (platform, time_bucket, content_type) DO UPDATE
+        SET value = (1 - beta) * b.value + beta * EXCLUDED.value,
+            num_samples = b.num_samples + 1,
+            updated_at = NOW()
+        RETURNING b.value INTO baseline;
+
+        idx := rec.i;
+        RETURN NEXT;
+    END LOOP;
+END;
+$$;
+
+-- ============================================================
+-- 10. Atomic server-side preference increments
+-- ============================================================
+-- updates: [{"segment", "platform", "time_bucket", "dimension",
+--            "action_value", "delta", "samples"}, ...]
+-- segment defaults to -1 (global) and samples to 1. Duplicate keys in
+-- one call are summed first (ON CONFLICT can touch a row only once per
+-- statement), then every row is inserted or incremented in a single
+-- statement. Returns the number of rows written.
+CREATE OR REPLACE FUNCTION rl_increment_preferences(updates JSONB)
+RETURNS INT
+LANGUAGE sql
+AS $$
+    WITH deltas AS (
+        SELECT
+            COALESCE((u->>'segment')::INT, -1) AS segment,
+            u->>'platform' AS platform,
+            u->>'time_bucket' AS time_bucket,
+            u->>'dimension' AS dimension,
+            u->>'action_value' AS action_value,
+            SUM((u->>'delta')::FLOAT) AS delta,
+            SUM(COALESCE((u->>'samples')::INT, 1)) AS samples
+        FROM jsonb_array_elements(updates) AS u
+        GROUP BY 1, 2, 3, 4, 5
+    ),
+    written AS (
+        INSERT INTO rl_preferences AS p
+            (segment, platform, time_bucket, dimension, action_value, preference_score, num_samples, updated_at)
+        SELECT segment, platform, time_bucket, dimension, action_value, delta, samples, NOW()
+        FROM deltas
+        ORDER BY segment, platform, time_bucket, dimension, action_value
+        ON CONFLICT (segment, platform, time_bucket, dimension, action_value) DO UPDATE
+        SET preference_score = p.preference_score + EXCLUDED.preference_score,
+            num_samples = p.num_samples + EXCLUDED.num_samples,
+            updated_at = NOW()
+        RETURNING 1
+    )
+    SELECT COUNT(*)::INT FROM written;
+$$;
+
+-- ============================================================
+-- 11. Lease-based job claiming for concurrent job_queue workers
+-- ============================================================
+-- rl_claim_jobs marks up to batch_size due jobs running for one worker
+-- in a single statement; rows locked by a concurrent claim are skipped
+-- (SKIP LOCKED), so two workers never get the same job. A claimed job
+-- belongs to lease_owner until lease_expires_at; rl_reap_jobs requeues
+-- jobs whose worker died, counting it as a failed attempt.
+ALTER TABLE jobs
+ADD COLUMN IF NOT EXISTS lease_owner TEXT;
+
+ALTER TABLE jobs
+ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS idx_jobs_status_run_at ON jobs(status, run_at);
+
+CREATE OR REPLACE FUNCTION rl_claim_jobs(worker TEXT, batch_size INT DEFAULT 20, lease_seconds INT DEFAULT 600)
+RETURNS SETOF jobs
+LANGUAGE sql
+AS $$
+    UPDATE jobs
+    SET status = 'running',
+        started_at = NOW(),
+        lease_owner = worker,
+        lease_expires_at = NOW() + make_interval(secs => lease_seconds)
+    WHERE job_id IN (
+        SELECT job_id
+        FROM jobs
+        WHERE status = 'queued'
+          AND run_at <= NOW()
+        ORDER BY run_at
+        LIMIT batch_size
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING *;
+$$;
+
+CREATE OR REPLACE FUNCTION rl_renew_job_leases(worker TEXT, job_ids TEXT[], lease_seconds INT DEFAULT 600)
+RETURNS TABLE (job_id TEXT)
+LANGUAGE sql
+AS $$
+    UPDATE jobs AS j
+    SET lease_expires_at = NOW() + make_interval(secs => lease_seconds)
+    WHERE j.job_id = ANY(job_ids)
+      AND j.lease_owner = worker
+      AND j.status = 'running'
+    RETURNING j.job_id;
+$$;
+
+CREATE OR REPLACE FUNCTION rl_reap_jobs(max_retries INT DEFAULT 3)
+RETURNS INT
+LANGUAGE sql
+AS $$
+    WITH reaped AS (
+        UPDATE jobs
+        SET status = CASE WHEN retry_count + 1 >= max_retries THEN 'failed' ELSE 'queued' END,
+            retry_count = retry_count + 1,
+            last_error = 'lease of ' || COALESCE(lease_owner, '?') || ' expired',
+            lease_owner = NULL,
+            lease_expires_at = NULL
+        WHERE status = 'running'
+          AND lease_expires_at < NOW()
+        RETURNING 1
+    )
+    SELECT COUNT(*)::INT FROM reaped;
+$$;
+
+-- ============================================================
+-- 12. Batched job state transitions
+-- ============================================================
+-- rl_finish_jobs applies the completed/failed transitions a worker has
+-- buffered (db.job_store) in one statement, releasing each lease. Only
+-- running jobs the worker still holds are touched, so re-sending a batch
+-- after a failed flush is a no-op for rows already applied.
+-- New jobs are batch-inserted with ON CONFLICT (job_id) DO NOTHING
+-- (PostgREST upsert with ignore_duplicates) and need no function.
+CREATE OR REPLACE FUNCTION rl_finish_jobs(worker TEXT, transitions JSONB)
+RETURNS TABLE (job_id TEXT)
+LANGUAGE sql
+AS $$
+    UPDATE jobs AS j
+    SET status = t.status,
+        result = COALESCE(t.result, j.result),
+        last_error = COALESCE(t.last_error, j.last_error),
+        retry_count = COALESCE(t.retry_count, j.retry_count),
+        completed_at = COALESCE(t.completed_at, j.completed_at),
+        lease_owner = NULL,
+        lease_expires_at = NULL
+    FROM jsonb_to_recordset(transitions) AS t(
+        job_id TEXT,
+        status TEXT,
+        result JSONB,
+        last_error TEXT,
+        retry_count INT,
+        completed_at TIMESTAMPTZ
+    )
+    WHERE j.job_id = t.job_id
+      AND j.lease_owner = worker
+      AND j.status = 'running'
+    RETURNING j.job_id;
+$$;
+
 -- ============================================================
 -- NOTES:
 -- ============================================================
@@ -64,5 +317,30 @@ ADD COLUMN IF NOT EXISTS post_script TEXT; -- Human-readable script explaining h
 --    explaining how to use the generated post content (caption + image)
 -- 5. All changes are backward compatible - existing records will
 --    have NULL content_type which defaults to 'post' behavior
+-- 6. Actions without a context_vector (older rows) are still updated:
+--    the RL job rebuilds their context from the stored topic
+-- 7. Actions logged before section 6 have NULL propensity and
+--    cannot be used for off-policy estimates
+-- 8. Existing rl_preferences rows become the global (segment -1)
+--    rows; segment rows only override them once they have
+--    RL_SEGMENT_MIN_SAMPLES samples. Segment ids are
+--    generation * 10000 + cluster; segments.py --fit deletes the
+--    rows of older generations
+-- 9. When the final reward of a post with a provisional_reward is
+--    applied, only the residual (reward_value - provisional_reward)
+--    is applied as an RL update. Without one it is applied in full
+--    and a provisional job still queued is skipped
+-- 10. A reward is folded into its baseline exactly once, when
+--    fetch_or_calculate_reward calculates it; provisional updates
+--    only read the baseline. Existing per-platform rl_baselines rows
+--    become the ('', 'post') key of their platform
+-- 11. db.update_preference / update_preferences_batch only call
+--    rl_increment_preferences; run section 10 before deploying them
+-- 12. Jobs marked running before section 11 have no lease and are
+--    never reaped; requeue them by hand once after migrating
+-- 13. Job ids are now deterministic (reward_<post_id>, rl_<post_id>,
+--    rl_provisional_<post_id>, ...) so duplicate inserts are dropped;
+--    jobs queued earlier keep their timestamped ids. Run section 12
+--    before deploying the job_store-based job_queue
 -- ============================================================
 
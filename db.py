@@ -2,13 +2,18 @@
 import os
 import math
 import uuid
+import base64
 import numpy as np
 from dotenv import load_dotenv
 from supabase import create_client
 from datetime import datetime, timedelta, timezone
+import atexit
 import pytz
 from typing import List
 
+from preference_cache import PreferenceCache
+from job_store import JobStore
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -24,6 +29,20 @@ REWARD_WEIGHTS = {     # at alpha = 0.35
 # Indian Standard Time (IST) - Asia/Kolkata
 IST = pytz.timezone("Asia/Kolkata")
 
+# rl_preferences.segment of the rows shared by all businesses (see segments.py)
+GLOBAL_SEGMENT = -1
+# A segment's own preference is used once it has this many samples
+SEGMENT_MIN_SAMPLES = int(os.getenv("RL_SEGMENT_MIN_SAMPLES", "20"))
+
+# Preference cache (see preference_cache.py): read TTL and write-behind flush cadence
+PREFS_TTL = float(os.getenv("RL_PREFS_TTL", "300"))
+PREFS_FLUSH_SECONDS = float(os.getenv("RL_PREFS_FLUSH_SECONDS", "30"))
+PREFS_MAX_PENDING = int(os.getenv("RL_PREFS_MAX_PENDING", "1000"))
+
+# Job store (see job_store.py): write-behind cadence of new jobs and job transitions
+JOBS_FLUSH_SECONDS = float(os.getenv("JOBS_FLUSH_SECONDS", "5"))
+JOBS_MAX_PENDING = int(os.getenv("JOBS_MAX_PENDING", "100"))
+
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 
@@ -93,101 +112,171 @@ def get_preference(platform, time_bucket, dimension, value):
         return 0.0
 
 
-def get_preferences_batch(platform, time_bucket) -> dict:
+def fetch_preference_rows(platform, time_bucket):
+    """
+    Every rl_preferences row (all segments) of a context. Raises on failure;
+    reads normally go through preference_cache.
     """
-    Fetch ALL preferences for a context in one go.
+    res = supabase.table("rl_preferences") \
+        .select("segment, dimension, action_value, preference_score, num_samples, updated_at") \
+        .eq("platform", platform) \
+        .eq("time_bucket", time_bucket) \
+        .execute()
+    return res.data or []
+
+
+def get_preferences_batch(platform, time_bucket, segment=None) -> dict:
+    """
+    Fetch ALL preferences for a context in one go (served from preference_cache).
     Returns: dict { (dimension, value): score }
+
+    With a segment, its own score is used for every value it has at least
+    SEGMENT_MIN_SAMPLES samples for; everything else falls back to the
+    global (segment -1) score.
     """
-    try:
-        res = supabase.table("rl_preferences") \
-            .select("dimension, action_value, preference_score") \
-            .eq("platform", platform) \
-            .eq("time_bucket", time_bucket) \
-            .execute()
+    return preference_cache.get(platform, time_bucket, segment)
 
-        prefs = {}
-        if res.data:
-            for row in res.data:
-                key = (row["dimension"], row["action_value"])
-                prefs[key] = float(row["preference_score"])
-        return prefs
 
-    except Exception as e:
-        print(f"Error batch fetching preferences for {platform}: {e}")
-        return {}
+def get_preferences_version(platform, time_bucket):
+    """
+    Latest rl_preferences.updated_at for a context (None if it has no rows),
+    "pending" while buffered deltas for it are unwritten. Every preference
+    write bumps updated_at, so this changes whenever the scores returned by
+    get_preferences_batch do.
+    """
+    return preference_cache.version(platform, time_bucket)
 
 
-def update_preference(platform, time_bucket, dimension, value, delta):
+def queue_preference_updates(updates):
+    """
+    Write-behind form of update_preferences_batch: deltas are buffered in
+    preference_cache and written in one batch when due (or on flush_preferences).
     """
-    Update preference scores with increment operations.
+    preference_cache.add(updates)
 
-    NOTE: This implementation still has a potential race condition between
-    SELECT and UPDATE operations. For production systems, consider:
 
-    1. Using database triggers for atomic increments
-    2. Creating a stored procedure for this operation
-    3. Using PostgreSQL's ON CONFLICT DO UPDATE with increment logic
-    4. Implementing optimistic locking with version columns
+def flush_preferences():
+    return preference_cache.flush()
 
-    Current implementation includes error handling and retry logic as mitigation.
+
+def update_preference(platform, time_bucket, dimension, value, delta, segment=GLOBAL_SEGMENT):
+    """
+    Atomically add delta to one preference (one sample), creating the row if needed.
     """
     print(f"Updating preference: {platform} | {time_bucket} | {dimension}={value} | delta={delta:.6f}")
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            res = supabase.table("rl_preferences") \
-                .select("id, preference_score, num_samples") \
-                .eq("platform", platform) \
-                .eq("time_bucket", time_bucket) \
-                .eq("dimension", dimension) \
-                .eq("action_value", value) \
-                .execute()
+    update_preferences_batch([{
+        "segment": segment,
+        "platform": platform,
+        "time_bucket": time_bucket,
+        "dimension": dimension,
+        "action_value": value,
+        "delta": delta,
+        "samples": 1
+    }])
+
+
+def update_preferences_batch(updates):
+    """
+    Apply many preference increments in one request.
+
+    updates: [{platform, time_bucket, dimension, action_value, delta, samples[, segment]}]
+    segment defaults to the global rows.
+
+    rl_increment_preferences (see database_changes.sql) adds every delta
+    server-side with INSERT ... ON CONFLICT DO UPDATE in one statement, so
+    concurrent writers never lose an increment.
+    """
+    if not updates:
+        return
+
+    platforms = sorted({u["platform"] for u in updates})
+    time_buckets = sorted({u["time_bucket"] for u in updates})
+    segments = sorted({u.get("segment", GLOBAL_SEGMENT) for u in updates})
+    print(f"Updating {len(updates)} preferences in bulk ({platforms} x {time_buckets}, segments {segments})")
+
+    payload = [
+        {
+            "segment": u.get("segment", GLOBAL_SEGMENT),
+            "platform": u["platform"],
+            "time_bucket": u["time_bucket"],
+            "dimension": u["dimension"],
+            "action_value": u["action_value"],
+            "delta": float(u["delta"]),
+            "samples": int(u.get("samples", 1))
+        }
+        for u in updates
+    ]
+    try:
+        supabase.rpc("rl_increment_preferences", {"updates": payload}).execute()
+    except Exception as e:
+        print(f"Error bulk updating {len(updates)} preferences: {e}")
+        raise
+
+
+preference_cache = PreferenceCache(
+    fetch_preference_rows,
+    update_preferences_batch,
+    ttl=PREFS_TTL,
+    flush_interval=PREFS_FLUSH_SECONDS,
+    max_pending=PREFS_MAX_PENDING,
+    min_segment_samples=SEGMENT_MIN_SAMPLES
+)
+atexit.register(preference_cache.flush)
+
+
+# ---------------- JOBS ----------------
+
+def insert_jobs_batch(rows):
+    """
+    Insert many jobs in one request; job_ids that already exist are left
+    untouched, so re-queuing the same job is a no-op.
+    """
+    if not rows:
+        return
+    supabase.table("jobs").upsert(rows, on_conflict="job_id", ignore_duplicates=True).execute()
+
+
+def finish_jobs_batch(worker, transitions):
+    """
+    Apply many job transitions in one request, only to jobs the worker
+    still holds the lease on (rl_finish_jobs, see database_changes.sql).
+    Returns the job_ids that were updated.
+    """
+    if not transitions:
+        return []
+    result = supabase.rpc("rl_finish_jobs", {"worker": worker, "transitions": transitions}).execute()
+    return [row["job_id"] for row in result.data or []]
+
+
+def queue_job(job_id, job_type, payload, run_at=None):
+    """
+    Buffer a new queued job in job_store; written on the next flush.
+    """
+    now = datetime.now(IST)
+    job_store.add_job({
+        "job_id": job_id,
+        "job_type": job_type,
+        "payload": payload,
+        "status": "queued",
+        "run_at": (run_at or now).isoformat(),
+        "retry_count": 0,
+        "created_at": now.isoformat()
+    })
+
+
+def flush_jobs():
+    return job_store.flush()
+
+
+job_store = JobStore(
+    insert_jobs_batch,
+    finish_jobs_batch,
+    flush_interval=JOBS_FLUSH_SECONDS,
+    max_pending=JOBS_MAX_PENDING
+)
+atexit.register(job_store.flush)
 
-            if res.data and len(res.data) > 0:
-                row = res.data[0]
-                if "id" in row and "preference_score" in row and "num_samples" in row:
-                    current_score = float(row["preference_score"])
-                    current_samples = int(row["num_samples"])
-                    new_score = current_score + delta
-
-                    print(f"   Existing preference: {current_score:.4f} -> {new_score:.4f} (samples: {current_samples} -> {current_samples + 1})")
-                    supabase.table("rl_preferences").update({
-                        "preference_score": new_score,
-                        "num_samples": current_samples + 1,
-                        "updated_at": datetime.now(IST).isoformat()
-                    }).eq("id", row["id"]).execute()
-                    return  # Success
-            else:
-                # Insert new preference - use upsert for safety
-                print(f"   Creating new preference entry with score: {delta:.4f}")
-                try:
-                    supabase.table("rl_preferences").upsert({
-                        "platform": platform,
-                        "time_bucket": time_bucket,
-                        "dimension": dimension,
-                        "action_value": value,
-                        "preference_score": delta,
-                        "num_samples": 1
-                    }).execute()
-                    return  # Success
-                except Exception as insert_error:
-                    # If upsert fails, the row might have been inserted by another process
-                    # Try update instead
-                    if attempt < max_retries - 1:  # Don't retry on last attempt
-                        continue
-                    raise insert_error
-
-            # If we get here, something unexpected happened
-            if attempt == max_retries - 1:
-                raise ValueError("Failed to update preference after all retries")
 
-        except Exception as e:
-            if attempt == max_retries - 1:  # Last attempt
-                print(f"Error updating preference for {platform}, {dimension}={value} after {max_retries} attempts: {e}")
-                raise
-            else:
-                print(f"Attempt {attempt + 1} failed, retrying: {e}")
-                continue
 def insert_post_content(
     post_id,
     action_id,
@@ -429,7 +518,36 @@ def create_post_reward_record(profile_id, post_id, platform, action_id=None):
     except Exception as e:
         print(f"Error creating post reward record for {post_id}: {e}")
         raise
-def insert_action(post_id, platform, context, action):
+def encode_context_vector(vec):
+    """
+    Compact form of a policy context vector for rl_actions.context_vector:
+    base64 of the float16 bytes (~4x smaller than a JSON float list).
+    """
+    return base64.b64encode(np.asarray(vec, dtype="<f2").tobytes()).decode("ascii")
+
+
+def decode_context_vector(encoded):
+    """
+    Inverse of encode_context_vector. Returns a float32 vector or None.
+    """
+    if not encoded:
+        return None
+    try:
+        return np.frombuffer(base64.b64decode(encoded), dtype="<f2").astype(np.float32)
+    except (ValueError, TypeError) as e:
+        print(f"Error decoding context vector: {e}")
+        return None
+
+
+def insert_action(post_id, platform, context, action,
+                  topic=None, business_id=None, ctx_vec=None, context_projection=None,
+                  propensity=None):
+    """
+    ctx_vec is the vector select_action scored with (in the projected space
+    named by context_projection), stored so the RL update can reuse it
+    instead of re-embedding the topic. propensity is {dimension: probability
+    of the chosen value} as logged by the sampler, for off-policy evaluation.
+    """
     try:
         res = supabase.table("rl_actions").insert({
             "post_id": post_id,
@@ -442,8 +560,11 @@ def insert_action(post_id, platform, context, action):
             "visual_style": action.get("VISUAL_STYLE"),
             "content_type": action.get("CONTENT_TYPE"),  # New: post or reel
             "time_bucket": context.get("time_bucket"),
-            "topic": None,  # Will be set from main.py
-            "business_id": None  # Will be set from main.py
+            "topic": topic,
+            "business_id": business_id,
+            "context_vector": encode_context_vector(ctx_vec) if ctx_vec is not None else None,
+            "context_projection": context_projection,
+            "propensity": propensity
         }).execute()
 
         if res.data and len(res.data) > 0 and "id" in res.data[0]:
@@ -501,34 +622,114 @@ def update_baseline_ema(previous_baseline: float, current_reward: float, beta: f
     """
     return (1 - beta) * previous_baseline + beta * current_reward
 
-# Global baseline storage for mathematical baseline updates
-_platform_baselines = {}
+# ---------- BASELINES ----------
+# One EMA of true rewards per (platform, time_bucket, content_type) in
+# rl_baselines, folded in server-side by rl_update_baselines (see
+# database_changes.sql) so concurrent workers never lose an update.
+
+BASELINE_BETA = 0.1
+
 
-def get_platform_baseline(platform: str, default: float = 0.0) -> float:
-    """Get current baseline for a platform"""
-    return _platform_baselines.get(platform, default)
+def baseline_key(platform, time_bucket=None, content_type=None):
+    return {
+        "platform": platform,
+        "time_bucket": time_bucket or "",
+        "content_type": content_type or "post"
+    }
 
-def set_platform_baseline(platform: str, baseline: float):
-    """Set baseline for a platform"""
-    _platform_baselines[platform] = baseline
 
-def update_baseline_mathematical(platform: str, current_reward: float, beta: float = 0.1) -> float:
+def update_baselines_batch(updates, beta: float = BASELINE_BETA) -> list:
     """
-    Pure mathematical baseline update using exponential moving average.
+    Fold many rewards into their baselines with one atomic RPC.
+
+    updates: [{platform, time_bucket, content_type, reward}]
+    Returns the baseline after each reward, in input order. Rewards for the
+    same key are applied in input order (b = (1 - beta) * b + beta * r); a
+    key seen for the first time starts at its first reward, not at 0.
+    """
+    if not updates:
+        return []
+
+    payload = [
+        {**baseline_key(u["platform"], u.get("time_bucket"), u.get("content_type")), "reward": float(u["reward"])}
+        for u in updates
+    ]
+    try:
+        res = supabase.rpc("rl_update_baselines", {"updates": payload, "beta": beta}).execute()
+    except Exception as e:
+        print(f"Error updating {len(updates)} baselines: {e}")
+        raise
+
+    baselines = {row["idx"]: float(row["baseline"]) for row in res.data or []}
+    print(f"📊 Updated {len(updates)} baselines (beta: {beta})")
+    return [baselines[i] for i in range(len(updates))]
 
-    Formula: b_{t+1} = (1 - β) · b_t + β · R_t
 
-    This is the ONLY correct way for RL baseline calculation.
+def update_baseline(platform: str, time_bucket: str, content_type: str, reward: float,
+                    beta: float = BASELINE_BETA) -> float:
+    return update_baselines_batch([{
+        "platform": platform,
+        "time_bucket": time_bucket,
+        "content_type": content_type,
+        "reward": reward
+    }], beta)[0]
+
+
+def get_baselines_batch(keys) -> list:
+    """
+    Current baselines for [(platform, time_bucket, content_type)] without
+    updating them. A key with no rewards yet falls back to the mean of its
+    platform's baselines, or 0.0 for a platform with none.
     """
-    previous_baseline = get_platform_baseline(platform, 0.0)
-    new_baseline = update_baseline_ema(previous_baseline, current_reward, beta)
+    if not keys:
+        return []
 
-    # Store the updated baseline
-    set_platform_baseline(platform, new_baseline)
+    platforms = sorted({platform for platform, _, _ in keys})
+    try:
+        res = supabase.table("rl_baselines") \
+            .select("platform, time_bucket, content_type, value") \
+            .in_("platform", platforms) \
+            .execute()
+        rows = res.data or []
+    except Exception as e:
+        print(f"Error fetching baselines for {platforms}: {e}")
+        rows = []
+
+    values, by_platform = {}, {}
+    for row in rows:
+        values[(row["platform"], row["time_bucket"], row["content_type"])] = float(row["value"])
+        by_platform.setdefault(row["platform"], []).append(float(row["value"]))
+
+    baselines = []
+    for platform, time_bucket, content_type in keys:
+        key = tuple(baseline_key(platform, time_bucket, content_type).values())
+        fallback = float(np.mean(by_platform[platform])) if platform in by_platform else 0.0
+        baselines.append(values.get(key, fallback))
+    return baselines
+
+
+def parse_embedding(embedding_data):
+    """
+    user_context_embedding can be returned as a list/array or string from Supabase.
+    Returns a float32 vector or None.
+    """
+    if isinstance(embedding_data, list):
+        return np.array(embedding_data, dtype=np.float32)
+    elif isinstance(embedding_data, str):
+        # Parse string representation of vector (e.g., "[1.0, 2.0, 3.0]" or "1.0,2.0,3.0")
+        try:
+            # Remove brackets if present and split by comma
+            cleaned_str = embedding_data.strip('[]')
+            values = [float(x.strip()) for x in cleaned_str.split(',')]
+            return np.array(values, dtype=np.float32)
+        except (ValueError, AttributeError) as parse_error:
+            print(f"Error parsing embedding string: {parse_error}")
+            return None
+    else:
+        print(f"Unexpected embedding format: {type(embedding_data)}")
+        return None
 
-    print(f"📊 Mathematical baseline update for {platform}: {previous_baseline:.4f} → {new_baseline:.4f} (reward: {current_reward:.4f}, beta: {beta})")
 
-    return new_baseline
 def get_profile_embedding(profile_id):
     """Retrieve profile embedding from profiles table"""
     try:
@@ -540,24 +741,7 @@ def get_profile_embedding(profile_id):
         if res.data and len(res.data) > 0:
             row = res.data[0]
             if "user_context_embedding" in row and row["user_context_embedding"] is not None:
-                # user_context_embedding can be returned as a list/array or string from Supabase
-                embedding_data = row["user_context_embedding"]
-
-                if isinstance(embedding_data, list):
-                    return np.array(embedding_data, dtype=np.float32)
-                elif isinstance(embedding_data, str):
-                    # Parse string representation of vector (e.g., "[1.0, 2.0, 3.0]" or "1.0,2.0,3.0")
-                    try:
-                        # Remove brackets if present and split by comma
-                        cleaned_str = embedding_data.strip('[]')
-                        values = [float(x.strip()) for x in cleaned_str.split(',')]
-                        return np.array(values, dtype=np.float32)
-                    except (ValueError, AttributeError) as parse_error:
-                        print(f"Error parsing embedding string: {parse_error}")
-                        return None
-                else:
-                    print(f"Unexpected embedding format: {type(embedding_data)}")
-                    return None
+                return parse_embedding(row["user_context_embedding"])
 
         return None
     except Exception as e:
@@ -565,6 +749,91 @@ def get_profile_embedding(profile_id):
         return None
 
 
+def get_profile_embeddings(profile_ids, chunk_size=100):
+    """
+    Batch version of get_profile_embedding.
+    Returns {profile_id: embedding}; profiles without an embedding are left out.
+    """
+    embeddings = {}
+    profile_ids = list(profile_ids)
+    for start in range(0, len(profile_ids), chunk_size):
+        chunk = profile_ids[start:start + chunk_size]
+        try:
+            res = supabase.table("profiles") \
+                .select("id, user_context_embedding") \
+                .in_("id", chunk) \
+                .execute()
+
+            for row in res.data or []:
+                if row.get("user_context_embedding") is not None:
+                    embedding = parse_embedding(row["user_context_embedding"])
+                    if embedding is not None:
+                        embeddings[row["id"]] = embedding
+        except Exception as e:
+            print(f"Error retrieving {len(chunk)} profile embeddings: {e}")
+
+    return embeddings
+
+
+_segment_cache = {}
+
+
+def get_business_segments(profile_ids):
+    """
+    Cached profiles.rl_segment for many profiles: {profile_id: segment or None}.
+    """
+    missing = [i for i in profile_ids if i not in _segment_cache]
+    for start in range(0, len(missing), 100):
+        chunk = missing[start:start + 100]
+        try:
+            res = supabase.table("profiles") \
+                .select("id, rl_segment") \
+                .in_("id", chunk) \
+                .execute()
+            for row in res.data or []:
+                _segment_cache[row["id"]] = row.get("rl_segment")
+        except Exception as e:
+            print(f"Error fetching segments for {len(chunk)} profiles: {e}")
+            return {i: _segment_cache.get(i) for i in profile_ids}
+
+    return {i: _segment_cache.get(i) for i in profile_ids}
+
+
+def get_business_segment(profile_id):
+    return get_business_segments([profile_id])[profile_id]
+
+
+def set_business_segments(assignments):
+    """
+    Store {profile_id: segment}, one update per segment.
+    """
+    by_segment = {}
+    for profile_id, segment in assignments.items():
+        by_segment.setdefault(segment, []).append(profile_id)
+
+    for segment, ids in by_segment.items():
+        for start in range(0, len(ids), 100):
+            supabase.table("profiles") \
+                .update({"rl_segment": segment}) \
+                .in_("id", ids[start:start + 100]) \
+                .execute()
+    _segment_cache.update(assignments)
+
+
+def delete_segment_preferences_before(first_segment):
+    """
+    Delete per-segment rl_preferences rows with 0 <= segment < first_segment
+    (older segment generations, see segments.py). Global rows are kept.
+    """
+    res = supabase.table("rl_preferences") \
+        .delete() \
+        .gte("segment", 0) \
+        .lt("segment", first_segment) \
+        .execute()
+    preference_cache.invalidate()
+    return len(res.data or [])
+
+
 def get_profile_embedding_with_fallback(profile_id):
     """Get profile embedding, return None if not found (no fake data)"""
     embedding = get_profile_embedding(profile_id)
@@ -694,20 +963,23 @@ def get_all_profile_ids():
         return []
 
 
-def should_create_post_today(profile_id) -> bool:
+def should_create_post_today(profile_id, platform=None) -> bool:
     """
-    Checks if a post has already been created for today for the given profile.
+    Checks if a post has already been created for today for the given profile
+    (on the given platform, if any).
     Returns True if no post exists for today, False otherwise.
     """
     try:
         current_date = datetime.now(IST).date().isoformat()
         
         # Query post_contents for any post by this business on this date
-        res = supabase.table("post_contents") \
+        query = supabase.table("post_contents") \
             .select("post_id") \
             .eq("business_id", profile_id) \
-            .eq("post_date", current_date) \
-            .execute()
+            .eq("post_date", current_date)
+        if platform is not None:
+            query = query.eq("platform", platform)
+        res = query.execute()
             
         if res.data and len(res.data) > 0:
             return False  # Already posted today
@@ -757,6 +1029,36 @@ def get_post_reward(profile_id: str, post_id: str, platform: str):
     except Exception as e:
         print(f"Error fetching reward record: {e}")
         return None
+
+
+def get_provisional_states(post_ids):
+    """
+    {(post_id, platform): {"reward_status", "provisional_reward"}} for many
+    posts in one query. provisional_reward is only set once the provisional
+    RL update has been applied (see set_provisional_rewards).
+    Raises on errors: guessing would apply a reward twice or not at all.
+    """
+    if not post_ids:
+        return {}
+    res = supabase.table("post_rewards") \
+        .select("post_id, platform, reward_status, provisional_reward") \
+        .in_("post_id", sorted(set(post_ids))) \
+        .execute()
+    return {(row["post_id"], row["platform"]): row for row in res.data or []}
+
+
+def set_provisional_rewards(applied):
+    """
+    Record the predictions of [(post_id, platform, prediction)] whose
+    provisional RL update has just been applied, so the final reward only
+    applies the residual.
+    """
+    for post_id, platform, prediction in applied:
+        supabase.table("post_rewards") \
+            .update({"provisional_reward": prediction}) \
+            .eq("post_id", post_id) \
+            .eq("platform", platform) \
+            .execute()
 def get_post_snapshots(profile_id: str, post_id: str, platform: str):
     res = (
         supabase.table("post_snapshots")
@@ -836,6 +1138,45 @@ def calculate_reward_from_snapshots(snapshots: list, platform: str, post_id: str
     print(f"   Total reward: {reward:.4f}, Followers: {followers}, Raw score: {raw_score:.4f}, Final reward: {final_reward:.4f}")
 
     return final_reward
+def reward_action_id(reward_row, platform):
+    """
+    rl_actions id of a post_rewards row, falling back to post_contents.
+    """
+    action_id = reward_row.get("action_id")
+
+    # If action_id not in reward record, try to find it from post_contents
+    if not action_id:
+        try:
+            post_content = supabase.table("post_contents").select("action_id").eq("post_id", reward_row["post_id"]).eq("platform", platform).execute()
+            if post_content.data and len(post_content.data) > 0:
+                action_id = post_content.data[0].get("action_id")
+                print(f"   🔗 Found action_id from post_contents: {action_id}")
+        except Exception as e:
+            print(f"   ⚠️  Could not find action_id: {e}")
+
+    return action_id
+
+
+def get_stored_baseline(action_id):
+    """
+    Baseline stored with the action's true reward in rl_rewards, i.e. the
+    value after that reward was folded in. None if no reward row exists
+    (the reward was never folded). Errors propagate: reading None instead
+    would fold the reward a second time.
+    """
+    if not action_id:
+        return None
+    res = (
+        supabase.table("rl_rewards")
+        .select("baseline")
+        .eq("action_id", action_id)
+        .eq("reward_window", "24h")
+        .limit(1)
+        .execute()
+    )
+    return res.data[0]["baseline"] if res.data else None
+
+
 def fetch_or_calculate_reward(profile_id: str, post_id: str, platform: str):
     print(f"Fetching/calculating reward for post {post_id} on {platform}")
     reward_row = get_post_reward(profile_id, post_id, platform)
@@ -854,7 +1195,9 @@ def fetch_or_calculate_reward(profile_id: str, post_id: str, platform: str):
         print(f"   Reward already calculated: {existing_reward}")
         return {
             "status": "calculated",
-            "reward": existing_reward
+            "reward": existing_reward,
+            # A retried job must not fold the reward into its baseline again
+            "baseline": get_stored_baseline(reward_action_id(reward_row, platform))
         }
 
     # 2️⃣ Check eligibility status (handle multiple valid states)
@@ -901,6 +1244,7 @@ def fetch_or_calculate_reward(profile_id: str, post_id: str, platform: str):
         }
 
     reward_value = calculate_reward_from_snapshots(snapshots, platform, post_id)
+    current_baseline = None
 
     try:
         print(f"   Updating reward record with calculated value: {reward_value}")
@@ -912,23 +1256,18 @@ def fetch_or_calculate_reward(profile_id: str, post_id: str, platform: str):
 
         # Also store final reward in rl_rewards table
         print(f"   📊 Storing reward in rl_rewards table")
-        action_id = reward_row.get("action_id")
-
-        # If action_id not in reward record, try to find it from post_contents
-        if not action_id:
-            try:
-                post_content = supabase.table("post_contents").select("action_id").eq("post_id", reward_row["post_id"]).eq("platform", platform).execute()
-                if post_content.data and len(post_content.data) > 0:
-                    action_id = post_content.data[0].get("action_id")
-                    print(f"   🔗 Found action_id from post_contents: {action_id}")
-            except Exception as e:
-                print(f"   ⚠️  Could not find action_id: {e}")
+        action_id = reward_action_id(reward_row, platform)
 
         if not action_id:
             print(f"   ⚠️  Warning: No action_id found, skipping rl_rewards insert")
         else:
-            # Calculate and update platform baseline using pure mathematics
-            current_baseline = update_baseline_mathematical(platform, reward_value, beta=0.1)
+            # The only place a true reward is folded into its baseline; the
+            # RL update job reuses this value
+            action_res = supabase.table("rl_actions").select("time_bucket, content_type").eq("id", action_id).execute()
+            action_row = action_res.data[0] if action_res.data else {}
+            current_baseline = update_baseline(
+                platform, action_row.get("time_bucket"), action_row.get("content_type"), reward_value
+            )
 
             supabase.table("rl_rewards").insert({
                 "action_id": action_id,  # Link to rl_actions record
@@ -950,7 +1289,8 @@ def fetch_or_calculate_reward(profile_id: str, post_id: str, platform: str):
 
     return {
         "status": "calculated",
-        "reward": reward_value
+        "reward": reward_value,
+        "baseline": current_baseline
     }
 
 
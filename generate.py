@@ -427,13 +427,14 @@ Create an image that encourages action and reinforces the main message about {to
 # CONTEXT BUILDER 
 # ============================================================
 
-def build_context(business_embedding, topic_embedding, platform, time):
+def build_context(business_embedding, topic_embedding, platform, time, business_id=None):
     """
     Build RL context from embeddings and scheduling info.
     """
     return {
         "platform": platform,
         "time_bucket": time,
+        "business_id": business_id,
         "business_embedding": business_embedding,
         "topic_embedding": topic_embedding
     }
@@ -450,10 +451,15 @@ def generate_prompts(
     platform: str,
     time: str,
     topic_text: str,profile_data: dict,
-    business_context: str
+    business_context: str,
+    business_id: str = None,
+    post_id: str = None,
+    selection: tuple = None
 ) -> dict:
     """
     Single execution point between RL and LLMs.
+    selection: (action, ctx_vec, propensity) already chosen for this context
+    by select_actions_batch; selected here when None.
     """
 
     print(f"RL Context: Platform={platform}, Time={time}")
@@ -463,11 +469,14 @@ def generate_prompts(
         business_embedding=business_embedding,
         topic_embedding=topic_embedding,
         platform=platform,
-        time=time
+        time=time,
+        business_id=business_id
     )
 
     # 2. RL decides creative controls
-    action, ctx_vec = select_action(context) 
+    if selection is None:
+        selection = select_action(context, post_id)
+    action, ctx_vec, propensity = selection
     
     print(f"RL Selected Action: {action}")
     hook_type = action.get("HOOK_TYPE", "")
@@ -527,7 +536,8 @@ def generate_prompts(
             "style": selected_style,
             "action": action,
             "context": context,
-            "ctx_vec": ctx_vec
+            "ctx_vec": ctx_vec,
+            "propensity": propensity
         }
 
 
@@ -563,5 +573,6 @@ def generate_prompts(
         "image_prompt": llm_response["image_prompt"],
         "action": action,
         "context": context,
-        "ctx_vec": ctx_vec
+        "ctx_vec": ctx_vec,
+        "propensity": propensity
     }
\ No newline at end of file
@@ -2,17 +2,26 @@
 job_queue.py
 -------------
 Cron-safe job poller for reward calculation + RL updates.
-Runs once, processes all due jobs, then exits.
+Runs once, processes all due jobs, then exits; with --daemon it keeps
+polling in one warm process and stops cleanly on SIGTERM.
+
+Jobs are claimed atomically with a lease (rl_claim_jobs), so any number of
+workers on any number of hosts can run this concurrently without picking
+up the same job twice.
 """
 
 import asyncio
+import argparse
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
 import time
 import logging
 from datetime import datetime
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional
 import pytz
-import subprocess
-import sys
+import socket
+import importlib
 
 import db
 import rl_agent
@@ -22,6 +31,44 @@ import rl_agent
 IST = pytz.timezone("Asia/Kolkata")
 MAX_RETRIES = 3
 
+# Jobs are claimed with a lease (rl_claim_jobs); a worker that dies leaves
+# them running until the lease expires and a reaper requeues them
+WORKER_ID = os.getenv("JOB_WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+CLAIM_BATCH = int(os.getenv("JOB_CLAIM_BATCH", "20"))
+LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "600"))
+
+# Claimed jobs run concurrently on one event loop, at most this many per
+# job_type at a time (JOB_CONCURRENCY="reward_calculation=32,content_generation=1");
+# rl_update jobs are applied as one batch by a single writer
+DEFAULT_CONCURRENCY = {"reward_calculation": 16, "content_generation": 2, "rl_update": 1}
+
+def parse_concurrency(spec: str) -> Dict[str, int]:
+    limits = dict(DEFAULT_CONCURRENCY)
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        job_type, _, limit = part.partition("=")
+        limits[job_type.strip()] = max(int(limit), 1)
+    limits["rl_update"] = 1
+    return limits
+
+JOB_CONCURRENCY = parse_concurrency(os.getenv("JOB_CONCURRENCY", ""))
+JOB_THREADS = int(os.getenv("JOB_THREADS", "32"))       # blocking DB/LLM calls
+RUN_SECONDS = float(os.getenv("JOB_RUN_SECONDS", "45"))  # keep claiming new rounds for this long
+
+# --daemon: idle polls back off from POLL_MIN_SECONDS to POLL_MAX_SECONDS,
+# but never sleep past the earliest queued run_at
+POLL_MIN_SECONDS = float(os.getenv("JOB_POLL_MIN_SECONDS", "1"))
+POLL_MAX_SECONDS = float(os.getenv("JOB_POLL_MAX_SECONDS", "60"))
+HOUSEKEEPING_SECONDS = float(os.getenv("JOB_HOUSEKEEPING_SECONDS", "60"))  # reaping, provisional rewards, logit tables
+
+# Every RL batch makes the logit tables (RL_LOGIT_TABLES) stale; housekeeping
+# rebuilds them, at most once per this many seconds
+LOGIT_TABLES_REBUILD_SECONDS = float(os.getenv("RL_LOGIT_TABLES_REBUILD_SECONDS", "3600"))
+_tables_built_at = None
+
+# Provisional RL updates from predicted rewards a day after posting (see reward_predictor.py)
+EARLY_REWARDS = os.getenv("RL_EARLY_REWARDS", "0") == "1"
+REWARD_MODEL_PATH = os.getenv("RL_REWARD_MODEL", "reward_model.json")
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s | %(levelname)s | %(message)s"
@@ -30,42 +77,111 @@ logger = logging.getLogger("job_queue")
 
 # ---------------- JOB FETCHING ----------------
 
-def fetch_due_jobs():
+def claim_jobs(limit: int = CLAIM_BATCH) -> List[Dict[str, Any]]:
     """
-    Fetch jobs that are ready to run.
+    Atomically claim up to limit due jobs for this worker.
+    Claimed jobs come back already running, with a lease of LEASE_SECONDS;
+    rows locked by another worker's claim are skipped, not waited for.
     """
-    result = (
-        db.supabase
-        .table("jobs")
-        .select("*")
-        .eq("status", "queued")
-        .lte("run_at", datetime.now(IST).isoformat())
-        .limit(20)
-        .execute()
-    )
+    result = db.supabase.rpc("rl_claim_jobs", {
+        "worker": WORKER_ID,
+        "batch_size": limit,
+        "lease_seconds": LEASE_SECONDS
+    }).execute()
     return result.data or []
 
-def mark_job_running(job_id: str):
-    db.supabase.table("jobs").update({
-        "status": "running",
-        "started_at": datetime.now(IST).isoformat()
-    }).eq("job_id", job_id).execute()
+def renew_leases(job_ids: List[str]) -> List[str]:
+    """
+    Push the lease of jobs this worker still holds LEASE_SECONDS into the
+    future. Returns the ids that are still held.
+    """
+    if not job_ids:
+        return []
+    result = db.supabase.rpc("rl_renew_job_leases", {
+        "worker": WORKER_ID,
+        "job_ids": job_ids,
+        "lease_seconds": LEASE_SECONDS
+    }).execute()
+    return [row["job_id"] for row in result.data or []]
+
+async def run_leased(job_id: str, func, *args):
+    """
+    Run a blocking call on the thread pool, renewing the job's lease every
+    third of LEASE_SECONDS until it returns.
+    """
+    task = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=max(LEASE_SECONDS // 3, 1))
+        if done:
+            return task.result()
+        if not await asyncio.to_thread(renew_leases, [job_id]):
+            logger.warning(f"Lost the lease on {job_id} while it was still running")
+
+def seconds_until_next_job() -> Optional[float]:
+    """
+    Seconds until the earliest queued job is due (0 if one is due now),
+    None if nothing is queued.
+    """
+    result = db.supabase.table("jobs") \
+        .select("run_at") \
+        .eq("status", "queued") \
+        .order("run_at") \
+        .limit(1) \
+        .execute()
+    if not result.data:
+        return None
+    run_at = datetime.fromisoformat(result.data[0]["run_at"].replace('Z', '+00:00'))
+    return max((run_at - datetime.now(IST)).total_seconds(), 0.0)
+
+def reap_expired_leases() -> int:
+    """
+    Requeue (or fail, after MAX_RETRIES) running jobs whose lease expired.
+    """
+    result = db.supabase.rpc("rl_reap_jobs", {"max_retries": MAX_RETRIES}).execute()
+    return result.data or 0
+
+# Both are buffered in db.job_store and written in one batch per round
+# (rl_finish_jobs). They only touch jobs this worker still holds: if the
+# lease expired and the job was reaped or claimed again, the newer owner
+# decides its status.
 
 def mark_job_completed(job_id: str, result: Dict[str, Any]):
-    db.supabase.table("jobs").update({
+    db.job_store.transition(WORKER_ID, job_id, {
         "status": "completed",
         "completed_at": datetime.now(IST).isoformat(),
         "result": result
-    }).eq("job_id", job_id).execute()
+    })
 
 def mark_job_failed(job_id: str, error: str, retry_count: int):
     new_status = "failed" if retry_count + 1 >= MAX_RETRIES else "queued"
 
-    db.supabase.table("jobs").update({
+    db.job_store.transition(WORKER_ID, job_id, {
         "status": new_status,
         "retry_count": retry_count + 1,
         "last_error": error
-    }).eq("job_id", job_id).execute()
+    })
+
+def queue_rl_update(profile_id: str, post_id: str, platform: str, reward_value: float,
+                    kind: str = "final", baseline: Optional[float] = None):
+    """
+    kind: "final" (true reward) or "provisional" (predicted reward).
+    Whether a final reward is applied in full or as the residual of a
+    provisional update is decided when it is applied (process_rl_updates).
+    baseline: the value the reward was already folded into, if any.
+    """
+    payload = {
+        "profile_id": profile_id,
+        "post_id": post_id,
+        "platform": platform,
+        "reward_value": reward_value,
+        "kind": kind
+    }
+    if baseline is not None:
+        payload["baseline"] = baseline
+
+    # One job per post and kind: a retried reward job cannot queue the update twice
+    prefix = "rl" if kind == "final" else f"rl_{kind}"
+    db.queue_job(f"{prefix}_{post_id}", "rl_update", payload)
 
 # ---------------- JOB PROCESSORS ----------------
 
@@ -77,56 +193,190 @@ async def process_reward_calculation(job: Dict[str, Any]) -> Dict[str, Any]:
 
     logger.info(f"Reward calc → {post_id} ({platform})")
 
-    result = db.fetch_or_calculate_reward(profile_id, post_id, platform)
+    result = await asyncio.to_thread(db.fetch_or_calculate_reward, profile_id, post_id, platform)
 
     if result.get("status") == "calculated":
         # Queue RL update job
-        db.supabase.table("jobs").insert({
-            "job_id": f"rl_{post_id}_{int(time.time())}",
-            "job_type": "rl_update",
-            "payload": {
-                "profile_id": profile_id,
-                "post_id": post_id,
-                "platform": platform,
-                "reward_value": result["reward"]
-            },
-            "status": "queued",
-            "run_at": datetime.now(IST).isoformat(),
-            "retry_count": 0,
-            "created_at": datetime.now(IST).isoformat()
-        }).execute()
+        await asyncio.to_thread(
+            queue_rl_update, profile_id, post_id, platform, result["reward"],
+            baseline=result.get("baseline")
+        )
 
     return result
 
-async def process_rl_update(job: Dict[str, Any]) -> Dict[str, Any]:
+def refresh_logit_tables() -> bool:
+    """
+    Rebuild the logit tables if they no longer match theta, so the
+    generation that follows can use them. Runs from housekeeping, outside
+    any leased job, at most once per LOGIT_TABLES_REBUILD_SECONDS.
+    Returns True if a rebuild ran.
+    """
+    global _tables_built_at
+    if rl_agent.logit_tables is None:
+        return False
+    if _tables_built_at is not None and time.monotonic() - _tables_built_at < LOGIT_TABLES_REBUILD_SECONDS:
+        return False
+
+    with rl_agent.policy_lock:
+        rl_agent.theta.load()
+        fresh = rl_agent.logit_tables.load() and rl_agent.logit_tables.matches(
+            rl_agent.theta.version, rl_agent.PROJECTION_ID, rl_agent.ACTION_SPACE
+        )
+    if fresh:
+        return False
+
+    import logit_tables
+    try:
+        logit_tables.build_tables(rl_agent.LOGIT_TABLES_PATH)
+    finally:
+        _tables_built_at = time.monotonic()   # a failed build waits for the next interval too
+    return True
+
+async def process_content_generation(job: Dict[str, Any]) -> Dict[str, Any]:
     payload = job["payload"]
+    business_id = payload["business_id"]
+    # Jobs scheduled before per-platform jobs cover every platform of the business
+    platforms = [payload["platform"]] if payload.get("platform") else None
 
-    profile_id = payload["profile_id"]
-    post_id = payload["post_id"]
-    platform = payload["platform"]
-    reward_value = payload["reward_value"]
+    logger.info(f"Content generation → {business_id} ({payload.get('platform') or 'all platforms'})")
 
-    logger.info(f"RL update → {post_id} (reward={reward_value:.4f})")
+    # Generation pulls in the LLM/image clients; only load them once a worker needs them
+    main = await asyncio.to_thread(importlib.import_module, "main")
+    result = await run_leased(job["job_id"], main.generate_for_business, business_id, platforms)
 
-    action_data = get_action_and_context_from_db(post_id, platform, profile_id)
-    if not action_data:
-        return {"status": "skipped", "reason": "missing_action_context"}
+    if result["failed"]:
+        raise RuntimeError(f"Content generation failed: {result['failed']}")
 
-    baseline = db.update_baseline_mathematical(
-        platform,
-        reward_value,
-        beta=0.1
-    )
+    return result
+
+def queue_provisional_updates() -> int:
+    """
+    Predict the final reward of posts whose 24h snapshot is in and queue a
+    provisional RL update for each. Returns the number queued.
+    """
+    import reward_predictor
 
-    rl_agent.update_rl(
-        context=action_data["context"],
-        action=action_data["action"],
-        ctx_vec=action_data["ctx_vec"],
-        reward=reward_value,
-        baseline=baseline
+    model = reward_predictor.RewardPredictor(REWARD_MODEL_PATH)
+    if not model.load():
+        logger.warning(f"RL_EARLY_REWARDS is set but {REWARD_MODEL_PATH} has not been fitted")
+        return 0
+
+    predicted = reward_predictor.predict_pending(model)
+    for row, prediction in predicted:
+        logger.info(f"Provisional reward → {row['post_id']} ({row['platform']}): {prediction:.4f}")
+        queue_rl_update(row["profile_id"], row["post_id"], row["platform"], prediction, kind="provisional")
+    return len(predicted)
+
+async def process_rl_updates(jobs: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Apply every due rl_update job with a single rl_agent.update_rl_batch call.
+    Returns {job_id: result}.
+
+    A final reward whose provisional update has been applied only applies
+    the residual; otherwise it is applied in full, and a provisional job
+    that is still queued once the final reward is calculated is dropped.
+    """
+    results = {}
+    samples = []
+    read, fold = [], []   # samples needing the current baseline / folded into it once applied
+    applied = []          # (post_id, platform, prediction) of provisional updates
+
+    # CONCURRENT FETCH: every job's action row at once, and the provisional state of their posts
+    contexts, states = await asyncio.gather(
+        asyncio.gather(*(
+            asyncio.to_thread(
+                get_action_and_context_from_db,
+                job["payload"]["post_id"],
+                job["payload"]["platform"],
+                job["payload"]["profile_id"]
+            )
+            for job in jobs
+        )),
+        asyncio.to_thread(db.get_provisional_states, [job["payload"]["post_id"] for job in jobs])
     )
 
-    return {"status": "completed", "baseline": baseline}
+    for job, action_data in zip(jobs, contexts):
+        payload = job["payload"]
+
+        post_id = payload["post_id"]
+        platform = payload["platform"]
+        reward_value = payload["reward_value"]
+        kind = payload.get("kind", "final")
+
+        state = states.get((post_id, platform), {})
+        provisional = state.get("provisional_reward") if kind != "provisional" else None
+
+        logger.info(f"RL update → {post_id} ({kind}, reward={reward_value:.4f})")
+
+        if not action_data:
+            results[job["job_id"]] = {"status": "skipped", "reason": "missing_action_context"}
+            continue
+        if kind == "provisional" and (state.get("reward_status") == "calculated" or state.get("provisional_reward") is not None):
+            # Already applied, or too late: the final reward is applied in full
+            results[job["job_id"]] = {"status": "skipped", "reason": "superseded"}
+            continue
+
+        sample = {
+            "context": action_data["context"],
+            "action": action_data["action"],
+            "ctx_vec": action_data["ctx_vec"],
+            "reward": reward_value,
+            "baseline": 0.0,
+            "correction": provisional is not None,
+            "job_id": job["job_id"],
+            "kind": "correction" if provisional is not None else kind,
+            "baseline_key": (platform, action_data["context"].get("time_bucket"), action_data["action"].get("CONTENT_TYPE"))
+        }
+
+        if provisional is not None:
+            # The provisional update already used advantage (predicted - baseline);
+            # adding (true - predicted) makes the total the true-reward update.
+            # Baselines only track true rewards, folded in by fetch_or_calculate_reward.
+            sample["reward"] = reward_value - float(provisional)
+        elif payload.get("baseline") is not None:
+            sample["baseline"] = payload["baseline"]
+        else:
+            read.append(sample)
+            if kind == "final":
+                fold.append(sample)   # reward was not folded in when calculated (no action_id, older jobs)
+        if kind == "provisional":
+            applied.append((post_id, platform, reward_value))
+
+        samples.append(sample)
+
+    # BATCH: one SELECT for every baseline not carried by the job
+    current = await asyncio.to_thread(db.get_baselines_batch, [s["baseline_key"] for s in read])
+    for sample, baseline in zip(read, current):
+        sample["baseline"] = baseline
+
+    for sample in samples:
+        results[sample["job_id"]] = {
+            "status": "completed",
+            "kind": sample["kind"],
+            "baseline": sample["baseline"]
+        }
+
+    await asyncio.to_thread(rl_agent.update_rl_batch, samples)
+
+    # Only once the update is applied: a failed batch is retried and must not
+    # fold its rewards twice. Failing from here on would apply them twice instead.
+    if fold:
+        try:
+            await asyncio.to_thread(db.update_baselines_batch, [
+                dict(zip(("platform", "time_bucket", "content_type"), s["baseline_key"]), reward=s["reward"])
+                for s in fold
+            ])
+        except Exception:
+            logger.exception(f"Could not fold {len(fold)} applied rewards into their baselines")
+
+    # Only now may a final reward be reduced to its residual
+    if applied:
+        try:
+            await asyncio.to_thread(db.set_provisional_rewards, applied)
+        except Exception:
+            logger.exception(f"Could not record {len(applied)} applied provisional rewards")
+
+    return results
 
 # ---------------- CONTEXT FETCH ----------------
 
@@ -149,98 +399,299 @@ def get_action_and_context_from_db(
         return None
 
     row = action_res.data[0]
-
-    action = {
-        "HOOK_TYPE": row.get("hook_type"),
-        "LENGTH": row.get("hook_length"),
-        "TONE": row.get("tone"),
-        "CREATIVITY": row.get("creativity"),
-        "TEXT_IN_IMAGE": row.get("text_in_image"),
-        "VISUAL_STYLE": row.get("visual_style"),
-        "CONTENT_TYPE": row.get("content_type"),  # New: post or reel
-        "INFORMATION_DEPTH": row.get("information_depth"),
-        "COMPOSITION_STYLE": row.get("composition_style")
-    }
-
-    business_embedding = db.get_profile_embedding_with_fallback(profile_id)
-    topic = row.get("topic", "")
-    topic_embedding = db.embed_topic(topic) if topic else None
+    action = rl_agent.action_from_row(row)
 
     context = {
         "platform": platform,
         "time_bucket": row.get("time_bucket"),
-        "day_of_week": row.get("day_of_week"),
-        "business_embedding": business_embedding,
-        "topic_embedding": topic_embedding or business_embedding
+        "business_id": profile_id
     }
 
-    from rl_agent import build_context_vector
-    ctx_vec = build_context_vector(context)
+    # Vector saved at selection time: no embedding calls needed
+    ctx_vec = rl_agent.stored_policy_vector(row)
+    if ctx_vec is not None:
+        return {"action": action, "context": context, "ctx_vec": ctx_vec}
+
+    # Older rows (or a changed projection): rebuild from embeddings
+    logger.info(f"No stored context vector for {post_id}, rebuilding from embeddings")
+
+    business_embedding = db.get_profile_embedding_with_fallback(profile_id)
+    if business_embedding is None:
+        return None
+
+    topic = row.get("topic")
+    if topic:
+        from generate import embed_topic
+        topic_embedding = embed_topic(topic)
+    else:
+        topic_embedding = business_embedding
+
+    context["business_embedding"] = business_embedding
+    context["topic_embedding"] = topic_embedding
 
     return {
         "action": action,
         "context": context,
-        "ctx_vec": ctx_vec
+        "ctx_vec": rl_agent.policy_vector(context)
     }
 
-# ---------------- MAIN CRON ENTRY ----------------
+# ---------------- EXECUTOR ----------------
 
-def run_once():
-    jobs = fetch_due_jobs()
+JOB_PROCESSORS = {
+    "reward_calculation": process_reward_calculation,
+    "content_generation": process_content_generation
+}
 
-    if not jobs:
-        logger.info("No due jobs found")
-        return
+async def execute_job(job: Dict[str, Any], limit: asyncio.Semaphore):
+    job_id = job["job_id"]
+    job_type = job["job_type"]
 
-    logger.info(f"Processing {len(jobs)} jobs")
+    async with limit:
+        try:
+            if job_type not in JOB_PROCESSORS:
+                raise ValueError(f"Unknown job type: {job_type}")
+            result = await JOB_PROCESSORS[job_type](job)
+            await asyncio.to_thread(mark_job_completed, job_id, result)
+
+        except Exception as e:
+            logger.exception(f"Job failed: {job_id}")
+            await asyncio.to_thread(mark_job_failed, job_id, str(e), job.get("retry_count", 0))
+
+async def execute_rl_batch(rl_jobs: List[Dict[str, Any]], limit: asyncio.Semaphore):
+    """
+    Apply claimed rl_update jobs as one batch (rl_update's limit is always 1).
+    """
+    async with limit:
+        # Other jobs may have outlasted the lease; only apply what is still ours
+        held = set(await asyncio.to_thread(renew_leases, [job["job_id"] for job in rl_jobs]))
+        if len(held) < len(rl_jobs):
+            logger.warning(f"Lost the lease on {len(rl_jobs) - len(held)} RL update jobs; leaving them to their new owner")
+        rl_jobs = [job for job in rl_jobs if job["job_id"] in held]
+        if not rl_jobs:
+            return
+
+        logger.info(f"Applying {len(rl_jobs)} RL updates in one batch")
+        try:
+            results = await process_rl_updates(rl_jobs)
+        except Exception as e:
+            logger.exception("RL batch update failed")
+            for job in rl_jobs:
+                await asyncio.to_thread(mark_job_failed, job["job_id"], str(e), job.get("retry_count", 0))
+            return
+
+        # The update is applied: from here on the jobs are completed, whatever
+        # fails below. Failing them would requeue and apply them a second time.
+        for job in rl_jobs:
+            await asyncio.to_thread(mark_job_completed, job["job_id"], results[job["job_id"]])
+
+        # Right away: a reaped batch would be applied twice. A failed flush
+        # keeps the transitions buffered for the next one.
+        try:
+            await asyncio.to_thread(db.flush_jobs)
+        except Exception:
+            logger.exception("Flushing RL batch completions failed; retrying with the next flush")
 
-    for job in jobs:
-        job_id = job["job_id"]
-        job_type = job["job_type"]
-        retry_count = job.get("retry_count", 0)
+        # Write the buffered preference deltas now rather than at exit
+        try:
+            await asyncio.to_thread(db.flush_preferences)
+        except Exception:
+            logger.exception("Flushing preference deltas failed; retrying with the next flush")
 
+async def flush_jobs_periodically():
+    """
+    Write buffered transitions while a round is still running, so a job
+    that finished early is not left unfinished (and reaped once its lease
+    expires) behind a long content_generation job.
+    """
+    while True:
+        await asyncio.sleep(max(db.JOBS_FLUSH_SECONDS / 2, 0.1))
         try:
-            mark_job_running(job_id)
+            await asyncio.to_thread(db.job_store.flush_if_due)
+        except Exception:
+            logger.exception("Flushing job bookkeeping failed")
+
+async def run_jobs(jobs: List[Dict[str, Any]], limits: Dict[str, asyncio.Semaphore]):
+    """
+    Run one round of claimed jobs concurrently, bounded per job_type.
+    """
+    rl_jobs = [job for job in jobs if job["job_type"] == "rl_update"]
+    tasks = [
+        execute_job(job, limits.setdefault(job["job_type"], asyncio.Semaphore(1)))
+        for job in jobs
+        if job["job_type"] != "rl_update"
+    ]
+    if rl_jobs:
+        tasks.append(execute_rl_batch(rl_jobs, limits["rl_update"]))
+
+    flusher = asyncio.create_task(flush_jobs_periodically())
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        flusher.cancel()
+
+    # The round's follow-up jobs and transitions in (typically) two requests
+    await asyncio.to_thread(db.flush_jobs)
 
-            if job_type == "reward_calculation":
-                result = asyncio.run(process_reward_calculation(job))
+# ---------------- MAIN CRON ENTRY ----------------
+
+def start_loop() -> Dict[str, asyncio.Semaphore]:
+    """
+    Set up the running loop's thread pool; returns the per-job_type limits.
+    """
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=JOB_THREADS))
+    return {job_type: asyncio.Semaphore(limit) for job_type, limit in JOB_CONCURRENCY.items()}
+
+async def housekeeping():
+    try:
+        reaped = await asyncio.to_thread(reap_expired_leases)
+        if reaped:
+            logger.warning(f"Requeued {reaped} jobs with expired leases")
+    except Exception:
+        logger.exception("Reaping expired leases failed")
+
+    if EARLY_REWARDS:
+        try:
+            queued = await asyncio.to_thread(queue_provisional_updates)
+            if queued:
+                await asyncio.to_thread(db.flush_jobs)
+                logger.info(f"Queued {queued} provisional RL updates")
+        except Exception:
+            logger.exception("Provisional reward prediction failed")
+
+    try:
+        if await asyncio.to_thread(refresh_logit_tables):
+            logger.info("Rebuilt stale logit tables")
+    except Exception:
+        logger.exception("Logit table rebuild failed; selection falls back to the full path")
+
+def log_stats(processed: int):
+    logger.info(f"Processed {processed} jobs")
+    logger.info(f"Preference cache: {db.preference_cache.stats()}")
+    logger.info(f"Job store: {db.job_store.stats()}")
+    if rl_agent.theta_shards is not None:
+        logger.info(f"Theta shards: {rl_agent.theta_shards.stats()}")
+
+async def run_async():
+    limits = start_loop()
+    deadline = time.monotonic() + RUN_SECONDS
+
+    await housekeeping()
+
+    # Keep claiming rounds until the queue is empty or the run budget is spent,
+    # so a backlog drains in one run instead of CLAIM_BATCH jobs per cron tick
+    processed = 0
+    while True:
+        jobs = await asyncio.to_thread(claim_jobs)
+        if not jobs:
+            break
+
+        logger.info(f"Claimed {len(jobs)} jobs as {WORKER_ID}")
+        await run_jobs(jobs, limits)
+        processed += len(jobs)
+
+        if time.monotonic() >= deadline:
+            logger.info(f"Run budget of {RUN_SECONDS:.0f}s spent; leaving the rest for the next run")
+            break
+
+    if not processed:
+        logger.info("No due jobs found")
+        return
 
-            elif job_type == "rl_update":
-                result = asyncio.run(process_rl_update(job))
+    log_stats(processed)
 
-            elif job_type == "content_generation":
-                logger.info("Triggering main.py for content generation")
+def run_once():
+    asyncio.run(run_async())
 
-                proc = subprocess.run(
-                    [sys.executable, "main.py"],
-                    capture_output=True,
-                    text=True,
-                    encoding='utf-8',
-                    errors='replace'
-                )
+# ---------------- DAEMON ----------------
 
-                logger.info("main.py stdout:\n" + (proc.stdout or ""))
+def stop_event() -> asyncio.Event:
+    """
+    Event set by SIGTERM/SIGINT. Jobs already claimed still run to completion.
+    """
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
 
-                if proc.returncode != 0:
-                    raise RuntimeError(
-                        f"main.py failed:\n{proc.stderr}"
-                    )
+    def request_stop(*_):
+        if not stop.is_set():
+            logger.info("Shutdown requested; finishing in-flight jobs")
+        stop.set()
 
-                result = {"status": "completed"}
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, request_stop)
+        except NotImplementedError:
+            # Windows event loops have no add_signal_handler
+            signal.signal(sig, lambda *_: loop.call_soon_threadsafe(request_stop))
+    return stop
+
+async def sleep_until(stop: asyncio.Event, seconds: float):
+    try:
+        await asyncio.wait_for(stop.wait(), timeout=seconds)
+    except asyncio.TimeoutError:
+        pass
+
+async def daemon_async():
+    limits = start_loop()
+    stop = stop_event()
+
+    backoff = POLL_MIN_SECONDS
+    processed = 0
+    last_housekeeping = None
+
+    while not stop.is_set():
+        if last_housekeeping is None or time.monotonic() - last_housekeeping >= HOUSEKEEPING_SECONDS:
+            await housekeeping()
+            last_housekeeping = time.monotonic()
 
-            else:
-                raise ValueError(f"Unknown job type: {job_type}")
+        try:
+            jobs = await asyncio.to_thread(claim_jobs)
+        except Exception:
+            logger.exception("Claiming jobs failed")
+            jobs = []
+
+        if jobs:
+            # Busy: claim the next round right away
+            logger.info(f"Claimed {len(jobs)} jobs as {WORKER_ID}")
+            await run_jobs(jobs, limits)
+            processed += len(jobs)
+            backoff = POLL_MIN_SECONDS
+            continue
+
+        if processed:
+            log_stats(processed)
+            processed = 0
+
+        wait = backoff
+        backoff = min(backoff * 2, POLL_MAX_SECONDS)
+        try:
+            next_job = await asyncio.to_thread(seconds_until_next_job)
+            if next_job is not None:
+                wait = max(min(wait, next_job), POLL_MIN_SECONDS)
+        except Exception:
+            logger.exception("Looking up the next run_at failed")
 
+        await sleep_until(stop, wait)
 
-            mark_job_completed(job_id, result)
+    if processed:
+        log_stats(processed)
+    await asyncio.to_thread(db.flush_jobs)
+    await asyncio.to_thread(db.flush_preferences)
 
-        except Exception as e:
-            logger.exception(f"Job failed: {job_id}")
-            mark_job_failed(job_id, str(e), retry_count)
+def run_daemon():
+    asyncio.run(daemon_async())
 
 # ---------------- ENTRYPOINT ----------------
 
 if __name__ == "__main__":
-    logger.info("Cron job_queue started")
-    run_once()
-    logger.info("Cron job_queue finished")
+    parser = argparse.ArgumentParser(description="Process due jobs")
+    parser.add_argument("--daemon", action="store_true", help="Keep polling instead of exiting after one run")
+    args = parser.parse_args()
+
+    if args.daemon:
+        logger.info(f"job_queue daemon started as {WORKER_ID}")
+        run_daemon()
+        logger.info("job_queue daemon stopped")
+    else:
+        logger.info("Cron job_queue started")
+        run_once()
+        logger.info("Cron job_queue finished")
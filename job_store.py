@@ -0,0 +1,170 @@
+"""
+job_store.py
+------------
+Write-behind buffer for job bookkeeping.
+
+New jobs and job state transitions (completed / failed) are buffered
+instead of costing one PostgREST request each. A flush writes them in
+two requests: all new jobs as one upsert, then all transitions as one
+rl_finish_jobs call. It happens when the buffer is JOBS_FLUSH_SECONDS old
+or holds JOBS_MAX_PENDING entries, on flush(), and at interpreter exit.
+The age is only checked when something is added, so long-running callers
+also call flush_if_due() on a timer (job_queue does while a round runs):
+a completion must land before the job's lease runs out.
+
+Every write is idempotent, so a failed flush keeps its entries buffered
+and simply retries them with the next one:
+- job ids are deterministic (e.g. reward_<post_id>) and re-inserting an
+  existing id is a no-op;
+- transitions are keyed by job_id (the latest one wins) and only apply
+  while the worker still holds the job's lease.
+
+New jobs are written before transitions, so a job is never marked
+completed without the follow-up jobs it queued. One flush runs at a time,
+outside the buffer lock, so adding never waits for a round-trip.
+
+Like the preference cache, the store knows nothing about Supabase: db.py
+passes in the write functions.
+"""
+
+import time
+import threading
+
+
+class JobStore:
+
+    def __init__(self, insert, finish, flush_interval=5.0, max_pending=100, clock=time.monotonic):
+        """
+        insert([job rows]) inserts new jobs, skipping job_ids that already exist.
+        finish(worker, [{job_id, status, ...columns}]) applies one worker's transitions.
+        """
+        self._insert = insert
+        self._finish = finish
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._clock = clock
+        self._lock = threading.RLock()
+        self._jobs = {}          # job_id -> row
+        self._transitions = {}   # (worker, job_id) -> {job_id, status, ...}
+        self._pending_since = None
+        self._flush_lock = threading.Lock()   # one flush at a time, held without self._lock
+        self.metrics = {
+            "jobs_queued": 0,
+            "transitions_queued": 0,
+            "flushes": 0,
+            "requests": 0,
+            "flush_errors": 0,
+            "flush_seconds": 0.0
+        }
+
+    # ---------------- BUFFER ----------------
+
+    def add_job(self, row):
+        """
+        Buffer a new job row (must carry its job_id).
+        """
+        with self._lock:
+            self._jobs[row["job_id"]] = row
+            self.metrics["jobs_queued"] += 1
+            due = self._mark_pending()
+        if due:
+            self.flush(wait=False)
+
+    def transition(self, worker, job_id, fields):
+        """
+        Buffer a state change of a job held by worker; fields are the jobs
+        columns to set (status, result, ...).
+        """
+        with self._lock:
+            self._transitions[(worker, job_id)] = {"job_id": job_id, **fields}
+            self.metrics["transitions_queued"] += 1
+            due = self._mark_pending()
+        if due:
+            self.flush(wait=False)
+
+    def _mark_pending(self):
+        if self._pending_since is None:
+            self._pending_since = self._clock()
+        return self._due()
+
+    def _due(self):
+        return self._pending_since is not None and (
+            len(self._jobs) + len(self._transitions) >= self.max_pending
+            or self._clock() - self._pending_since >= self.flush_interval
+        )
+
+    def flush_if_due(self):
+        """
+        Flush if the buffer is old or full enough. Returns the number of entries written.
+        """
+        with self._lock:
+            due = self._due()
+        return self.flush(wait=False) if due else 0
+
+    # ---------------- FLUSH ----------------
+
+    def flush(self, wait=True):
+        """
+        Write every buffered job, then every buffered transition. The
+        buffer is swapped out under the lock and written without it;
+        whatever fails is merged back for the next flush. wait=False
+        returns at once if another flush is running. Returns the number
+        of entries written.
+        """
+        if not self._flush_lock.acquire(blocking=wait):
+            return 0
+        try:
+            return self._flush_pending()
+        finally:
+            self._flush_lock.release()
+
+    def _flush_pending(self):
+        with self._lock:
+            if not self._jobs and not self._transitions:
+                return 0
+            jobs, self._jobs = self._jobs, {}
+            transitions, self._transitions = self._transitions, {}
+            started = self._clock()
+            self._pending_since = None
+
+        written = requests = 0
+        try:
+            if jobs:
+                self._insert(list(jobs.values()))
+                requests += 1
+                written += len(jobs)
+                jobs = {}
+
+            by_worker = {}
+            for (worker, _), fields in transitions.items():
+                by_worker.setdefault(worker, []).append(fields)
+            for worker, rows in by_worker.items():
+                self._finish(worker, rows)
+                requests += 1
+                written += len(rows)
+                transitions = {k: v for k, v in transitions.items() if k[0] != worker}
+
+        except Exception as e:
+            print(f"Error flushing {len(jobs)} jobs / {len(transitions)} job transitions, keeping them buffered: {e}")
+            with self._lock:
+                self.metrics["requests"] += requests
+                self.metrics["flush_errors"] += 1
+                # Entries buffered during the flush are newer and win
+                self._jobs = {**jobs, **self._jobs}
+                self._transitions = {**transitions, **self._transitions}
+                self._pending_since = started if self._pending_since is None else min(self._pending_since, started)
+            return written
+
+        with self._lock:
+            self.metrics["requests"] += requests
+            self.metrics["flushes"] += 1
+            self.metrics["flush_seconds"] += self._clock() - started
+        return written
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self.metrics,
+                "pending_jobs": len(self._jobs),
+                "pending_transitions": len(self._transitions)
+            }
@@ -0,0 +1,194 @@
+"""
+logit_tables.py
+---------------
+Precomputed per-business action logits for O(1) selection.
+
+For a context x = [business; topic] the logits of every dimension are
+
+    prefs(platform, time_bucket) + theta @ P(x)
+  = [prefs + theta @ P([business; 0])] + topic @ (P_topic @ theta^T)
+
+where P is the context projection (identity when disabled) and P_topic
+its topic half. The bracket only depends on (business, platform,
+time_bucket) and is stored as one row per key; the topic weights
+(topic_dim x num_values) are shared by every key. Selection is then a row
+lookup plus one small topic product, and needs no rl_preferences fetch.
+
+A table is only used while it matches the theta version and projection it
+was built from and the rl_preferences version (latest updated_at) of the
+(platform, time_bucket); otherwise selection falls back to the full path.
+
+Rebuild nightly, ahead of the 10:10 IST generation run:
+    python logit_tables.py
+RL updates during the day make the table stale; job_queue rebuilds it
+before content generation when it no longer matches theta, at most once
+per RL_LOGIT_TABLES_REBUILD_SECONDS.
+"""
+
+import os
+import json
+import tempfile
+import numpy as np
+
+
+class LogitTables:
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = None
+        self.keys = {}
+        self.base = None
+        self.topic_weights = None
+        self._mtime = None
+
+    @staticmethod
+    def key(business_id, platform, time_bucket):
+        return f"{business_id}|{platform}|{time_bucket}"
+
+    def load(self):
+        """
+        (Re)load the table when the file changed on disk. False if there is none.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            self.meta = None
+            return False
+
+        if mtime != self._mtime:
+            with np.load(self.path) as data:
+                self.meta = json.loads(str(data["meta"]))
+                self.keys = {k: i for i, k in enumerate(data["keys"].tolist())}
+                self.base = data["base"]
+                self.topic_weights = data["topic_weights"]
+            self._mtime = mtime
+        return True
+
+    def matches(self, theta_version, projection, action_space):
+        """
+        True if the table was built from this theta and action space.
+        """
+        if self.meta is None:
+            return False
+        return (
+            self.meta["theta_version"] == theta_version
+            and self.meta["projection"] == projection
+            and {dim: values for dim, (_, values) in self.meta["dimensions"].items()} == action_space
+        )
+
+    def prefs_version(self, platform, time_bucket):
+        return self.meta["prefs_versions"].get(f"{platform}|{time_bucket}")
+
+    def row(self, business_id, platform, time_bucket):
+        return self.keys.get(self.key(business_id, platform, time_bucket), -1)
+
+    def columns(self, dim):
+        offset, values = self.meta["dimensions"][dim]
+        return slice(offset, offset + len(values))
+
+
+def write_tables(path, keys, base, topic_weights, meta):
+    """
+    Atomically write a table (temp file + rename) so selection never reads a partial file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".logits_", suffix=".npz", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(
+                f,
+                keys=np.array(keys, dtype=str),
+                base=np.asarray(base, dtype=np.float32),
+                topic_weights=np.asarray(topic_weights, dtype=np.float32),
+                meta=np.array(json.dumps(meta))
+            )
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def build_tables(path, business_ids=None):
+    """
+    Materialize base logits for every (business, platform, time_bucket) that
+    main.py would post for, from the current theta and rl_preferences.
+    """
+    import db
+    import rl_agent
+
+    theta = rl_agent.theta
+    business_ids = db.get_all_profile_ids() if business_ids is None else list(business_ids)
+    embeddings = db.get_profile_embeddings(business_ids)
+
+    segments = {}
+    if rl_agent.segment_model is not None:
+        db.get_business_segments(business_ids)   # one batched fetch, cached for context_segment
+        segments = {
+            business_id: rl_agent.context_segment({"business_id": business_id, "business_embedding": embedding})
+            for business_id, embedding in embeddings.items()
+        }
+
+    entries = []   # (key, business_embedding, platform, time_bucket, segment)
+    for business_id in business_ids:
+        if business_id not in embeddings:
+            continue
+        time_bucket = db.get_profile_scheduling_prefs(business_id)["time_bucket"]
+        for platform in sorted(set(db.get_connected_platforms(business_id))):
+            entries.append((
+                LogitTables.key(business_id, platform, time_bucket), embeddings[business_id],
+                platform, time_bucket, segments.get(business_id)
+            ))
+
+    prefs, prefs_versions = {}, {}
+    for _, _, platform, time_bucket, segment in entries:
+        if f"{platform}|{time_bucket}" not in prefs_versions:
+            # version first: a write landing in between only makes the table look stale
+            prefs_versions[f"{platform}|{time_bucket}"] = db.get_preferences_version(platform, time_bucket)
+        if (platform, time_bucket, segment) not in prefs:
+            prefs[(platform, time_bucket, segment)] = db.get_preferences_batch(platform, time_bucket, segment)
+
+    dimensions, offset = {}, 0
+    for dim, values in rl_agent.ACTION_SPACE.items():
+        dimensions[dim] = [offset, list(values)]
+        offset += len(values)
+
+    base = np.zeros((len(entries), offset), dtype=np.float32)
+    topic_weights = np.zeros((rl_agent.TOPIC_DIM, offset), dtype=np.float32)
+    topic_basis = rl_agent.topic_basis()
+
+    if entries:
+        business_mat = rl_agent.business_policy_vectors(np.stack([e[1] for e in entries]))
+    # theta is shared with in-process selection and RL updates (job_queue)
+    with rl_agent.policy_lock:
+        theta.load()
+        theta_version = theta.version
+        for dim in rl_agent.ACTION_SPACE:
+            cols = slice(dimensions[dim][0], dimensions[dim][0] + len(rl_agent.ACTION_SPACE[dim]))
+            topic_weights[:, cols] = theta.scores(dim, topic_basis)
+            if entries:
+                pref_rows = np.stack([
+                    rl_agent.preference_vector(prefs[(platform, time_bucket, segment)], dim)
+                    for _, _, platform, time_bucket, segment in entries
+                ])
+                base[:, cols] = pref_rows + theta.scores(dim, business_mat)
+
+    write_tables(path, [e[0] for e in entries], base, topic_weights, {
+        "theta_version": theta_version,
+        "projection": rl_agent.PROJECTION_ID,
+        "dimensions": dimensions,
+        "prefs_versions": prefs_versions
+    })
+    print(f"Built logit tables for {len(entries)} (business, platform, time_bucket) keys at theta v{theta_version} -> {path}")
+    return len(entries)
+
+
+if __name__ == "__main__":
+    import argparse
+    import rl_agent
+
+    parser = argparse.ArgumentParser(description="Precompute per-business action logits")
+    parser.add_argument("--out", default=rl_agent.LOGIT_TABLES_PATH or "rl_logits.npz")
+    args = parser.parse_args()
+
+    build_tables(args.out)
@@ -0,0 +1,221 @@
+"""
+lowrank_policy.py
+-----------------
+Low-rank factorized alternative to the per-value theta rows.
+
+Instead of one embedding_dim-wide row per (dimension, value), the policy
+keeps one shared context map W (embedding_dim x rank) and a rank-wide
+embedding per action value:
+
+    score(dim, value | ctx) = (ctx @ W) . E[dim][value]
+
+z = ctx @ W is a (n x rank) product, cheap next to the per-value scores.
+Parameters drop from values x embedding_dim to
+embedding_dim x rank + values x rank.
+
+Updates follow the same REINFORCE-style rule as theta: for the chosen
+value, E[value] += lr * adv * z and W += lr * adv * outer(ctx, E[value]).
+Values that are new to the action space start at the mean embedding of
+their dimension instead of from scratch.
+
+Exposes the subset of the ThetaStore interface rl_agent uses (load,
+scores, scatter_add, save, version, meta), selected with
+RL_POLICY_MODEL=lowrank. Saved as an .npz; save() merges local deltas
+into the latest file under the same lock-and-rename scheme as theta_store.
+"""
+
+import os
+import json
+import tempfile
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locking, last writer wins
+    fcntl = None
+
+
+class LowRankPolicy:
+
+    def __init__(self, path, action_space, embedding_dim, rank=64, projection=None, seed=0):
+        self.path = path
+        self.action_space = action_space
+        self.embedding_dim = embedding_dim
+        self.rank = rank
+        self.projection = projection
+        self.seed = seed
+        self.version = 0
+        self.meta = {}
+        self.W = None
+        self.E = None          # dim -> (num_values x rank), aligned with action_space[dim]
+        self._W0 = None        # parameters as loaded, for merging deltas on save
+        self._E0 = None
+        self._stamp = None     # (inode, mtime) of the file the parameters were read from
+
+    # ---------------- LOADING ----------------
+
+    def _initial_W(self):
+        # Deterministic so every process starts from the same W before the first save
+        rng = np.random.default_rng(self.seed)
+        return (rng.standard_normal((self.embedding_dim, self.rank)) / np.sqrt(self.embedding_dim)).astype(np.float32)
+
+    def _read(self):
+        """
+        (version, meta, W, {dim: E aligned with action_space}) from disk,
+        or the initial parameters if there is no file yet.
+        """
+        if not os.path.exists(self.path):
+            return 0, {}, self._initial_W(), {
+                dim: np.zeros((len(values), self.rank), dtype=np.float32)
+                for dim, values in self.action_space.items()
+            }
+
+        with np.load(self.path) as data:
+            header = json.loads(str(data["header"]))
+            if (header["embedding_dim"], header["rank"]) != (self.embedding_dim, self.rank):
+                raise ValueError(
+                    f"Low-rank policy {self.path} is {header['embedding_dim']}x{header['rank']}, "
+                    f"expected {self.embedding_dim}x{self.rank}"
+                )
+            if header.get("projection") != self.projection:
+                raise ValueError(
+                    f"Low-rank policy {self.path} was trained with projection {header.get('projection')!r}, "
+                    f"configured projection is {self.projection!r}"
+                )
+
+            E = {}
+            for dim, values in self.action_space.items():
+                stored_values = header["values"].get(dim, [])
+                stored = data[f"E_{dim}"] if stored_values else np.zeros((0, self.rank), dtype=np.float32)
+                E[dim] = self._align(stored_values, stored, values)
+            return header["version"], header.get("meta") or {}, np.array(data["W"]), E
+
+    def _align(self, stored_values, stored, values):
+        """
+        Rows for values in order; values without a stored row warm-start
+        from the mean of the stored rows of the dimension.
+        """
+        position = {v: i for i, v in enumerate(stored_values)}
+        warm = stored.mean(axis=0) if len(stored) else np.zeros(self.rank, dtype=np.float32)
+        return np.stack([
+            stored[position[v]] if v in position else warm for v in values
+        ]).astype(np.float32) if values else np.zeros((0, self.rank), dtype=np.float32)
+
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def load(self):
+        """
+        Read the parameters, or re-read them if another process saved since.
+        Callers check once per batch; scores() and updates only load on
+        first use. Unsaved updates pin the loaded parameters until save().
+        """
+        stamp = self._file_stamp()
+        if self.W is not None and (stamp == self._stamp or self.dirty):
+            return
+
+        self._stamp = stamp
+        self.version, self.meta, self.W, self.E = self._read()
+        self._W0 = self.W.copy()
+        self._E0 = {dim: E.copy() for dim, E in self.E.items()}
+        if self.version:
+            print(f"Loaded low-rank policy v{self.version} from {self.path} (rank {self.rank})")
+
+    # ---------------- ACCESS ----------------
+
+    def _ensure_loaded(self):
+        if self.W is None:
+            self.load()
+
+    def scores(self, dim, ctx_mat):
+        """
+        (n x num_values) scores for a (n x embedding_dim) context matrix.
+        z is computed per call, not cached on the instance, so concurrent
+        callers never score with each other's contexts.
+        """
+        self._ensure_loaded()
+        z = np.asarray(ctx_mat, dtype=np.float32) @ self.W
+        return z @ self.E[dim].T
+
+    def scatter_add(self, dim, rows, coefs, ctx_mat):
+        """
+        REINFORCE step for chosen rows[i] with weight coefs[i] on context ctx_mat[i]
+        (rows may repeat). Both factors are updated from their pre-step values.
+        """
+        self._ensure_loaded()
+        ctx_mat = np.asarray(ctx_mat, dtype=np.float32)
+        coefs = np.asarray(coefs, dtype=np.float32)[:, None]
+        z = ctx_mat @ self.W
+
+        grad_W = ctx_mat.T @ (coefs * self.E[dim][rows])
+        np.add.at(self.E[dim], rows, coefs * z)
+        self.W += grad_W
+
+    @property
+    def dirty(self):
+        return self.W is not None and (
+            not np.array_equal(self.W, self._W0)
+            or any(not np.array_equal(self.E[dim], self._E0[dim]) for dim in self.E)
+        )
+
+    def resident_rows(self):
+        self._ensure_loaded()
+        return self.embedding_dim + sum(len(E) for E in self.E.values())
+
+    def resident_bytes(self):
+        self._ensure_loaded()
+        return self.W.nbytes + sum(E.nbytes for E in self.E.values())
+
+    # ---------------- PERSISTENCE ----------------
+
+    def _write(self, version, W, E):
+        header = {
+            "version": version,
+            "embedding_dim": self.embedding_dim,
+            "rank": self.rank,
+            "projection": self.projection,
+            "values": {dim: list(values) for dim, values in self.action_space.items()},
+            "meta": self.meta
+        }
+        arrays = {f"E_{dim}": E[dim] for dim in self.action_space}
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".lowrank_", suffix=".npz", dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, header=np.array(json.dumps(header)), W=W, **arrays)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def save(self, force=False):
+        """
+        Add local deltas to the latest file on disk and atomically replace it.
+        """
+        if not self.dirty and not force:
+            return
+
+        with open(self.path + ".lock", "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                version, _, W, E = self._read()
+                W = W + (self.W - self._W0)
+                E = {dim: E[dim] + (self.E[dim] - self._E0[dim]) for dim in self.action_space}
+                version += 1
+                self._write(version, W, E)
+                stamp = self._file_stamp()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+        self.version, self.W, self.E, self._stamp = version, W, E, stamp
+        self._W0 = W.copy()
+        self._E0 = {dim: e.copy() for dim, e in E.items()}
+        print(f"Saved low-rank policy v{self.version} to {self.path} ({self.resident_bytes()} bytes)")
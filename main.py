@@ -19,10 +19,6 @@ import os
 import sys
 import io
 
-# Force UTF-8 encoding for stdout/stderr to handle emojis on Windows
-sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
-sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
-
 load_dotenv()
 
 # from db import fetch_or_calculate_reward
@@ -40,7 +36,8 @@ IST = pytz.timezone("Asia/Kolkata")
 
 import db
 # from rl_agent import update_rl
-from generate import generate_prompts,embed_topic,generate_topic,generate_reel_script,generate_post_script,generate_carousel_script
+from rl_agent import PROJECTION_ID, theta_shards, select_actions_batch
+from generate import generate_prompts,build_context,embed_topic,generate_topic,generate_reel_script,generate_post_script,generate_carousel_script
 #from job_queue import queue_reward_calculation_job
 from content_generation import generate_content, generate_carousel_content
 from prompt_template import CAROUSEL_IMAGE_PROMPT_GENERATOR
@@ -52,14 +49,18 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("main")
 
-logger.info(" main.py ENTRYPOINT reached")
 from datetime import datetime, timedelta
 import pytz
 import db
 
 IST = pytz.timezone("Asia/Kolkata")
 
-def schedule_next_content_generation(business_id):
+ALLOWED_PLATFORMS = {"instagram","facebook"}
+
+# Contexts per select_actions_batch call when generating for many businesses
+SELECTION_BATCH_SIZE = int(os.getenv("RL_SELECTION_BATCH_SIZE", "256"))
+
+def schedule_next_content_generation(business_id, platform):
     # Fetch preferred posting time
     prefs = db.get_profile_scheduling_prefs(business_id)
 
@@ -75,35 +76,27 @@ def schedule_next_content_generation(business_id):
         microsecond=0
     )
 
-    job_id = f"content_gen_{business_id}_{run_at.date()}"
+    # One job per (business, platform) so each is retried and run on its own
+    job_id = f"content_gen_{business_id}_{platform}_{run_at.date()}"
 
-    # Idempotency: avoid duplicates
-    existing = (
-        db.supabase
-        .table("jobs")
-        .select("job_id")
-        .eq("job_id", job_id)
-        .execute()
+    # Idempotency: an already scheduled job_id is left as is
+    db.queue_job(
+        job_id,
+        "content_generation",
+        {"business_id": business_id, "platform": platform},
+        run_at=run_at
     )
 
-    if existing.data:
-        return  # already scheduled
-
-    db.supabase.table("jobs").insert({
-        "job_id": job_id,
-        "job_type": "content_generation",
-        "payload": {"business_id": business_id},
-        "status": "queued",
-        "run_at": run_at.isoformat(),
-        "retry_count": 0,
-        "created_at": datetime.now(IST).isoformat()
-    }).execute()
-
 
 # MAIN LOOP
 # -------------------------------------------------
 
-def run_one_post(BUSINESS_ID, platform, time_bucket=None):
+def prepare_post(BUSINESS_ID, platform, time_bucket=None):
+    """
+    Everything a post needs before the RL decision: topic, embeddings and
+    the RL context. generate_for_businesses prepares every post first so
+    batched select_actions_batch calls decide them all.
+    """
     # Get user's scheduling preferences if not provided
     if time_bucket is None:
         scheduling_prefs = db.get_profile_scheduling_prefs(BUSINESS_ID)
@@ -145,14 +138,44 @@ def run_one_post(BUSINESS_ID, platform, time_bucket=None):
         "BUSINESS_DESCRIPTION": profile_data["business_description"],
     }
 
+    # post_id seeds the RL sampler, so it is fixed before selection
+    post_id = f"{platform}_{uuid.uuid4().hex[:8]}"
+
+    return {
+        "platform": platform,
+        "time_bucket": time_bucket,
+        "post_id": post_id,
+        "inputs": inputs,
+        "profile_data": profile_data,
+        "topic_text": topic_text,
+        "business_embedding": business_embedding,
+        "topic_embedding": topic_embedding,
+        "context": build_context(business_embedding, topic_embedding, platform, time_bucket, BUSINESS_ID)
+    }
+
+
+def finish_post(BUSINESS_ID, post, selection=None):
+    """
+    Generate, store and queue a prepared post. selection is its
+    (action, ctx_vec, propensity) if already chosen by select_actions_batch;
+    otherwise generate_prompts selects it.
+    """
+    platform = post["platform"]
+    post_id = post["post_id"]
+    profile_data = post["profile_data"]
+    topic_text = post["topic_text"]
+
     result = generate_prompts(
-        inputs,
-        business_embedding,
-        topic_embedding,
+        post["inputs"],
+        post["business_embedding"],
+        post["topic_embedding"],
         platform,
-        time_bucket,
+        post["time_bucket"],
         topic_text,profile_data,
         business_context=profile_data,
+        business_id=BUSINESS_ID,
+        post_id=post_id,
+        selection=selection,
     )
 
     # Extract values based on mode
@@ -163,13 +186,16 @@ def run_one_post(BUSINESS_ID, platform, time_bucket=None):
     prompt_text = result.get("grok_prompt") or result.get("prompt", "") or result.get("image_prompt", "")
 
     # ---------- 3. STORE RL ACTION ----------
-    post_id = f"{platform}_{uuid.uuid4().hex[:8]}"
-
     action_id = db.insert_action(
         post_id=post_id,
         platform=platform,
         context=context,
-        action=action
+        action=action,
+        topic=topic_text,
+        business_id=BUSINESS_ID,
+        ctx_vec=ctx_vec,
+        context_projection=PROJECTION_ID,
+        propensity=result.get("propensity")
     )
 
     # ---------- 4. CHECK CONTENT TYPE AND BRANCH ----------
@@ -393,82 +419,182 @@ def run_one_post(BUSINESS_ID, platform, time_bucket=None):
 
     # ---------- 6. QUEUE REWARD CALCULATION FOR WORKER ----------
     # Queue reward calculation job (will automatically trigger RL update when ready)
-    reward_job_id = f"reward_{post_id}_{int(time.time())}"
-
-    db.supabase.table("jobs").insert({
-        "job_id": reward_job_id,
-        "job_type": "reward_calculation",
-        "payload": {
-            "profile_id": BUSINESS_ID,
-            "post_id": post_id,
-            "platform": platform
-        },
-        "status": "queued",
-        "run_at": datetime.now(IST).isoformat(),
-        "retry_count": 0,
-        "created_at": datetime.now(IST).isoformat()
-    }).execute()
+    reward_job_id = f"reward_{post_id}"
+
+    db.queue_job(reward_job_id, "reward_calculation", {
+        "profile_id": BUSINESS_ID,
+        "post_id": post_id,
+        "platform": platform
+    })
 
     print(f" Reward calculation job queued: {reward_job_id}")
 
 
 # -------------------------------------------------
-# ENTRY POINT
+# PER-BUSINESS GENERATION
 # -------------------------------------------------
-ALLOWED_PLATFORMS = {"instagram","facebook"}
 
-if __name__ == "__main__":
-    try:
-        all_business_ids =db.get_all_profile_ids()
-        print(f"Found {len(all_business_ids)} business profiles to check")
+def prepare_business(business_id, platforms=None):
+    """
+    Prepare today's posts of one business on each of the given platforms
+    (default: every connected, supported one).
+
+    Returns (result, scheduled platforms, {platform: prepared post}).
+    """
+    connected = {p.lower().strip() for p in db.get_connected_platforms(business_id)}
+    if platforms is None:
+        platforms = sorted(connected)
+    print(f"Business {business_id} platforms: {platforms}")
+
+    result = {"created": [], "skipped": {}, "failed": {}}
+    scheduled = []
+    posts = {}
+    for platform in platforms:
+        platform = platform.lower().strip()
+
+        if platform not in ALLOWED_PLATFORMS:
+            print(f"Skipping unsupported platform: {platform}")
+            result["skipped"][platform] = "unsupported"
+            continue
+        if platform not in connected:
+            # Disconnected since the job was scheduled; ends its daily chain
+            print(f"Skipping disconnected platform: {platform}")
+            result["skipped"][platform] = "not connected"
+            continue
+        scheduled.append(platform)
 
-        for business_id in all_business_ids:
-            try:
-                print(f"\nProcessing business: {business_id}")
+        try:
+            # Check daily eligibility
+            if not db.should_create_post_today(business_id, platform):
+                print(f"Skipping {business_id} on {platform} - not scheduled for today")
+                result["skipped"][platform] = "not scheduled for today"
+            else:
+                print(f"Creating post for {business_id} on {platform}")
+                posts[platform] = prepare_post(business_id, platform)
 
-                # Check daily eligibility
-                if not db.should_create_post_today(business_id):
-                    print(f"Skipping business {business_id} - not scheduled for today")
-                    continue
+        except Exception as e:
+            print(f"Platform failed {platform}: {e}")
+            result["failed"][platform] = str(e)
 
-                user_connected_platforms = list(set(db.get_connected_platforms(business_id)))
-                print(f"Business {business_id} platforms: {user_connected_platforms}")
+    return result, scheduled, posts
 
-                any_platform_succeeded = False
 
-                for platform in user_connected_platforms:
-                    try:
-                        platform = platform.lower().strip()
+def select_for_posts(posts):
+    """
+    RL selections for prepared posts, SELECTION_BATCH_SIZE contexts per
+    select_actions_batch call. A chunk whose batch call fails gets None
+    selections, so generate_prompts selects those posts one by one.
+    """
+    selections = []
+    for start in range(0, len(posts), SELECTION_BATCH_SIZE):
+        chunk = posts[start:start + SELECTION_BATCH_SIZE]
+        try:
+            selections.extend(select_actions_batch(
+                [post["context"] for post in chunk],
+                [post["post_id"] for post in chunk]
+            ))
+        except Exception as e:
+            print(f"Batch action selection failed, selecting per post: {e}")
+            selections.extend([None] * len(chunk))
+    return selections
 
-                        if platform not in ALLOWED_PLATFORMS:
-                            print(f"Skipping unsupported platform: {platform}")
-                            continue
 
-                        print(f"Creating post for {business_id} on {platform}")
+def finish_business(business_id, result, scheduled, posts, selections):
+    """
+    Generate and store the prepared posts of one business and schedule
+    tomorrow's content_generation job per platform.
+    """
+    for platform, post in posts.items():
+        try:
+            finish_post(business_id, post, selections.get(platform))
+            result["created"].append(platform)
+            print(f"Post created for {platform}")
 
-                        run_one_post(
-                            BUSINESS_ID=business_id,
-                            platform=platform,
-                        )
+        except Exception as e:
+            print(f"Platform failed {platform}: {e}")
+            result["failed"][platform] = str(e)
 
-                        any_platform_succeeded = True
-                        print(f"Post created for {platform}")
+    for platform in scheduled:
+        schedule_next_content_generation(business_id, platform)
+        print(f"Next content_generation scheduled for {business_id} on {platform}")
 
-                    except Exception as e:
-                        print(f"Platform failed {platform}: {e}")
-                        continue
+    return result
 
-                # ✅ THIS IS THE CORRECT PLACE
-                
-        
-                schedule_next_content_generation(business_id)
-                print(f"Next content_generation scheduled for {business_id}")
 
-            except Exception as e:
-                print(f"Business failed {business_id}: {e}")
-                continue
+def generate_for_businesses(business_platforms):
+    """
+    Create today's posts for many businesses: every post is prepared first,
+    RL then decides all of them in batched select_actions_batch calls, and
+    each business is finished in turn.
+
+    business_platforms: {business_id: platforms or None for every connected one}
+    Returns {business_id: result} (see generate_for_business); a business
+    that fails as a whole is printed and left out.
+    """
+    prepared = {}
+    results = {}
+    for business_id, platforms in business_platforms.items():
+        try:
+            print(f"\nProcessing business: {business_id}")
+            prepared[business_id] = prepare_business(business_id, platforms)
+        except Exception as e:
+            print(f"Business failed {business_id}: {e}")
+
+    # RL decides every business's creative controls in batched passes
+    keys = [(b, platform) for b, (_, _, posts) in prepared.items() for platform in posts]
+    chosen = select_for_posts([prepared[b][2][platform] for b, platform in keys])
+    selections = {}
+    for (business_id, platform), selection in zip(keys, chosen):
+        selections.setdefault(business_id, {})[platform] = selection
+
+    for business_id, (result, scheduled, posts) in prepared.items():
+        try:
+            results[business_id] = finish_business(
+                business_id, result, scheduled, posts, selections.get(business_id, {})
+            )
+        except Exception as e:
+            print(f"Business failed {business_id}: {e}")
+
+    return results
+
+
+def generate_for_business(business_id, platforms=None):
+    """
+    Create today's post for one business on each of the given platforms
+    (default: every connected, supported one) and schedule tomorrow's
+    content_generation job per platform. Safe to import: job_queue calls
+    this in-process for each job.
+
+    Returns {"created": [platforms], "skipped": {platform: reason}, "failed": {platform: error}}.
+    """
+    result, scheduled, posts = prepare_business(business_id, platforms)
+    selections = dict(zip(posts, select_for_posts(list(posts.values()))))
+    return finish_business(business_id, result, scheduled, posts, selections)
+
+
+# -------------------------------------------------
+# ENTRY POINT
+# -------------------------------------------------
+
+if __name__ == "__main__":
+    # Force UTF-8 encoding for stdout/stderr to handle emojis on Windows
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+
+    logger.info(" main.py ENTRYPOINT reached")
+
+    try:
+        all_business_ids =db.get_all_profile_ids()
+        print(f"Found {len(all_business_ids)} business profiles to check")
+
+        generate_for_businesses({business_id: None for business_id in all_business_ids})
 
         print("Daily post creation process completed")
+        db.flush_jobs()
+        print(f"Preference cache: {db.preference_cache.stats()}")
+        print(f"Job store: {db.job_store.stats()}")
+        if theta_shards is not None:
+            print(f"Theta shards: {theta_shards.stats()}")
 
     except Exception as e:
         print(f"Critical error in main process: {e}")
@@ -0,0 +1,266 @@
+"""
+off_policy_eval.py
+------------------
+Offline evaluation of a candidate policy on logged decisions.
+
+Streams rewarded rl_actions (with the propensities logged by the sampler)
+page by page and estimates the reward the candidate theta + preferences
+would have earned, without shipping it:
+
+  IPS    mean(w * r)
+  SNIPS  sum(w * r) / sum(w)
+  DR     mean(q(x, pi) + w * (r - q(x, a)))
+
+with w = pi(a|x) / mu(a|x) the importance weight of the logged value
+(optionally clipped) and q a per-(dimension, value) mean-reward model fit
+in a first streaming pass. Every dimension is reported on its own (the
+candidate choosing that dimension, logging policy for the rest), plus
+ALL for the joint action (w = product over dimensions, q = mean of the
+per-dimension q, so it stays on the reward scale).
+
+Memory is bounded by the page size: only running sums are kept.
+
+Usage:
+    python off_policy_eval.py --theta replay_theta.bin [--prefs checkpoint] [--clip 20]
+"""
+
+import json
+import time
+import argparse
+import numpy as np
+
+import db
+import rl_agent
+from theta_store import ThetaStore
+from replay_trainer import EmbeddingCache, stream_reward_pages, build_samples
+
+DIMENSIONS = list(rl_agent.ACTION_SPACE)
+
+REWARD_MODEL_SELECT = (
+    "id, created_at, reward_value, rl_actions("
+    + ", ".join(dim.lower() for dim in DIMENSIONS)
+    + ")"
+)
+
+
+# ---------------- CANDIDATE POLICY ----------------
+
+class CandidatePolicy:
+    """
+    Action probabilities of a theta checkpoint plus preferences, either the
+    production rl_preferences or the ones a replay_trainer checkpoint carries.
+    """
+
+    def __init__(self, theta_path, prefs_source="production"):
+        self.theta = ThetaStore(
+            theta_path, rl_agent.ACTION_SPACE, rl_agent.EMBEDDING_DIM, projection=rl_agent.PROJECTION_ID
+        )
+        self.theta.load()
+        self._prefs = {}
+
+        if prefs_source == "checkpoint":
+            for key, score in self.theta.meta.get("preferences", {}).items():
+                platform, time_bucket, dim, value = key.split("|", 3)
+                self._prefs.setdefault((platform, time_bucket), {})[(dim, value)] = score
+
+        self.prefs_source = prefs_source
+
+    def prefs(self, platform, time_bucket):
+        key = (platform, str(time_bucket))
+        if key not in self._prefs:
+            self._prefs[key] = db.get_preferences_batch(platform, time_bucket) if self.prefs_source == "production" else {}
+        return self._prefs[key]
+
+    def probabilities(self, samples, ctx_mat):
+        """
+        {dim: (n x num_values)} candidate action probabilities
+        """
+        keys = [(s["context"]["platform"], s["context"]["time_bucket"]) for s in samples]
+        probs = {}
+        for dim in DIMENSIONS:
+            prefs = np.stack([rl_agent.preference_vector(self.prefs(*k), dim) for k in keys])
+            probs[dim] = rl_agent.softmax(prefs + self.theta.scores(dim, ctx_mat))
+        return probs
+
+
+# ---------------- REWARD MODEL ----------------
+
+def fit_reward_model(page_size, limit=None):
+    """
+    First pass: mean reward per (dimension, value), falling back to the
+    global mean for values never logged. Returns ({dim: (num_values,)}, rows).
+    """
+    sums = {dim: np.zeros(len(v)) for dim, v in rl_agent.ACTION_SPACE.items()}
+    counts = {dim: np.zeros(len(v)) for dim, v in rl_agent.ACTION_SPACE.items()}
+    total, n = 0.0, 0
+
+    for rows in stream_reward_pages(None, page_size, select=REWARD_MODEL_SELECT):
+        rows = [r for r in rows if r.get("rl_actions") and r.get("reward_value") is not None]
+        rewards = np.array([float(r["reward_value"]) for r in rows])
+        total += rewards.sum()
+        n += len(rows)
+
+        for dim in DIMENSIONS:
+            idx = np.array(
+                [rl_agent.ACTION_INDEX[dim].get(r["rl_actions"].get(dim.lower()), -1) for r in rows],
+                dtype=np.intp
+            )
+            known = idx >= 0
+            np.add.at(sums[dim], idx[known], rewards[known])
+            np.add.at(counts[dim], idx[known], 1)
+
+        if limit and n >= limit:
+            break
+
+    mean = total / n if n else 0.0
+    model = {
+        dim: np.where(counts[dim] > 0, sums[dim] / np.maximum(counts[dim], 1), mean)
+        for dim in DIMENSIONS
+    }
+    return model, n
+
+
+# ---------------- ESTIMATORS ----------------
+
+class Estimate:
+    """
+    Running sums for one estimate (a dimension or the joint action).
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.sum_r = 0.0
+        self.sum_w = 0.0
+        self.sum_wr = 0.0
+        self.sum_w2 = 0.0
+        self.sum_dr = 0.0
+        self.max_w = 0.0
+
+    def add(self, w, r, q_logged, q_policy):
+        self.n += len(w)
+        self.sum_r += float(r.sum())
+        self.sum_w += float(w.sum())
+        self.sum_wr += float((w * r).sum())
+        self.sum_w2 += float((w * w).sum())
+        self.sum_dr += float((q_policy + w * (r - q_logged)).sum())
+        self.max_w = max(self.max_w, float(w.max())) if len(w) else self.max_w
+
+    def report(self):
+        if not self.n:
+            return {"n": 0}
+        return {
+            "n": self.n,
+            "logged": self.sum_r / self.n,
+            "ips": self.sum_wr / self.n,
+            "snips": self.sum_wr / self.sum_w if self.sum_w else None,
+            "dr": self.sum_dr / self.n,
+            "ess": self.sum_w ** 2 / self.sum_w2 if self.sum_w2 else 0.0,
+            "max_w": self.max_w
+        }
+
+
+def accumulate(estimates, samples, probs, reward_model, clip=None):
+    """
+    Add one batch to the per-dimension and joint estimates. The joint q
+    is the mean over dimensions of the per-dimension q.
+    """
+    n = len(samples)
+    rewards = np.array([s["reward"] for s in samples])
+    ratios = np.full((n, len(DIMENSIONS)), np.nan)
+    q_logged = np.zeros((n, len(DIMENSIONS)))
+    q_policy = np.zeros((n, len(DIMENSIONS)))
+
+    for d, dim in enumerate(DIMENSIONS):
+        idx = np.array(
+            [rl_agent.ACTION_INDEX[dim].get(s["action"].get(dim), -1) for s in samples],
+            dtype=np.intp
+        )
+        mu = np.array([(s.get("propensity") or {}).get(dim) or 0.0 for s in samples], dtype=np.float64)
+        ok = (idx >= 0) & (mu > 0)
+
+        pi = probs[dim]
+        q_logged[:, d] = reward_model[dim][np.maximum(idx, 0)]
+        q_policy[:, d] = pi @ reward_model[dim]
+        w = pi[np.arange(n), np.maximum(idx, 0)] / np.where(ok, mu, 1.0)
+        if clip:
+            w = np.minimum(w, clip)
+        ratios[ok, d] = w[ok]
+
+        estimates[dim].add(w[ok], rewards[ok], q_logged[ok, d], q_policy[ok, d])
+
+    joint = ~np.isnan(ratios).any(axis=1)
+    w = np.prod(ratios[joint], axis=1)
+    if clip:
+        w = np.minimum(w, clip)
+    estimates["ALL"].add(w, rewards[joint], q_logged[joint].mean(axis=1), q_policy[joint].mean(axis=1))
+
+
+def evaluate(theta_path, prefs_source="production", clip=None, page_size=1000, batch_size=256,
+             topic_cache="embedding_cache", allow_embed=True, limit=None):
+    started = time.time()
+    reward_model, fitted = fit_reward_model(page_size, limit)
+    print(f"Reward model fit on {fitted} rows in {time.time() - started:.1f}s")
+
+    policy = CandidatePolicy(theta_path, prefs_source)
+    estimates = {dim: Estimate() for dim in DIMENSIONS + ["ALL"]}
+    cache = EmbeddingCache(topic_cache, allow_embed=allow_embed)
+    rows_seen = 0
+
+    for rows in stream_reward_pages(None, page_size):
+        samples = [s for s in build_samples(rows, cache) if s.get("propensity")]
+        for start in range(0, len(samples), batch_size):
+            batch = samples[start:start + batch_size]
+            probs = policy.probabilities(batch, rl_agent.sample_matrix(batch))
+            accumulate(estimates, batch, probs, reward_model, clip)
+
+        rows_seen += len(rows)
+        if limit and rows_seen >= limit:
+            break
+
+    elapsed = time.time() - started
+    print(f"Evaluated {rows_seen} rows in {elapsed:.1f}s ({rows_seen / max(elapsed, 1e-9):.1f} rows/sec)")
+    return {name: est.report() for name, est in estimates.items()}
+
+
+def print_report(report):
+    print(f"\n{'dimension':<20} {'n':>7} {'logged':>9} {'IPS':>9} {'SNIPS':>9} {'DR':>9} {'ESS':>9} {'max w':>8}")
+    for name, r in report.items():
+        if not r["n"]:
+            print(f"{name:<20} {0:>7}   (no logged propensities)")
+            continue
+        snips = f"{r['snips']:>9.4f}" if r["snips"] is not None else f"{'-':>9}"
+        print(
+            f"{name:<20} {r['n']:>7} {r['logged']:>9.4f} {r['ips']:>9.4f} {snips} "
+            f"{r['dr']:>9.4f} {r['ess']:>9.1f} {r['max_w']:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Off-policy evaluation of a candidate theta on logged actions")
+    parser.add_argument("--theta", default=rl_agent.THETA_PATH, help="Candidate theta file")
+    parser.add_argument("--prefs", choices=["production", "checkpoint"], default="production",
+                        help="Use production rl_preferences or the preferences stored in a replay checkpoint")
+    parser.add_argument("--clip", type=float, default=None, help="Clip importance weights at this value")
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--topic-cache", default="embedding_cache")
+    parser.add_argument("--no-embed", action="store_true", help="Skip rows whose topic embedding is not cached")
+    parser.add_argument("--limit", type=int, default=None, help="Stop after roughly this many rows")
+    parser.add_argument("--json", default=None, help="Also write the report to this file")
+    args = parser.parse_args()
+
+    report = evaluate(
+        args.theta,
+        prefs_source=args.prefs,
+        clip=args.clip,
+        page_size=args.page_size,
+        batch_size=args.batch_size,
+        topic_cache=args.topic_cache,
+        allow_embed=not args.no_embed,
+        limit=args.limit
+    )
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,257 @@
+"""
+preference_cache.py
+-------------------
+Process-local read-through cache of rl_preferences with write-behind deltas.
+
+Reads: all rows of a (platform, time_bucket) - every segment - are
+fetched with one query and kept for RL_PREFS_TTL seconds, so a whole
+generation run costs one query per (platform, time_bucket). Each entry
+carries its version stamp (latest updated_at of the rows), which is what
+the logit tables compare against.
+
+Writes: preference deltas are merged into a pending buffer and applied
+to the cached rows at once (reads see their own writes). The buffer is
+written as one batch when it is RL_PREFS_FLUSH_SECONDS old or holds
+RL_PREFS_MAX_PENDING keys, on flush(), and at interpreter exit. Flushed
+(platform, time_bucket) entries are dropped so the next read picks up
+other workers' writes too. Fetches and flushes run outside the cache
+lock, so a slow round-trip never blocks other readers and writers.
+
+Deltas still in the buffer are lost if the process is killed; set
+RL_PREFS_FLUSH_SECONDS=0 to write through.
+
+The cache knows nothing about Supabase: db.py passes in the fetch and
+flush functions.
+"""
+
+import time
+import threading
+
+GLOBAL_SEGMENT = -1   # rl_preferences.segment of the rows shared by all businesses
+
+
+class PreferenceCache:
+
+    def __init__(self, fetch, flush, ttl=300.0, flush_interval=30.0, max_pending=1000,
+                 min_segment_samples=20, clock=time.monotonic):
+        """
+        fetch(platform, time_bucket) -> [{segment, dimension, action_value,
+        preference_score, num_samples, updated_at}], raising on failure.
+        flush([{segment, platform, time_bucket, dimension, action_value, delta, samples}]).
+        """
+        self._fetch = fetch
+        self._flush = flush
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.min_segment_samples = min_segment_samples
+        self._clock = clock
+        self._lock = threading.RLock()
+        self._entries = {}    # (platform, time_bucket) -> {"rows", "version", "loaded_at"}
+        self._pending = {}    # (segment, platform, time_bucket, dimension, value) -> [delta, samples]
+        self._flushing = {}   # deltas of the flush in flight, same layout
+        self._pending_since = None
+        self._flush_lock = threading.Lock()   # one flush at a time, held without self._lock
+        self._flush_count = 0   # completed flushes, to spot one finishing during a fetch
+        self.metrics = {
+            "hits": 0,
+            "misses": 0,
+            "fetch_errors": 0,
+            "flushes": 0,
+            "flushed_rows": 0,
+            "flush_errors": 0,
+            "flush_seconds": 0.0
+        }
+
+    # ---------------- READS ----------------
+
+    def _unwritten(self):
+        yield from self._pending.items()
+        yield from self._flushing.items()
+
+    def _entry(self, platform, time_bucket):
+        """
+        Cached entry of a context; a missing or expired one is fetched
+        without holding the lock.
+        """
+        key = (platform, time_bucket)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._clock() - entry["loaded_at"] < self.ttl:
+                self.metrics["hits"] += 1
+                return entry
+            self.metrics["misses"] += 1
+            flush_count = self._flush_count
+
+        try:
+            fetched = self._fetch(platform, time_bucket)
+        except Exception as e:
+            with self._lock:
+                self.metrics["fetch_errors"] += 1
+            print(f"Error fetching preferences for {platform}/{time_bucket}: {e}")
+            if entry is not None:
+                return entry   # stale beats empty
+            return {"rows": {}, "version": None, "loaded_at": None}
+
+        with self._lock:
+            rows = {
+                (row.get("segment", GLOBAL_SEGMENT), row["dimension"], row["action_value"]): [
+                    float(row["preference_score"]), int(row.get("num_samples") or 0)
+                ]
+                for row in fetched
+            }
+            # deltas not written yet are not in the fetched rows
+            for (segment, p, tb, dim, value), (delta, samples) in self._unwritten():
+                if (p, tb) == key:
+                    self._apply(rows, (segment, dim, value), delta, samples)
+
+            entry = {
+                "rows": rows,
+                "version": max((row.get("updated_at") or "" for row in fetched), default=None) or None,
+                "loaded_at": self._clock()
+            }
+            # A flush that finished meanwhile may or may not be in the fetched rows
+            if self.ttl > 0 and flush_count == self._flush_count:
+                self._entries[key] = entry
+            return entry
+
+    def get(self, platform, time_bucket, segment=None):
+        """
+        { (dimension, value): score } for a context. With a segment, its own
+        score is used for every value it has at least min_segment_samples
+        samples for; everything else falls back to the global score.
+        """
+        entry = self._entry(platform, time_bucket)
+        with self._lock:
+            rows = entry["rows"]
+            prefs = {
+                (dim, value): score
+                for (seg, dim, value), (score, _) in rows.items()
+                if seg == GLOBAL_SEGMENT
+            }
+            if segment is not None and segment != GLOBAL_SEGMENT:
+                for (seg, dim, value), (score, samples) in rows.items():
+                    if seg == segment and samples >= self.min_segment_samples:
+                        prefs[(dim, value)] = score
+            return prefs
+
+    def version(self, platform, time_bucket):
+        """
+        Version stamp of the cached rows; "pending" while local deltas for
+        the context have not been written, so nothing built from the
+        database version matches.
+        """
+        with self._lock:
+            if any((p, tb) == (platform, time_bucket) for (_, p, tb, _, _), _ in self._unwritten()):
+                return "pending"
+        return self._entry(platform, time_bucket)["version"]
+
+    def invalidate(self, platform=None, time_bucket=None):
+        with self._lock:
+            if platform is None:
+                self._entries.clear()
+            else:
+                self._entries.pop((platform, time_bucket), None)
+
+    # ---------------- WRITES ----------------
+
+    @staticmethod
+    def _apply(rows, key, delta, samples):
+        row = rows.setdefault(key, [0.0, 0])
+        row[0] += delta
+        row[1] += samples
+
+    def add(self, updates):
+        """
+        Buffer aggregated deltas (db.update_preferences_batch format) and
+        flush if the buffer is due.
+        """
+        with self._lock:
+            for u in updates:
+                segment = u.get("segment", GLOBAL_SEGMENT)
+                key = (segment, u["platform"], u["time_bucket"], u["dimension"], u["action_value"])
+                pending = self._pending.setdefault(key, [0.0, 0])
+                pending[0] += u["delta"]
+                pending[1] += u["samples"]
+
+                entry = self._entries.get((u["platform"], u["time_bucket"]))
+                if entry is not None:
+                    self._apply(entry["rows"], (segment, u["dimension"], u["action_value"]), u["delta"], u["samples"])
+
+            if self._pending and self._pending_since is None:
+                self._pending_since = self._clock()
+            due = (
+                len(self._pending) >= self.max_pending
+                or self._clock() - (self._pending_since or 0.0) >= self.flush_interval
+            )
+        if due:
+            self.flush(wait=False)
+
+    def flush(self, wait=True):
+        """
+        Write every buffered delta as one batch. The buffer is swapped out
+        under the lock and written without it; on failure the deltas are
+        merged back for the next flush. wait=False returns at once if
+        another flush is running. Returns the number of rows written.
+        """
+        if not self._flush_lock.acquire(blocking=wait):
+            return 0
+        try:
+            return self._flush_pending()
+        finally:
+            self._flush_lock.release()
+
+    def _flush_pending(self):
+        with self._lock:
+            if not self._pending:
+                return 0
+            pending, self._pending, self._pending_since = self._pending, {}, None
+            self._flushing = pending
+
+            updates = [
+                {
+                    "segment": segment,
+                    "platform": platform,
+                    "time_bucket": time_bucket,
+                    "dimension": dim,
+                    "action_value": value,
+                    "delta": delta,
+                    "samples": samples
+                }
+                for (segment, platform, time_bucket, dim, value), (delta, samples) in pending.items()
+            ]
+            started = self._clock()
+
+        try:
+            self._flush(updates)
+        except Exception as e:
+            print(f"Error flushing {len(updates)} preference deltas, keeping them buffered: {e}")
+            with self._lock:
+                self.metrics["flush_errors"] += 1
+                for key, (delta, samples) in pending.items():
+                    merged = self._pending.setdefault(key, [0.0, 0])
+                    merged[0] += delta
+                    merged[1] += samples
+                self._flushing = {}
+                self._pending_since = started if self._pending_since is None else min(self._pending_since, started)
+            return 0
+
+        with self._lock:
+            self._flushing = {}
+            self._flush_count += 1
+            self.metrics["flushes"] += 1
+            self.metrics["flushed_rows"] += len(updates)
+            self.metrics["flush_seconds"] += self._clock() - started
+            for _, platform, time_bucket, _, _ in pending:
+                self._entries.pop((platform, time_bucket), None)
+        return len(updates)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.metrics["hits"] + self.metrics["misses"]
+            return {
+                **self.metrics,
+                "hit_rate": self.metrics["hits"] / lookups if lookups else None,
+                "entries": len(self._entries),
+                "pending": len(self._pending)
+            }
@@ -0,0 +1,108 @@
+"""
+projection.py
+-------------
+Optional linear projection of the RL context vector.
+
+The raw context is two concatenated 1536-d embeddings (3072 floats).
+A projection maps it down to k dimensions before scoring and updating,
+which shrinks every theta row (and the scoring FLOPs) by 3072 / k.
+
+Two kinds are supported:
+  - random: fixed Gaussian (Johnson-Lindenstrauss) matrix, fully
+    determined by (input_dim, k, seed) so it never has to be shipped
+  - pca:    offline-fitted principal components, saved with save()
+
+Every projection has an id; theta_store records it in the theta file so
+weights are never scored against a different projection.
+"""
+
+import os
+import hashlib
+import numpy as np
+
+
+class Projection:
+
+    def __init__(self, kind, matrix, mean=None, seed=None):
+        self.kind = kind
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)   # (input_dim x k)
+        self.mean = None if mean is None else np.asarray(mean, dtype=np.float32)
+        self.seed = seed
+
+    @property
+    def input_dim(self):
+        return self.matrix.shape[0]
+
+    @property
+    def k(self):
+        return self.matrix.shape[1]
+
+    @property
+    def id(self):
+        if self.kind == "random":
+            return f"random-{self.input_dim}x{self.k}-s{self.seed}"
+        digest = hashlib.sha1(self.matrix.tobytes())
+        if self.mean is not None:
+            digest.update(self.mean.tobytes())
+        return f"{self.kind}-{self.input_dim}x{self.k}-{digest.hexdigest()[:12]}"
+
+    def apply(self, x):
+        """
+        Project a (input_dim,) vector or a (n x input_dim) matrix.
+        """
+        x = np.asarray(x, dtype=np.float32)
+        if self.mean is not None:
+            x = x - self.mean
+        return x @ self.matrix
+
+    def save(self, path):
+        np.savez(
+            path,
+            kind=self.kind,
+            matrix=self.matrix,
+            mean=self.mean if self.mean is not None else np.empty(0, dtype=np.float32),
+            seed=-1 if self.seed is None else self.seed
+        )
+
+
+def random_projection(input_dim, k, seed=0):
+    rng = np.random.default_rng(seed)
+    matrix = rng.standard_normal((input_dim, k), dtype=np.float32) / np.sqrt(k)
+    return Projection("random", matrix, seed=seed)
+
+
+def fit_pca(samples, k):
+    """
+    Fit a PCA projection on a (n x input_dim) matrix of logged context vectors.
+    """
+    samples = np.asarray(samples, dtype=np.float32)
+    mean = samples.mean(axis=0)
+    _, _, vt = np.linalg.svd(samples - mean, full_matrices=False)
+    return Projection("pca", vt[:k].T, mean=mean)
+
+
+def load_projection(spec, input_dim):
+    """
+    spec:
+      ""                -> no projection (None)
+      "random:<k>[:<seed>]"
+      "<path>.npz"      -> projection saved with Projection.save()
+    """
+    if not spec:
+        return None
+
+    if spec.startswith("random:"):
+        parts = spec.split(":")
+        seed = int(parts[2]) if len(parts) > 2 else 0
+        return random_projection(input_dim, int(parts[1]), seed)
+
+    if not os.path.exists(spec):
+        raise ValueError(f"Projection file not found: {spec}")
+
+    data = np.load(spec)
+    mean = data["mean"] if data["mean"].size else None
+    seed = int(data["seed"])
+    projection = Projection(str(data["kind"]), data["matrix"], mean=mean, seed=None if seed < 0 else seed)
+    if projection.input_dim != input_dim:
+        raise ValueError(f"Projection {spec} expects input_dim={projection.input_dim}, got {input_dim}")
+    return projection
@@ -0,0 +1,254 @@
+"""
+replay_trainer.py
+-----------------
+Offline trainer that rebuilds theta from logged history.
+
+Streams rl_rewards joined with their rl_actions row and post_contents.topic
+in keyset pages ordered by (created_at, id), takes each context vector from
+the action row (or rebuilds it from cached embeddings for older rows) and
+replays the same updates as rl_agent.update_rl_batch in vectorized
+minibatches into a fresh theta file. Production theta and
+rl_preferences are never touched: the replayed discrete preferences are
+written into the checkpoint's header meta instead.
+
+The update rule does not depend on the current weights, so replay order
+does not matter and a resumed run produces the same checkpoint as an
+uninterrupted one. The resume cursor is stored in the checkpoint header,
+so weights and cursor are always saved together.
+
+Usage:
+    python replay_trainer.py --out replay_theta.bin [--lr-theta 0.01] [--lr-discrete 0.05]
+"""
+
+import os
+import time
+import hashlib
+import argparse
+import numpy as np
+
+import db
+import rl_agent
+from theta_store import ThetaStore
+
+REWARD_SELECT = (
+    "id, created_at, reward_value, baseline, "
+    "rl_actions(id, post_id, platform, time_bucket, topic, business_id, context_vector, context_projection, propensity, "
+    + ", ".join(dim.lower() for dim in rl_agent.ACTION_SPACE)
+    + ", post_contents(topic, business_id))"
+)
+
+
+# ---------------- EMBEDDING CACHE ----------------
+
+class EmbeddingCache:
+    """
+    Business embeddings are fetched once per business (one query per page
+    for new ids); topic embeddings are cached on disk as <sha1>.npy so a
+    topic is only ever embedded once across runs.
+    """
+
+    def __init__(self, topic_dir, allow_embed=True):
+        self.topic_dir = topic_dir
+        self.allow_embed = allow_embed
+        self.business = {}
+        self.embedded = 0
+        os.makedirs(topic_dir, exist_ok=True)
+
+    def prefetch_businesses(self, business_ids):
+        missing = sorted({b for b in business_ids if b and b not in self.business})
+        if not missing:
+            return
+
+        embeddings = db.get_profile_embeddings(missing)
+        for business_id in missing:
+            self.business[business_id] = embeddings.get(business_id)
+
+    def topic(self, text):
+        path = os.path.join(self.topic_dir, hashlib.sha1(text.encode("utf-8")).hexdigest() + ".npy")
+        if os.path.exists(path):
+            return np.load(path)
+        if not self.allow_embed:
+            return None
+
+        from generate import embed_topic   # paid API call, only on cache miss
+        embedding = embed_topic(text)
+        np.save(path, embedding)
+        self.embedded += 1
+        return embedding
+
+
+# ---------------- STREAMING ----------------
+
+def stream_reward_pages(cursor, page_size, select=REWARD_SELECT):
+    """
+    Yield pages of rl_rewards rows (with embedded rl_actions) after cursor.
+
+    cursor = {"created_at", "id"} of the last replayed row. ids are random
+    uuids, so created_at orders the stream and id only breaks ties.
+    """
+    while True:
+        query = db.supabase.table("rl_rewards") \
+            .select(select) \
+            .order("created_at") \
+            .order("id") \
+            .limit(page_size)
+        if cursor:
+            ts, last_id = cursor["created_at"], cursor["id"]
+            query = query.or_(f'created_at.gt."{ts}",and(created_at.eq."{ts}",id.gt.{last_id})')
+
+        rows = query.execute().data or []
+        if not rows:
+            return
+
+        yield rows
+        cursor = {"created_at": rows[-1]["created_at"], "id": rows[-1]["id"]}
+
+
+def build_samples(rows, cache):
+    """
+    Joined rows -> samples with ctx_vec set. The vector stored at selection
+    time is used when present; otherwise the context is rebuilt from cached
+    embeddings. Rows without a usable action, reward or embedding are skipped.
+    """
+    samples, rebuild = [], []
+    for row in rows:
+        action_row = row.get("rl_actions")
+        if not action_row or row.get("reward_value") is None:
+            continue
+
+        sample = {
+            "context": {
+                "platform": action_row["platform"],
+                "time_bucket": action_row.get("time_bucket")
+            },
+            "action": rl_agent.action_from_row(action_row),
+            "ctx_vec": rl_agent.stored_policy_vector(action_row),
+            "propensity": action_row.get("propensity"),
+            "reward": float(row["reward_value"]),
+            "baseline": float(row.get("baseline") or 0.0)
+        }
+        if sample["ctx_vec"] is not None:
+            samples.append(sample)
+            continue
+
+        posts = action_row.get("post_contents") or []
+        post = posts[0] if posts else {}
+        topic = action_row.get("topic") or post.get("topic")
+        business_id = action_row.get("business_id") or post.get("business_id")
+        if topic and business_id:
+            rebuild.append((sample, topic, business_id))
+
+    cache.prefetch_businesses(business_id for _, _, business_id in rebuild)
+
+    for sample, topic, business_id in rebuild:
+        business_embedding = cache.business.get(business_id)
+        topic_embedding = cache.topic(topic)
+        if business_embedding is None or topic_embedding is None:
+            continue
+
+        sample["context"]["business_embedding"] = business_embedding
+        sample["context"]["topic_embedding"] = topic_embedding
+        samples.append(sample)
+
+    return samples
+
+
+# ---------------- TRAINING ----------------
+
+def train(out_path, lr_theta=0.01, lr_discrete=0.05, page_size=1000, batch_size=256,
+          topic_cache="embedding_cache", allow_embed=True, limit=None):
+    store = ThetaStore(
+        out_path,
+        rl_agent.ACTION_SPACE,
+        rl_agent.EMBEDDING_DIM,
+        projection=rl_agent.projection.id if rl_agent.projection else None
+    )
+    store.load()
+
+    meta = store.meta
+    if meta and (meta.get("lr_theta"), meta.get("lr_discrete")) != (lr_theta, lr_discrete):
+        raise ValueError(
+            f"{out_path} was trained with lr_theta={meta.get('lr_theta')}, "
+            f"lr_discrete={meta.get('lr_discrete')}; use a new --out to change learning rates"
+        )
+
+    cursor = meta.get("cursor")
+    total_rows = meta.get("rows", 0)
+    total_samples = meta.get("samples", 0)
+    preferences = meta.get("preferences", {})
+    if cursor:
+        print(f"Resuming {out_path} after {cursor['created_at']} ({total_rows} rows already replayed)")
+
+    cache = EmbeddingCache(topic_cache, allow_embed=allow_embed)
+    started = time.time()
+    run_rows = 0
+
+    for rows in stream_reward_pages(cursor, page_size):
+        page_started = time.time()
+        samples = build_samples(rows, cache)
+
+        for start in range(0, len(samples), batch_size):
+            batch = samples[start:start + batch_size]
+            ctx_mat = rl_agent.sample_matrix(batch)
+            for u in rl_agent.accumulate_updates(store, batch, ctx_mat, lr_discrete, lr_theta):
+                if u["segment"] != db.GLOBAL_SEGMENT:
+                    continue   # replayed contexts carry no business, only global rows
+                key = "|".join([u["platform"], str(u["time_bucket"]), u["dimension"], u["action_value"]])
+                preferences[key] = preferences.get(key, 0.0) + u["delta"]
+
+        total_rows += len(rows)
+        total_samples += len(samples)
+        run_rows += len(rows)
+        store.meta = {
+            "cursor": {"created_at": rows[-1]["created_at"], "id": rows[-1]["id"]},
+            "rows": total_rows,
+            "samples": total_samples,
+            "lr_theta": lr_theta,
+            "lr_discrete": lr_discrete,
+            "preferences": preferences
+        }
+        store.save(force=True)
+
+        elapsed = time.time() - started
+        print(
+            f"Page: {len(rows)} rows, {len(samples)} replayed in {time.time() - page_started:.2f}s | "
+            f"total {total_rows} rows | {run_rows / max(elapsed, 1e-9):.1f} rows/sec | "
+            f"{cache.embedded} topics embedded"
+        )
+
+        if limit and run_rows >= limit:
+            break
+
+    elapsed = time.time() - started
+    print(
+        f"Replay finished: {run_rows} rows in {elapsed:.1f}s "
+        f"({run_rows / max(elapsed, 1e-9):.1f} rows/sec), checkpoint {out_path} v{store.version}"
+    )
+    return store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild theta offline from rl_actions + rl_rewards")
+    parser.add_argument("--out", required=True, help="Checkpoint path (resumed if it exists)")
+    parser.add_argument("--lr-theta", type=float, default=0.01)
+    parser.add_argument("--lr-discrete", type=float, default=0.05)
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--topic-cache", default="embedding_cache", help="Directory of cached topic embeddings")
+    parser.add_argument("--no-embed", action="store_true", help="Skip rows whose topic is not cached instead of calling the embeddings API")
+    parser.add_argument("--limit", type=int, default=None, help="Stop after roughly this many rows")
+    args = parser.parse_args()
+
+    if os.path.abspath(args.out) == os.path.abspath(rl_agent.THETA_PATH):
+        raise SystemExit("Refusing to write the production theta file; choose another --out")
+
+    train(
+        args.out,
+        lr_theta=args.lr_theta,
+        lr_discrete=args.lr_discrete,
+        page_size=args.page_size,
+        batch_size=args.batch_size,
+        topic_cache=args.topic_cache,
+        allow_embed=not args.no_embed,
+        limit=args.limit
+    )
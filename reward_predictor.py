@@ -0,0 +1,340 @@
+"""
+reward_predictor.py
+-------------------
+Early estimate of the final post reward from the first day of snapshots.
+
+The true reward (db.calculate_reward_from_snapshots) is only calculated
+168h after posting. Once the 24h snapshot is in, this model predicts it
+from the 6h/24h engagement so job_queue can apply a provisional RL update
+a day after posting; when the true reward lands only the residual
+(true - predicted) is applied, so the total update equals the one the
+true reward alone would have made. If the provisional update was never
+applied, the true reward is applied in full and the provisional job is
+dropped.
+
+One ridge regression per platform over
+
+    [1, l6, l24, l6^2, l24^2, l6 * l24, has_6h, lf, l24 / lf]
+
+    l = log1p(engagement), lf = log1p(max(follower_count, 1))
+
+with engagement the platform-weighted score of db.calculate_platform_engagement,
+fitted on post_rewards that already have their final reward. The true
+reward is tanh(log1p(engagement) / lf), hence the follower terms. The weights
+and the per-platform holdout error are stored in a small JSON file
+(RL_REWARD_MODEL).
+
+Usage:
+    python reward_predictor.py --fit [--ridge 1.0]   # refit on calculated rewards
+    python reward_predictor.py --report              # live error of provisional rewards
+"""
+
+import os
+import json
+import tempfile
+import argparse
+from datetime import datetime, timedelta
+import numpy as np
+
+import db
+
+EARLY_HOURS = (6, 24)
+SNAPSHOT_SELECT = "post_id, platform, timeslot_hours, likes, comments, shares, saves, replies, retweets, reactions, follower_count"
+NUM_FEATURES = 9
+# Posts whose 24h snapshot is still missing this long after posting are
+# marked as attempted (provisional_at) and left to the final reward
+MAX_WAIT_HOURS = 48
+
+
+def features(platform, snapshots):
+    """
+    Feature vector from a post's snapshots, or None without a 24h snapshot.
+    """
+    by_hours = {snap["timeslot_hours"]: snap for snap in snapshots}
+    if 24 not in by_hours:
+        return None
+
+    l6 = np.log1p(db.calculate_platform_engagement(platform, by_hours[6])) if 6 in by_hours else 0.0
+    l24 = np.log1p(db.calculate_platform_engagement(platform, by_hours[24]))
+    lf = np.log1p(max(by_hours[24].get("follower_count") or 1, 1))
+    return np.array([1.0, l6, l24, l6 * l6, l24 * l24, l6 * l24, float(6 in by_hours), lf, l24 / lf])
+
+
+class RewardPredictor:
+
+    def __init__(self, path):
+        self.path = path
+        self.platforms = {}    # platform -> {"weights", "n", "holdout": {...}}
+        self.fitted_at = None
+
+    def load(self):
+        """
+        False if no model has been fitted yet.
+        """
+        if self.platforms:
+            return True
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            data = json.load(f)
+        self.platforms = data["platforms"]
+        self.fitted_at = data.get("fitted_at")
+        return True
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".reward_model_", suffix=".json", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"fitted_at": self.fitted_at, "platforms": self.platforms}, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def predict(self, platform, snapshots):
+        """
+        Predicted final reward, or None if the platform has no model or the
+        24h snapshot is missing. Clipped to the reward's [-1, 1] range.
+        """
+        if not self.load() or platform not in self.platforms:
+            return None
+        if len(self.platforms[platform]["weights"]) != NUM_FEATURES:
+            print(f"Reward model for {platform} predates the current features; refit with --fit")
+            return None
+        x = features(platform, snapshots)
+        if x is None:
+            return None
+        return float(np.clip(x @ np.array(self.platforms[platform]["weights"]), -1.0, 1.0))
+
+    # ---------------- FITTING ----------------
+
+    @staticmethod
+    def _ridge(X, y, ridge):
+        penalty = ridge * np.eye(X.shape[1])
+        penalty[0, 0] = 0.0   # leave the intercept unpenalized
+        return np.linalg.solve(X.T @ X + penalty, X.T @ y)
+
+    @staticmethod
+    def _errors(X, y, weights):
+        err = np.clip(X @ weights, -1.0, 1.0) - y
+        return {
+            "n": int(len(y)),
+            "mae": float(np.abs(err).mean()),
+            "rmse": float(np.sqrt((err ** 2).mean())),
+            "bias": float(err.mean())
+        }
+
+    def fit(self, data, ridge=1.0, holdout=0.2, min_samples=20, seed=0):
+        """
+        data: {platform: (X, y)}. Holdout error is measured on a random
+        split, then the reported weights are refit on everything.
+        """
+        rng = np.random.default_rng(seed)
+        platforms = {}
+        for platform, (X, y) in data.items():
+            if len(y) < min_samples:
+                print(f"Skipping {platform}: only {len(y)} rewarded posts with early snapshots")
+                continue
+
+            test = rng.random(len(y)) < holdout
+            if test.any() and (~test).sum() >= X.shape[1]:
+                heldout = self._errors(X[test], y[test], self._ridge(X[~test], y[~test], ridge))
+            else:
+                heldout = None
+
+            weights = self._ridge(X, y, ridge)
+            platforms[platform] = {
+                "weights": weights.tolist(),
+                "n": int(len(y)),
+                "train": self._errors(X, y, weights),
+                "holdout": heldout
+            }
+
+        self.platforms = platforms
+        self.fitted_at = datetime.now(db.IST).isoformat()
+        return platforms
+
+
+# ---------------- DATA ----------------
+
+def early_snapshots(post_ids, chunk_size=100):
+    """
+    {post_id: [6h/24h snapshot rows]} for many posts.
+    """
+    snapshots = {}
+    for start in range(0, len(post_ids), chunk_size):
+        res = db.supabase.table("post_snapshots") \
+            .select(SNAPSHOT_SELECT) \
+            .in_("post_id", post_ids[start:start + chunk_size]) \
+            .in_("timeslot_hours", list(EARLY_HOURS)) \
+            .execute()
+        for row in res.data or []:
+            snapshots.setdefault(row["post_id"], []).append(row)
+    return snapshots
+
+
+def training_data(page_size=1000):
+    """
+    {platform: (X, y)} from every post_rewards row with a final reward.
+    """
+    rows_by_platform = {}
+    start = 0
+    while True:
+        res = db.supabase.table("post_rewards") \
+            .select("post_id, platform, reward_value") \
+            .eq("reward_status", "calculated") \
+            .order("id") \
+            .range(start, start + page_size - 1) \
+            .execute()
+        rows = [r for r in res.data or [] if r.get("reward_value") is not None]
+        snapshots = early_snapshots(sorted({r["post_id"] for r in rows}))
+
+        for row in rows:
+            snaps = [s for s in snapshots.get(row["post_id"], []) if s["platform"] == row["platform"]]
+            x = features(row["platform"], snaps)
+            if x is not None:
+                rows_by_platform.setdefault(row["platform"], []).append((x, float(row["reward_value"])))
+
+        if len(res.data or []) < page_size:
+            break
+        start += page_size
+
+    return {
+        platform: (np.stack([x for x, _ in pairs]), np.array([y for _, y in pairs]))
+        for platform, pairs in rows_by_platform.items()
+    }
+
+
+# ---------------- PROVISIONAL REWARDS ----------------
+
+def provisional_candidates(platforms, limit=50):
+    """
+    Pending post_rewards at least 24h old on a platform with a fitted model
+    that have not been attempted yet, oldest first.
+    """
+    if not platforms:
+        return []
+    cutoff = datetime.now(db.IST) - timedelta(hours=24)
+    res = db.supabase.table("post_rewards") \
+        .select("id, profile_id, post_id, platform, post_created_at") \
+        .eq("reward_status", "pending") \
+        .is_("provisional_at", "null") \
+        .in_("platform", sorted(platforms)) \
+        .lte("post_created_at", cutoff.isoformat()) \
+        .order("post_created_at") \
+        .limit(limit) \
+        .execute()
+    return res.data or []
+
+
+def claim(row):
+    """
+    Set provisional_at unless another worker already did. True if this call
+    claimed the row. The prediction travels in the RL job and is only
+    stored (db.set_provisional_rewards) once the update has been applied.
+    """
+    update = {"provisional_at": datetime.now(db.IST).isoformat()}
+    res = db.supabase.table("post_rewards").update(update) \
+        .eq("id", row["id"]) \
+        .is_("provisional_at", "null") \
+        .execute()
+    return bool(res.data)
+
+
+def predict_pending(model, limit=50):
+    """
+    Predict provisional rewards for due posts.
+    Returns [(post_rewards row, prediction)] for the posts claimed here.
+
+    Posts still without a 24h snapshot MAX_WAIT_HOURS after posting are
+    marked attempted without a prediction, so they stop coming back ahead
+    of newer posts.
+    """
+    if not model.load():
+        return []
+    rows = provisional_candidates(model.platforms, limit)
+    snapshots = early_snapshots([r["post_id"] for r in rows])
+    give_up = datetime.now(db.IST) - timedelta(hours=MAX_WAIT_HOURS)
+
+    predicted, abandoned = [], 0
+    for row in rows:
+        snaps = [s for s in snapshots.get(row["post_id"], []) if s["platform"] == row["platform"]]
+        prediction = model.predict(row["platform"], snaps)
+        if prediction is None:
+            posted = datetime.fromisoformat(row["post_created_at"].replace('Z', '+00:00'))
+            if posted.tzinfo is None:
+                posted = db.IST.localize(posted)
+            if posted <= give_up and claim(row):
+                abandoned += 1
+            continue
+
+        if claim(row):
+            predicted.append((row, prediction))
+
+    if abandoned:
+        print(f"No 24h snapshot after {MAX_WAIT_HOURS}h for {abandoned} posts; they get no provisional reward")
+    return predicted
+
+
+def report_errors(page_size=1000):
+    """
+    Per-platform error of provisional rewards against the final ones.
+    """
+    errors = {}
+    start = 0
+    while True:
+        res = db.supabase.table("post_rewards") \
+            .select("platform, reward_value, provisional_reward") \
+            .eq("reward_status", "calculated") \
+            .not_.is_("provisional_reward", "null") \
+            .order("id") \
+            .range(start, start + page_size - 1) \
+            .execute()
+        for row in res.data or []:
+            if row.get("reward_value") is not None:
+                errors.setdefault(row["platform"], []).append(float(row["provisional_reward"]) - float(row["reward_value"]))
+        if len(res.data or []) < page_size:
+            break
+        start += page_size
+
+    return {
+        platform: {
+            "n": len(err),
+            "mae": float(np.abs(err).mean()),
+            "rmse": float(np.sqrt((np.square(err)).mean())),
+            "bias": float(np.mean(err))
+        }
+        for platform, err in errors.items()
+    }
+
+
+def print_errors(title, errors):
+    print(f"\n{title}")
+    print(f"{'platform':<12} {'n':>7} {'MAE':>8} {'RMSE':>8} {'bias':>8}")
+    for platform, e in sorted(errors.items()):
+        if e:
+            print(f"{platform:<12} {e['n']:>7} {e['mae']:>8.4f} {e['rmse']:>8.4f} {e['bias']:>+8.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Early reward predictor for provisional RL updates")
+    parser.add_argument("--path", default=os.getenv("RL_REWARD_MODEL", "reward_model.json"))
+    parser.add_argument("--fit", action="store_true", help="Refit on all calculated rewards")
+    parser.add_argument("--report", action="store_true", help="Error of provisional vs final rewards")
+    parser.add_argument("--ridge", type=float, default=1.0)
+    args = parser.parse_args()
+
+    if not args.fit and not args.report:
+        parser.error("pass --fit and/or --report")
+
+    if args.fit:
+        model = RewardPredictor(args.path)
+        model.fit(training_data(), ridge=args.ridge)
+        model.save()
+        print(f"Saved reward model for {sorted(model.platforms)} to {args.path}")
+        print_errors("Holdout error", {p: m["holdout"] for p, m in model.platforms.items()})
+
+    if args.report:
+        print_errors("Provisional vs final reward", report_errors())
@@ -1,9 +1,16 @@
 # rl_agent.py
-import math
-import random
+import os
+import hashlib
+import threading
 import numpy as np
 import db
-from collections import defaultdict
+from theta_store import ThetaStore
+from shared_theta import SharedTheta, segment_name
+from logit_tables import LogitTables
+from lowrank_policy import LowRankPolicy
+from sharded_theta import ShardedTheta
+import segments
+from projection import load_projection
 
 # ---------------- ACTION SPACE ----------------
 
@@ -122,19 +129,95 @@ ACTION_SPACE = {
 }
 
 # ---------------- THETA STORE ----------------
-# theta per (dimension, value)
-EMBEDDING_DIM = 3072  # 384 business + 384 topic
+# theta per (dimension, value), stored sparsely: a row only exists once
+# update_rl has written it, untouched values score 0
+BUSINESS_DIM = 1536
+TOPIC_DIM = 1536
+CONTEXT_DIM = BUSINESS_DIM + TOPIC_DIM   # business embedding + topic embedding
+
+# Optional context projection: "" (off), "random:<k>[:<seed>]" or a fitted .npz
+# (see projection.py). theta rows live in the projected space.
+projection = load_projection(os.getenv("RL_PROJECTION", ""), CONTEXT_DIM)
+EMBEDDING_DIM = projection.k if projection else CONTEXT_DIM
+PROJECTION_ID = projection.id if projection else None
+
+# value -> row index, per dimension
+ACTION_INDEX = {
+    dim: {v: i for i, v in enumerate(values)}
+    for dim, values in ACTION_SPACE.items()
+}
 
-theta = defaultdict(lambda: np.zeros(EMBEDDING_DIM, dtype=np.float32))
+# Persisted between runs (see theta_store.py); loaded lazily on first use
+THETA_PATH = os.getenv("RL_THETA_PATH", "rl_theta.bin")
+
+# Serving precision: "float32", "float16" or "int8" (updates always stay float32)
+THETA_DTYPE = os.getenv("RL_THETA_DTYPE", "float32")
+REQUANTIZE_EVERY = int(os.getenv("RL_REQUANTIZE_EVERY", "20"))
+
+# Opt-in: serve theta from one shared-memory segment per host (see shared_theta.py)
+THETA_SHM = os.getenv("RL_THETA_SHM", "0") == "1"
+THETA_SHM_BYTES = int(os.getenv("RL_THETA_SHM_BYTES", str(64 * 1024 * 1024)))
+
+# Policy model: "theta" (one row per action value) or "lowrank" (see lowrank_policy.py)
+POLICY_MODEL = os.getenv("RL_POLICY_MODEL", "theta")
+LOWRANK_PATH = os.getenv("RL_LOWRANK_PATH", "rl_lowrank.npz")
+LOWRANK_RANK = int(os.getenv("RL_LOWRANK_RANK", "64"))
+
+if POLICY_MODEL == "lowrank":
+    theta = LowRankPolicy(LOWRANK_PATH, ACTION_SPACE, EMBEDDING_DIM, rank=LOWRANK_RANK, projection=PROJECTION_ID)
+elif POLICY_MODEL == "theta":
+    theta = ThetaStore(
+        THETA_PATH,
+        ACTION_SPACE,
+        EMBEDDING_DIM,
+        projection=PROJECTION_ID,
+        dtype=THETA_DTYPE,
+        requantize_every=REQUANTIZE_EVERY,
+        shared=SharedTheta.open(segment_name(THETA_PATH), THETA_SHM_BYTES) if THETA_SHM else None
+    )
+else:
+    raise ValueError(f"Unknown RL_POLICY_MODEL: {POLICY_MODEL}")
+
+# Optional precomputed (business, platform, time_bucket) logits, see logit_tables.py
+LOGIT_TABLES_PATH = os.getenv("RL_LOGIT_TABLES", "")
+logit_tables = LogitTables(LOGIT_TABLES_PATH) if LOGIT_TABLES_PATH else None
+
+# Optional per-segment preferences (see segments.py)
+SEGMENTS = os.getenv("RL_SEGMENTS", "0") == "1"
+SEGMENTS_PATH = os.getenv("RL_SEGMENTS_PATH", "rl_segments.npz")
+segment_model = segments.SegmentModel(SEGMENTS_PATH) if SEGMENTS else None
+
+# Optional per-business / per-segment theta residuals (see sharded_theta.py)
+THETA_SHARDS = os.getenv("RL_THETA_SHARDS", "")   # "", "business" or "segment"
+THETA_SHARD_DIR = os.getenv("RL_THETA_SHARD_DIR", "theta_shards")
+THETA_SHARD_BUDGET_BYTES = int(os.getenv("RL_THETA_SHARD_BUDGET_BYTES", str(256 << 20)))
+
+if THETA_SHARDS not in ("", "business", "segment"):
+    raise ValueError(f"Unknown RL_THETA_SHARDS: {THETA_SHARDS}")
+theta_shards = ShardedTheta(
+    THETA_SHARD_DIR,
+    ACTION_SPACE,
+    EMBEDDING_DIM,
+    projection=PROJECTION_ID,
+    dtype=THETA_DTYPE,
+    requantize_every=REQUANTIZE_EVERY,
+    budget_bytes=THETA_SHARD_BUDGET_BYTES
+) if THETA_SHARDS else None
+
+_rng = np.random.default_rng()
+
+# job_queue runs content generation threads next to the RL batch thread in
+# one process: scoring and updates of theta / logit_tables / segment_model
+# (and _rng) are serialized on this lock, like ShardedTheta's LRU
+policy_lock = threading.RLock()
 
 
 # ---------------- UTILS ----------------
 
 def softmax(scores):
-    max_s = max(scores)
-    exp = [math.exp(s - max_s) for s in scores]
-    total = sum(exp)
-    return [e / total for e in exp]
+    scores = np.asarray(scores, dtype=np.float64)
+    exp = np.exp(scores - scores.max(axis=-1, keepdims=True))
+    return exp / exp.sum(axis=-1, keepdims=True)
 
 
 def build_context_vector(context):
@@ -144,71 +227,411 @@ def build_context_vector(context):
     return np.concatenate([
         context["business_embedding"],
         context["topic_embedding"]
-    ])
+    ]).astype(np.float32, copy=False)
+
+
+def project(ctx):
+    """
+    Map raw context vector(s) into the space theta is scored in.
+    """
+    return projection.apply(ctx) if projection else ctx
+
+
+def policy_vector(context):
+    """
+    Context vector as seen by the policy (projected when enabled)
+    """
+    return project(build_context_vector(context))
+
+
+def business_policy_vectors(business_mat):
+    """
+    Policy vectors of (n x BUSINESS_DIM) business embeddings with a zero
+    topic half. policy_vector(context) == this + topic @ topic_basis().
+    """
+    business_mat = np.asarray(business_mat, dtype=np.float32)
+    zeros = np.zeros((business_mat.shape[0], TOPIC_DIM), dtype=np.float32)
+    return project(np.hstack([business_mat, zeros]))
+
+
+def topic_basis():
+    """
+    (TOPIC_DIM x EMBEDDING_DIM) linear map of a topic embedding into policy space.
+    """
+    if projection:
+        return projection.matrix[BUSINESS_DIM:]
+    return np.eye(TOPIC_DIM, CONTEXT_DIM, k=BUSINESS_DIM, dtype=np.float32)
+
+
+def stored_policy_vector(row):
+    """
+    Policy vector saved with an rl_actions row (see db.insert_action), or
+    None if it is missing or was recorded under a different projection.
+    """
+    if row.get("context_projection") != PROJECTION_ID:
+        return None
+    vec = db.decode_context_vector(row.get("context_vector"))
+    if vec is None or vec.shape != (EMBEDDING_DIM,):
+        return None
+    return vec
+
+
+def sample_matrix(samples):
+    """
+    Stack the policy vectors of samples, reusing a sample's ctx_vec when
+    present and rebuilding it from the context otherwise.
+    """
+    return np.stack([
+        s["ctx_vec"] if s.get("ctx_vec") is not None else policy_vector(s["context"])
+        for s in samples
+    ]).astype(np.float32, copy=False)
+
+
+def context_segment(context):
+    """
+    Preference segment of the context's business, None for global-only.
+    Businesses without a segment of the current model generation are
+    assigned read-only from their embedding; `segments.py --assign`
+    persists them. A context already carrying "segment" (see
+    with_segments) is not looked up again.
+    """
+    if segment_model is None:
+        return None
+    if "segment" in context:
+        return context["segment"]
+
+    business_id = context.get("business_id")
+    if not business_id:
+        return None
+    segment = db.get_business_segment(business_id)
+    with policy_lock:
+        if not segment_model.load():
+            return None
+        if segment_model.current(segment):
+            return segment
+        if context.get("business_embedding") is None:
+            return None
+        return segment_model.segment_of(context["business_embedding"])
+
+
+def with_segments(contexts):
+    """
+    Contexts with their segment resolved, so nothing run under policy_lock
+    looks it up in the database.
+    """
+    if segment_model is None:
+        return contexts
+    return [c if "segment" in c else {**c, "segment": context_segment(c)} for c in contexts]
+
+
+def shard_key(context):
+    """
+    Theta shard of the context's business, None if sharding is off or the
+    context has no business (or segment).
+    """
+    if THETA_SHARDS == "business":
+        return context.get("business_id") or None
+    if THETA_SHARDS == "segment":
+        segment = context_segment(context)
+        return None if segment is None else f"segment_{segment}"
+    return None
+
+
+def shard_groups(contexts):
+    """
+    {shard_key: row indices} for the contexts that have a shard.
+    """
+    groups = {}
+    if theta_shards is not None:
+        for i, context in enumerate(contexts):
+            key = shard_key(context)
+            if key is not None:
+                groups.setdefault(key, []).append(i)
+    return {key: np.array(members, dtype=np.intp) for key, members in groups.items()}
+
+
+def preference_vector(all_prefs, dim):
+    """
+    Discrete preference scores for one dimension, aligned with
+    the rows of theta[dim] (missing entries score 0.0).
+    """
+    return np.array(
+        [all_prefs.get((dim, v), 0.0) for v in ACTION_SPACE[dim]],
+        dtype=np.float32
+    )
 
 
 # ---------------- ACTION SELECTION ----------------
 
-def select_action(context):
+def select_action(context, post_id=None):
     """
     context = {
       platform,
       time_bucket,
-      business_embedding (384),
-      topic_embedding (384)
+      business_embedding (1536),
+      topic_embedding (1536),
+      business_id (optional, enables the precomputed logit tables and
+                   per-segment preferences)
     }
+    post_id seeds the sampler so the decision can be replayed exactly.
+
+    Returns (action, ctx_vec, propensity) with propensity = {dim: probability
+    of the chosen value}.
     """
+    return select_actions_batch([context], [post_id])[0]
 
-    ctx_vec = build_context_vector(context)
 
-    # BATCH FETCH: Get all preferences for this context in ONE call
-    all_prefs = db.get_preferences_batch(
-        context["platform"],
-        context["time_bucket"]
-    )
-    # Returns dict: { (dimension, value): score }
+def decision_rng(post_id, dim):
+    """
+    Generator for one (post_id, dimension) decision. The same pair always
+    yields the same stream.
+    """
+    digest = hashlib.sha256(f"{post_id}|{dim}".encode("utf-8")).digest()
+    return np.random.default_rng(int.from_bytes(digest[:16], "little"))
 
-    action = {}
 
-    for dim, values in ACTION_SPACE.items():
+def gumbel_noise(post_ids, dim, num_values):
+    """
+    (n x num_values) Gumbel(0, 1) noise, seeded per (post_id, dim) for
+    rows that have a post_id and from the global stream otherwise.
+    """
+    noise = _rng.gumbel(size=(len(post_ids), num_values))
+    for i, post_id in enumerate(post_ids):
+        if post_id is not None:
+            noise[i] = decision_rng(post_id, dim).gumbel(size=num_values)
+    return noise
+
+
+def sample_gumbel_max(scores, noise):
+    """
+    argmax(scores + Gumbel noise) per row: an exact draw from softmax(scores).
+    """
+    return np.argmax(np.asarray(scores, dtype=np.float64) + noise, axis=1)
+
+
+def replay_choice(post_id, dim, scores):
+    """
+    Re-draw a logged decision from its scores (num_values,): bit-exact with
+    what select_action chose for post_id when given the same scores.
+    """
+    noise = decision_rng(post_id, dim).gumbel(size=len(scores))
+    return ACTION_SPACE[dim][int(sample_gumbel_max(np.asarray(scores)[None, :], noise[None, :])[0])]
+
+
+def table_logits(contexts, groups):
+    """
+    Logits from the precomputed tables for contexts that have a fresh row.
+    Returns (hit mask, (n x total values) logits or None).
+    """
+    hit = np.zeros(len(contexts), dtype=bool)
+    if not logit_tables.load() or not logit_tables.matches(theta.version, PROJECTION_ID, ACTION_SPACE):
+        return hit, None
+
+    rows = np.full(len(contexts), -1, dtype=np.intp)
+    for (platform, time_bucket, _), members in groups.items():
+        if logit_tables.prefs_version(platform, time_bucket) != db.get_preferences_version(platform, time_bucket):
+            continue
+        for i in members:
+            rows[i] = logit_tables.row(contexts[i].get("business_id"), platform, time_bucket)
+
+    hit = rows >= 0
+    if not hit.any():
+        return hit, None
+
+    topics = np.stack([
+        np.asarray(contexts[i]["topic_embedding"], dtype=np.float32) for i in np.flatnonzero(hit)
+    ])
+    logits = np.zeros((len(contexts), logit_tables.base.shape[1]), dtype=np.float32)
+    logits[hit] = logit_tables.base[rows[hit]] + topics @ logit_tables.topic_weights
+    return hit, logits
+
+
+def select_actions_batch(contexts, post_ids=None):
+    """
+    Select actions for many contexts in one pass.
+
+    Contexts are grouped by (platform, time_bucket, segment) so preferences
+    are fetched once per group; every dimension is then scored for all
+    contexts with one matrix product and sampled in one vectorized draw.
+    Contexts with a fresh precomputed table row (RL_LOGIT_TABLES) skip the
+    preferences fetch and the business half of the product. With
+    RL_THETA_SHARDS each context's shard residual is added on top.
+
+    Sampling is Gumbel-max, seeded per (post_id, dimension) when post_ids
+    are given.
+
+    Returns [(action, ctx_vec, propensity)] in the same order as contexts.
+    """
+    if not contexts:
+        return []
+    post_ids = list(post_ids) if post_ids is not None else [None] * len(contexts)
+
+    ctx_mat = project(np.stack([build_context_vector(c) for c in contexts]))
+    contexts = with_segments(contexts)
+
+    groups = {}
+    for i, context in enumerate(contexts):
+        groups.setdefault((context["platform"], context["time_bucket"], context_segment(context)), []).append(i)
 
-        scores = []
-        for v in values:
-            # discrete preference (from batch)
-            H = all_prefs.get((dim, v), 0.0)
+    with policy_lock:
+        return score_and_sample(contexts, post_ids, ctx_mat, groups)
 
-            # continuous contribution
-            score = H + np.dot(theta[(dim, v)], ctx_vec)
-            scores.append(score)
 
-        probs = softmax(scores)
-        action[dim] = random.choices(values, probs)[0]
+def score_and_sample(contexts, post_ids, ctx_mat, groups):
+    """
+    Scoring and sampling half of select_actions_batch; callers hold policy_lock.
+    """
+    theta.load()   # pick up saves by other processes once per batch
+    hit, logits = np.zeros(len(contexts), dtype=bool), None
+    if logit_tables is not None:
+        hit, logits = table_logits(contexts, groups)
+    miss = np.flatnonzero(~hit)
+
+    # BATCH FETCH: one preferences call per (platform, time_bucket, segment) with table misses
+    group_of = np.empty(len(contexts), dtype=np.intp)
+    group_prefs = []
+    for g, ((platform, time_bucket, segment), members) in enumerate(groups.items()):
+        group_prefs.append({} if hit[members].all() else db.get_preferences_batch(platform, time_bucket, segment))
+        group_of[members] = g
+
+    miss_mat = ctx_mat[miss]   # one matrix for every dimension
+    shards = shard_groups(contexts)
+    actions = [{} for _ in contexts]
+    propensities = [{} for _ in contexts]
+    rows = np.arange(len(contexts))
 
-    return action, ctx_vec
+    for dim, values in ACTION_SPACE.items():
+        scores = np.empty((len(contexts), len(values)), dtype=np.float32)
+        if logits is not None:
+            scores[hit] = logits[hit][:, logit_tables.columns(dim)]
+        if len(miss):
+            # discrete preference (per group) + continuous contribution, one matmul per dimension
+            prefs = np.stack([preference_vector(p, dim) for p in group_prefs])
+            scores[miss] = prefs[group_of[miss]] + theta.scores(dim, miss_mat)
+        for key, members in shards.items():
+            scores[members] += theta_shards.scores(key, dim, ctx_mat[members])
+
+        choices = sample_gumbel_max(scores, gumbel_noise(post_ids, dim, len(values)))
+        chosen_probs = softmax(scores)[rows, choices]
+        for action, propensity, c, p in zip(actions, propensities, choices, chosen_probs):
+            action[dim] = values[c]
+            propensity[dim] = float(p)
+
+    return list(zip(actions, ctx_mat, propensities))
 
     # ---------------- LEARNING UPDATE ----------------
 
 def update_rl(context, action, ctx_vec, reward, baseline,
               lr_discrete=0.05, lr_theta=0.01):
     print(f"Updating RL: reward={reward:.4f}, baseline={baseline:.4f}, advantage={reward - baseline:.4f}")
-    ctx_vec = build_context_vector(context)
-    advantage = reward - baseline
-
-    for dim, val in action.items():
-        print(f"   Updating action dimension: {dim}={val}")
-
-        # 1. Discrete update (Supabase)
-        db.update_preference(
-            context["platform"],
-            context["time_bucket"],
-            dim,
-            val,
-            lr_discrete * advantage
-        )
+    update_rl_batch(
+        [{"context": context, "action": action, "ctx_vec": ctx_vec, "reward": reward, "baseline": baseline}],
+        lr_discrete=lr_discrete,
+        lr_theta=lr_theta
+    )
+
+
+def update_rl_batch(samples, lr_discrete=0.05, lr_theta=0.01):
+    """
+    Apply many rewards in one vectorized pass.
+
+    samples = [{context, action, reward, baseline[, ctx_vec]}, ...]
+
+    ctx_vec is the policy vector returned by select_action; when present
+    the context only needs platform and time_bucket.
+
+    Discrete deltas are summed per (platform, time_bucket, dimension, value)
+    and buffered for one bulk write (db.queue_preference_updates); theta
+    gets one scatter-add per dimension over the stacked context matrix and
+    a single save.
+    """
+    if not samples:
+        return
+
+    ctx_mat = sample_matrix(samples)
+    print(f"Updating RL batch: {len(samples)} samples")
+    samples = [
+        {**s, "context": context}
+        for s, context in zip(samples, with_segments([s["context"] for s in samples]))
+    ]
 
-        # 2. Continuous update (theta)
-        theta_update = lr_theta * advantage * ctx_vec
-        theta[(dim, val)] += theta_update
-        print(f"   Theta update magnitude: {np.linalg.norm(theta_update):.6f}")
+    with policy_lock:
+        theta.load()
+        preference_updates = accumulate_updates(theta, samples, ctx_mat, lr_discrete, lr_theta, theta_shards)
 
+        # Persist so the next cron run selects with the learned theta
+        theta.save()
+        if theta_shards is not None:
+            theta_shards.save()
 
+    db.queue_preference_updates(preference_updates)
+
+
+def action_from_row(row):
+    """
+    rl_actions row -> action dict (columns are the lower-cased dimension names)
+    """
+    return {dim: row.get(dim.lower()) for dim in ACTION_SPACE}
+
+
+def accumulate_updates(store, samples, ctx_mat, lr_discrete=0.05, lr_theta=0.01, shards=None):
+    """
+    Scatter-add the theta updates of samples (rows of ctx_mat, already
+    projected) into store and return the aggregated discrete updates,
+    ready for db.update_preferences_batch.
+
+    With shards (a ShardedTheta) every sample also updates its own shard.
+
+    Samples flagged "correction" (the residual of a provisional update, see
+    reward_predictor.py) move the weights but do not count as new samples.
+    """
+    advantages = np.array([s["reward"] - s["baseline"] for s in samples], dtype=np.float32)
+
+    for s in samples:
+        for dim, val in s["action"].items():
+            if val is not None and val not in ACTION_INDEX.get(dim, {}):
+                print(f"   Skipping unknown action dimension/value: {dim}={val}")
+
+    # { (platform, time_bucket, segment, dimension, value): [delta, samples] }
+    # every sample updates the global row and, if it has one, its segment's row
+    pref_deltas = {}
+    sample_segments = [context_segment(s["context"]) for s in samples]
+    sample_shards = shard_groups([s["context"] for s in samples]) if shards is not None else {}
+
+    for dim in ACTION_SPACE:
+        rows = np.array(
+            [ACTION_INDEX[dim].get(s["action"].get(dim), -1) for s in samples],
+            dtype=np.intp
+        )
+        known = np.flatnonzero(rows >= 0)
+        if not len(known):
+            continue
+
+        # 1. Discrete deltas, aggregated per key
+        for i in known:
+            context = samples[i]["context"]
+            for segment in {db.GLOBAL_SEGMENT, sample_segments[i]} - {None}:
+                key = (context["platform"], context["time_bucket"], segment, dim, ACTION_SPACE[dim][rows[i]])
+                entry = pref_deltas.setdefault(key, [0.0, 0])
+                entry[0] += lr_discrete * float(advantages[i])
+                entry[1] += 0 if samples[i].get("correction") else 1
+
+        # 2. Continuous update: theta[dim][row_i] += lr * adv_i * ctx_i for all i at once
+        store.scatter_add(dim, rows[known], lr_theta * advantages[known], ctx_mat[known])
+        for key, members in sample_shards.items():
+            members = members[rows[members] >= 0]
+            if len(members):
+                shards.scatter_add(key, dim, rows[members], lr_theta * advantages[members], ctx_mat[members])
+
+    return [
+        {
+            "platform": platform,
+            "time_bucket": time_bucket,
+            "segment": segment,
+            "dimension": dim,
+            "action_value": val,
+            "delta": delta,
+            "samples": count
+        }
+        for (platform, time_bucket, segment, dim, val), (delta, count) in pref_deltas.items()
+    ]
@@ -0,0 +1,261 @@
+"""
+segments.py
+-----------
+Business segments for hierarchical rl_preferences.
+
+Profile embeddings (profiles.user_context_embedding) are clustered with
+mini-batch k-means; each business's segment id is cached in
+profiles.rl_segment and preferences are learned per (segment, platform,
+time_bucket) next to the global (segment -1) rows, see
+db.get_preferences_batch for the fallback.
+
+Centroids live in a small .npz (RL_SEGMENTS_PATH). New businesses are
+assigned to the nearest centroid, which is nudged towards them with the
+usual per-centroid 1/count step, so no full recluster is needed.
+
+A full --fit renumbers the clusters, so segment ids carry the model's
+generation (bumped by every fit): segment = generation * GENERATION_STRIDE
++ cluster. Preference rows and theta shards of an older generation can
+never be mistaken for a new cluster; --fit deletes them.
+
+Selection only assigns read-only (nearest centroid, nothing saved);
+the nightly --assign persists new businesses and nudges the centroids.
+
+Usage:
+    python segments.py --fit --k 16      # (re)cluster every active profile
+    python segments.py --assign          # assign profiles without a segment (nightly)
+"""
+
+import os
+import glob
+import json
+import tempfile
+import argparse
+import numpy as np
+
+GENERATION_STRIDE = 10000   # > any k
+
+
+class SegmentModel:
+
+    def __init__(self, path):
+        self.path = path
+        self.centroids = None    # (k x embedding_dim)
+        self.counts = None       # points absorbed per centroid, drives the step size
+        self.version = 0
+        self.generation = 0      # bumped by every full fit, see segment_id
+        self._mtime = None
+
+    def load(self):
+        """
+        (Re)load the model when the file changed on disk (e.g. a refit by
+        another process). False if no model has been fitted yet.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return self.centroids is not None
+
+        if mtime != self._mtime:
+            with np.load(self.path) as data:
+                header = json.loads(str(data["header"]))
+                self.centroids = np.array(data["centroids"])
+                self.counts = np.array(data["counts"])
+                self.version = int(header["version"])
+                self.generation = int(header.get("generation", 0))
+            self._mtime = mtime
+        return True
+
+    def save(self):
+        self.version += 1
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".segments_", suffix=".npz", dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(
+                    f,
+                    header=np.array(json.dumps({"version": self.version, "generation": self.generation})),
+                    centroids=self.centroids,
+                    counts=self.counts
+                )
+            os.replace(tmp_path, self.path)
+            self._mtime = os.stat(self.path).st_mtime_ns
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @property
+    def k(self):
+        return 0 if self.centroids is None else len(self.centroids)
+
+    def segment_id(self, label):
+        return self.generation * GENERATION_STRIDE + int(label)
+
+    def current(self, segment):
+        """
+        True if a stored segment id belongs to this model's generation.
+        """
+        return segment is not None and segment // GENERATION_STRIDE == self.generation
+
+    def segment_of(self, embedding):
+        """
+        Read-only segment id of one embedding (nothing is saved or nudged).
+        """
+        return self.segment_id(self.assign(np.asarray(embedding, dtype=np.float32)[None, :])[0])
+
+    # ---------------- K-MEANS ----------------
+
+    def assign(self, embeddings):
+        """
+        Nearest centroid per row of a (n x embedding_dim) matrix.
+        """
+        x = np.asarray(embeddings, dtype=np.float32)
+        distances = (
+            (x * x).sum(axis=1, keepdims=True)
+            - 2.0 * x @ self.centroids.T
+            + (self.centroids * self.centroids).sum(axis=1)
+        )
+        return distances.argmin(axis=1)
+
+    def partial_fit(self, embeddings):
+        """
+        One mini-batch k-means step: move each centroid towards the points
+        assigned to it with step 1/count. Returns the assignments.
+        """
+        x = np.asarray(embeddings, dtype=np.float32)
+        labels = self.assign(x)
+        for c in np.unique(labels):
+            members = x[labels == c]
+            self.counts[c] += len(members)
+            step = len(members) / self.counts[c]
+            self.centroids[c] += step * (members.mean(axis=0) - self.centroids[c])
+        return labels
+
+    def fit(self, embeddings, k, batch_size=256, iterations=100, seed=0):
+        """
+        Mini-batch k-means (k-means++ seeding) on a (n x embedding_dim) matrix.
+        """
+        x = np.asarray(embeddings, dtype=np.float32)
+        k = min(k, len(x), GENERATION_STRIDE)
+        rng = np.random.default_rng(seed)
+        if self.centroids is not None or os.path.exists(self.path):
+            self.load()
+            self.generation += 1   # new numbering
+
+        centroids = [x[rng.integers(len(x))]]
+        closest = ((x - centroids[0]) ** 2).sum(axis=1)
+        for _ in range(1, k):
+            probs = closest / closest.sum() if closest.sum() > 0 else None
+            centroids.append(x[rng.choice(len(x), p=probs)])
+            closest = np.minimum(closest, ((x - centroids[-1]) ** 2).sum(axis=1))
+
+        self.centroids = np.stack(centroids).astype(np.float32)
+        self.counts = np.zeros(k, dtype=np.float64)
+        for _ in range(iterations):
+            batch = x[rng.choice(len(x), size=min(batch_size, len(x)), replace=False)]
+            self.partial_fit(batch)
+
+        return self.assign(x)
+
+
+# ---------------- JOBS ----------------
+
+def fit_segments(model, k, batch_size=256, iterations=100):
+    """
+    Full recluster of every active profile; rewrites all cached segment ids.
+    """
+    import db
+
+    embeddings = db.get_profile_embeddings(db.get_all_profile_ids())
+    if not embeddings:
+        print("No profile embeddings to cluster")
+        return {}
+
+    ids = list(embeddings)
+    labels = model.fit(np.stack([embeddings[i] for i in ids]), k, batch_size, iterations)
+    model.save()
+
+    assignments = {business_id: model.segment_id(label) for business_id, label in zip(ids, labels)}
+    db.set_business_segments(assignments)
+    sizes = np.bincount(labels, minlength=model.k)
+    print(
+        f"Clustered {len(ids)} profiles into {model.k} segments "
+        f"(generation {model.generation}, v{model.version}), sizes {sizes.tolist()}"
+    )
+    prune_generations(model)
+    return assignments
+
+
+def prune_generations(model):
+    """
+    Delete per-segment rl_preferences rows and segment theta shards of
+    older generations; their cluster numbers mean nothing any more.
+    """
+    import db
+    import rl_agent
+
+    first = model.generation * GENERATION_STRIDE
+    deleted = db.delete_segment_preferences_before(first)
+    print(f"Deleted {deleted} rl_preferences rows of older segment generations")
+
+    if rl_agent.THETA_SHARDS == "segment":
+        stale = []
+        for path in glob.glob(os.path.join(rl_agent.THETA_SHARD_DIR, "segment_*")):
+            segment = os.path.basename(path).split(".")[0][len("segment_"):]   # segment_<id>.bin[.lock|.<dtype>]
+            if not segment.isdigit() or int(segment) < first:
+                stale.append(path)
+        for path in stale:
+            os.remove(path)
+        print(f"Deleted {len(stale)} theta shard files of older segment generations")
+
+
+def assign_new(model, business_embeddings):
+    """
+    Incrementally assign {business_id: embedding} and persist the segments.
+    """
+    import db
+
+    if not business_embeddings or not model.load():
+        return {}
+
+    ids = list(business_embeddings)
+    labels = model.partial_fit(np.stack([business_embeddings[i] for i in ids]))
+    model.save()
+
+    assignments = {business_id: model.segment_id(label) for business_id, label in zip(ids, labels)}
+    db.set_business_segments(assignments)
+    return assignments
+
+
+def assign_unsegmented(model):
+    import db
+
+    if not model.load():
+        print("No segment model; run --fit first")
+        return {}
+    ids = db.get_all_profile_ids()
+    segments = db.get_business_segments(ids)
+    missing = [i for i in ids if not model.current(segments.get(i))]
+    assignments = assign_new(model, db.get_profile_embeddings(missing))
+    print(f"Assigned {len(assignments)} of {len(missing)} unsegmented profiles")
+    return assignments
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cluster business profiles into preference segments")
+    parser.add_argument("--path", default=os.getenv("RL_SEGMENTS_PATH", "rl_segments.npz"))
+    parser.add_argument("--fit", action="store_true", help="Full recluster of all active profiles")
+    parser.add_argument("--assign", action="store_true", help="Assign profiles that have no segment yet")
+    parser.add_argument("--k", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--iterations", type=int, default=100)
+    args = parser.parse_args()
+
+    model = SegmentModel(args.path)
+    if args.fit:
+        fit_segments(model, args.k, args.batch_size, args.iterations)
+    elif args.assign:
+        assign_unsegmented(model)
+    else:
+        parser.error("pass --fit or --assign")
@@ -0,0 +1,137 @@
+"""
+sharded_theta.py
+----------------
+Per-business (or per-segment) theta shards under a memory budget.
+
+With RL_THETA_SHARDS=business|segment every shard key gets its own theta
+file (theta_store format) in RL_THETA_SHARD_DIR holding a residual on top
+of the global theta:
+
+    score(dim, value | ctx, key) = theta[dim][value] . ctx + shard[key][dim][value] . ctx
+
+A shard starts empty (the global policy) and learns from the rewards of
+its own key only, while the global theta keeps learning from everyone.
+
+Shards are loaded on first use and kept in an in-process LRU. Once the
+resident bytes of all loaded shards exceed RL_THETA_SHARD_BUDGET_BYTES the
+least recently used ones are saved (if dirty) and dropped, so a run that
+works through every business keeps a bounded footprint. The LRU is locked,
+so job_queue's generation threads and RL batch can share one instance.
+"""
+
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from theta_store import ThetaStore
+
+# Counted per loaded shard on top of its rows, so empty shards are evicted too
+SHARD_OVERHEAD_BYTES = 4096
+
+
+class ShardedTheta:
+
+    def __init__(self, directory, action_space, embedding_dim, projection=None,
+                 dtype="float32", requantize_every=20, budget_bytes=256 << 20):
+        self.directory = directory
+        self.action_space = action_space
+        self.embedding_dim = embedding_dim
+        self.projection = projection
+        self.dtype = dtype
+        self.requantize_every = requantize_every
+        self.budget_bytes = budget_bytes
+        self._shards = OrderedDict()   # key -> ThetaStore, least recently used first
+        self._bytes = {}               # key -> resident bytes when last touched
+        self._lock = threading.RLock()
+        self.metrics = {"hits": 0, "misses": 0, "evictions": 0, "eviction_saves": 0}
+
+    def shard_path(self, key):
+        safe = re.sub(r"[^A-Za-z0-9_.-]", "_", str(key))
+        return os.path.join(self.directory, f"{safe}.bin")
+
+    # ---------------- LRU ----------------
+
+    def shard(self, key):
+        """
+        The (loaded) store for key, marked most recently used.
+        """
+        with self._lock:
+            return self._shard(key)
+
+    def _shard(self, key):
+        store = self._shards.get(key)
+        if store is not None:
+            self.metrics["hits"] += 1
+            self._shards.move_to_end(key)
+            return store
+
+        self.metrics["misses"] += 1
+        os.makedirs(self.directory, exist_ok=True)
+        store = ThetaStore(
+            self.shard_path(key),
+            self.action_space,
+            self.embedding_dim,
+            projection=self.projection,
+            dtype=self.dtype,
+            requantize_every=self.requantize_every
+        )
+        store.load()
+        self._shards[key] = store
+        self._touch(key)
+        return store
+
+    def _touch(self, key):
+        self._bytes[key] = self._shards[key].resident_bytes() + SHARD_OVERHEAD_BYTES
+        self._evict(keep=key)
+
+    def _evict(self, keep):
+        while self.resident_bytes() > self.budget_bytes and len(self._shards) > 1:
+            key, store = next(iter(self._shards.items()))
+            if key == keep:
+                self._shards.move_to_end(key)
+                continue
+            if store.dirty:
+                store.save()
+                self.metrics["eviction_saves"] += 1
+            del self._shards[key]
+            del self._bytes[key]
+            self.metrics["evictions"] += 1
+
+    def resident_bytes(self):
+        return sum(self._bytes.values())
+
+    # ---------------- ACCESS ----------------
+
+    def scores(self, key, dim, ctx_mat):
+        """
+        (n x num_values) residual scores of one shard.
+        """
+        with self._lock:
+            return self._shard(key).scores(dim, ctx_mat)
+
+    def scatter_add(self, key, dim, rows, coefs, ctx_mat):
+        with self._lock:
+            self._shard(key).scatter_add(dim, rows, coefs, ctx_mat)
+            self._touch(key)
+
+    def save(self):
+        """
+        Save every dirty shard that is still resident.
+        """
+        with self._lock:
+            for key, store in self._shards.items():
+                if store.dirty:
+                    store.save()
+                    self._bytes[key] = store.resident_bytes() + SHARD_OVERHEAD_BYTES
+
+    def stats(self):
+        with self._lock:
+            lookups = self.metrics["hits"] + self.metrics["misses"]
+            return {
+                **self.metrics,
+                "hit_rate": self.metrics["hits"] / lookups if lookups else None,
+                "resident_shards": len(self._shards),
+                "resident_bytes": self.resident_bytes(),
+                "budget_bytes": self.budget_bytes
+            }
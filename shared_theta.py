@@ -0,0 +1,173 @@
+"""
+shared_theta.py
+---------------
+Host-wide shared-memory copy of the serving theta file.
+
+With RL_THETA_SHM=1 every worker on a host maps one
+multiprocessing.shared_memory segment instead of loading its own copy of
+theta, so memory stays constant however many processes select actions.
+
+Segment layout (little endian):
+
+    control      64 bytes  magic, active slot, slot capacity,
+                           per-slot sequence number and length
+    slot 0       capacity  bytes of a theta file (theta_store format)
+    slot 1       capacity
+
+The writer (whoever holds the theta file lock, see ThetaStore.save) always
+fills the slot that is not active and then flips `active`. Each slot has
+its own seqlock: the sequence is odd while the slot is being written and
+bumped to the next even value when done. Readers never lock: they parse
+the active slot zero-copy and re-check its sequence after every read; if
+it moved, the slot was recycled under them and they re-attach to the
+current one.
+"""
+
+import os
+import hashlib
+import struct
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:  # no POSIX/Windows shared memory: shared mode unavailable
+    shared_memory = None
+else:
+    class _Segment(shared_memory.SharedMemory):
+        """
+        Readers keep zero-copy numpy views of the segment for the life of
+        the process, so closing it at interpreter exit is expected to fail.
+        """
+        def __del__(self):
+            try:
+                super().__del__()
+            except BufferError:
+                pass
+
+MAGIC = b"RLTHSHM\0"
+SLOTS = 2
+CONTROL_SIZE = 64
+_CONTROL = struct.Struct("<8sIIQQQQQ")   # magic, active, pad, capacity, seq[2], len[2]
+
+
+def segment_name(theta_path):
+    """
+    Stable segment name for a theta file path.
+    """
+    digest = hashlib.sha1(os.path.abspath(theta_path).encode("utf-8")).hexdigest()
+    return f"rltheta_{digest[:16]}"
+
+
+def _open_segment(name, create, size=0):
+    """
+    The segment must outlive the process that created it (cron runs are
+    short), so it is kept out of multiprocessing's resource tracker.
+    """
+    try:
+        return _Segment(name=name, create=create, size=size, track=False)
+    except TypeError:  # Python < 3.13 has no track=
+        shm = _Segment(name=name, create=create, size=size)
+        try:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        except Exception:
+            pass
+        return shm
+
+
+class SharedTheta:
+
+    def __init__(self, shm):
+        self.shm = shm
+        magic, _, _, capacity, _, _, _, _ = _CONTROL.unpack_from(shm.buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f"Shared memory segment {shm.name} is not a theta segment")
+        self.capacity = capacity
+
+    @classmethod
+    def open(cls, name, capacity):
+        """
+        Attach to the segment, creating it with capacity bytes per slot if needed.
+        """
+        if shared_memory is None:
+            raise RuntimeError("multiprocessing.shared_memory is not available")
+
+        try:
+            return cls(_open_segment(name, create=False))
+        except FileNotFoundError:
+            pass
+
+        try:
+            shm = _open_segment(name, create=True, size=CONTROL_SIZE + SLOTS * capacity)
+        except FileExistsError:  # another worker created it first
+            return cls(_open_segment(name, create=False))
+
+        _CONTROL.pack_into(shm.buf, 0, MAGIC, 0, 0, capacity, 0, 0, 0, 0)
+        print(f"Created shared theta segment {name} ({SLOTS} x {capacity} bytes)")
+        return cls(shm)
+
+    # ---------------- CONTROL BLOCK ----------------
+
+    def _control(self):
+        _, active, _, _, seq0, seq1, len0, len1 = _CONTROL.unpack_from(self.shm.buf, 0)
+        return active, (seq0, seq1), (len0, len1)
+
+    def _slot_offset(self, slot):
+        return CONTROL_SIZE + slot * self.capacity
+
+    def _set(self, field, value):
+        offsets = {"active": 8, "seq0": 24, "seq1": 32, "len0": 40, "len1": 48}
+        fmt = "<I" if field == "active" else "<Q"
+        struct.pack_into(fmt, self.shm.buf, offsets[field], value)
+
+    # ---------------- READER ----------------
+
+    def snapshot(self):
+        """
+        (slot, seq, memoryview) of the active slot, or None if nothing has
+        been published yet. Check valid(slot, seq) after using the view.
+        """
+        active, seqs, lengths = self._control()
+        seq = seqs[active]
+        if seq == 0 or seq % 2:
+            return None
+        start = self._slot_offset(active)
+        return active, seq, self.shm.buf[start:start + lengths[active]]
+
+    def valid(self, slot, seq):
+        """
+        True while the slot still holds what snapshot() returned.
+        """
+        return self._control()[1][slot] == seq
+
+    def current(self, slot, seq):
+        """
+        True if (slot, seq) is still the newest published copy.
+        """
+        active, seqs, _ = self._control()
+        return active == slot and seqs[slot] == seq
+
+    # ---------------- WRITER ----------------
+
+    def publish(self, data):
+        """
+        Copy a theta file image into the inactive slot and make it active.
+        Callers must serialize publishes (ThetaStore.save holds the file lock).
+        Returns False if data does not fit.
+        """
+        if len(data) > self.capacity:
+            print(
+                f"Theta image ({len(data)} bytes) exceeds shared slot capacity "
+                f"({self.capacity} bytes); raise RL_THETA_SHM_BYTES"
+            )
+            return False
+
+        active, seqs, _ = self._control()
+        slot = 1 - active
+        seq = seqs[slot]
+        start = self._slot_offset(slot)
+
+        self._set(f"seq{slot}", seq + 1)     # odd: readers of this slot retry
+        self.shm.buf[start:start + len(data)] = data
+        self._set(f"len{slot}", len(data))
+        self._set(f"seq{slot}", seq + 2)
+        self._set("active", slot)
+        return True
@@ -0,0 +1,156 @@
+import threading
+
+import pytest
+
+from job_store import JobStore
+
+
+class Backend:
+    """
+    Records every write; fails the next `fail` calls of insert or finish.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.fail = {"insert": 0, "finish": 0}
+        self.before = None   # called at the start of every write
+
+    def _call(self, name, *args):
+        if self.before is not None:
+            self.before(name, *args)
+        if self.fail[name]:
+            self.fail[name] -= 1
+            raise RuntimeError(f"{name} unavailable")
+        self.calls.append((name, *args))
+
+    def insert(self, rows):
+        self._call("insert", rows)
+
+    def finish(self, worker, rows):
+        self._call("finish", worker, rows)
+
+
+@pytest.fixture
+def backend():
+    return Backend()
+
+
+@pytest.fixture
+def store(backend, clock):
+    return JobStore(backend.insert, backend.finish, flush_interval=5.0, max_pending=10, clock=clock)
+
+
+def test_buffers_until_full(store, backend):
+    for i in range(9):
+        store.add_job({"job_id": f"reward_{i}"})
+    assert backend.calls == []
+
+    store.add_job({"job_id": "reward_9"})
+    assert len(backend.calls) == 1
+    name, rows = backend.calls[0]
+    assert name == "insert"
+    assert [row["job_id"] for row in rows] == [f"reward_{i}" for i in range(10)]
+    assert store.stats()["pending_jobs"] == 0
+
+
+def test_duplicate_job_ids_are_written_once(store, backend):
+    store.add_job({"job_id": "reward_1", "payload": {"n": 1}})
+    store.add_job({"job_id": "reward_1", "payload": {"n": 2}})
+    assert store.flush() == 1
+    assert backend.calls == [("insert", [{"job_id": "reward_1", "payload": {"n": 2}}])]
+
+
+def test_flush_if_due_waits_for_the_interval(store, backend, clock):
+    store.transition("w1", "reward_1", {"status": "completed"})
+    clock.now = 4.9
+    assert store.flush_if_due() == 0
+    assert backend.calls == []
+
+    clock.now = 5.0
+    assert store.flush_if_due() == 1
+    assert backend.calls == [("finish", "w1", [{"job_id": "reward_1", "status": "completed"}])]
+
+    # Nothing pending: the age restarts with the next entry
+    clock.now = 100.0
+    assert store.flush_if_due() == 0
+
+
+def test_jobs_are_written_before_transitions(store, backend):
+    store.transition("w1", "content_gen_1", {"status": "completed"})
+    store.add_job({"job_id": "reward_1"})
+    store.flush()
+    assert [call[0] for call in backend.calls] == ["insert", "finish"]
+
+
+def test_latest_transition_wins_per_worker(store, backend):
+    store.transition("w1", "reward_1", {"status": "failed", "error": "timeout"})
+    store.transition("w1", "reward_1", {"status": "completed"})
+    store.transition("w2", "reward_2", {"status": "completed"})
+    assert store.flush() == 2
+    assert sorted(backend.calls) == [
+        ("finish", "w1", [{"job_id": "reward_1", "status": "completed"}]),
+        ("finish", "w2", [{"job_id": "reward_2", "status": "completed"}])
+    ]
+
+
+def test_failed_flush_keeps_everything_buffered(store, backend, clock):
+    store.add_job({"job_id": "reward_1"})
+    store.transition("w1", "content_gen_1", {"status": "completed"})
+    backend.fail["insert"] = 1
+
+    clock.now = 1.0
+    assert store.flush() == 0
+    assert backend.calls == []
+    assert store.stats()["pending_jobs"] == 1
+    assert store.stats()["pending_transitions"] == 1
+    assert store.stats()["flush_errors"] == 1
+
+    # Retried one interval after the failed attempt
+    clock.now = 5.5
+    assert store.flush_if_due() == 0
+    clock.now = 6.0
+    assert store.flush_if_due() == 2
+    assert [call[0] for call in backend.calls] == ["insert", "finish"]
+    assert store.stats()["pending_jobs"] == store.stats()["pending_transitions"] == 0
+
+
+def test_failed_transitions_do_not_rewrite_jobs(store, backend):
+    store.add_job({"job_id": "reward_1"})
+    store.transition("w1", "content_gen_1", {"status": "completed"})
+    backend.fail["finish"] = 1
+
+    assert store.flush() == 1
+    assert store.stats()["pending_jobs"] == 0
+    assert store.stats()["pending_transitions"] == 1
+
+    assert store.flush() == 1
+    assert [call[0] for call in backend.calls] == ["insert", "finish"]
+
+
+def test_a_transition_queued_during_a_failure_is_not_lost(store, backend):
+    store.transition("w1", "reward_1", {"status": "completed"})
+    backend.fail["finish"] = 1
+    store.flush()
+
+    store.transition("w1", "reward_2", {"status": "completed"})
+    assert store.flush() == 2
+    assert sorted(row["job_id"] for row in backend.calls[0][2]) == ["reward_1", "reward_2"]
+
+
+def test_buffering_does_not_wait_for_a_flush_in_flight(store, backend):
+    def buffer_newer(*_):
+        # Another thread buffers a newer transition while this write is on the wire
+        other = threading.Thread(target=store.transition, args=("w1", "reward_1", {"status": "failed"}))
+        other.start()
+        other.join(timeout=5)
+        assert not other.is_alive()
+
+    store.transition("w1", "reward_1", {"status": "completed"})
+    backend.fail["finish"] = 1
+    backend.before = buffer_newer
+    assert store.flush() == 0
+
+    # The failed transition is merged back, but the newer one wins
+    backend.before = None
+    assert store.flush() == 1
+    assert backend.calls == [("finish", "w1", [{"job_id": "reward_1", "status": "failed"}])]
@@ -0,0 +1,143 @@
+import numpy as np
+import pytest
+
+from lowrank_policy import LowRankPolicy
+
+ACTION_SPACE = {"TONE": ["friendly", "witty", "formal"], "HOOK_TYPE": ["question", "statistic"]}
+DIM = 32
+RANK = 4
+
+
+def policy(tmp_path, action_space=ACTION_SPACE, rank=RANK, **kwargs):
+    return LowRankPolicy(str(tmp_path / "lowrank.npz"), action_space, DIM, rank=rank, **kwargs)
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(3)
+
+
+def trained(tmp_path, rng):
+    model = policy(tmp_path)
+    ctx = rng.standard_normal((6, DIM)).astype(np.float32)
+    model.load()
+    # E starts at zero; give every value an embedding first
+    for dim, values in ACTION_SPACE.items():
+        model.E[dim] += rng.standard_normal((len(values), RANK)).astype(np.float32)
+    model.scatter_add("TONE", np.array([0, 2, 2, 1, 0, 2]), rng.standard_normal(6).astype(np.float32), ctx)
+    return model
+
+
+def test_scores_are_the_factorized_product(tmp_path, rng):
+    model = trained(tmp_path, rng)
+    ctx = rng.standard_normal((5, DIM)).astype(np.float32)
+    for dim in ACTION_SPACE:
+        np.testing.assert_allclose(model.scores(dim, ctx), (ctx @ model.W) @ model.E[dim].T, rtol=1e-5, atol=1e-6)
+
+
+def test_scatter_add_matches_the_reinforce_step(tmp_path, rng):
+    model = trained(tmp_path, rng)
+    W, E = model.W.copy(), model.E["TONE"].copy()
+    rows = np.array([1, 1, 0])
+    coefs = np.array([0.5, -0.2, 0.3], dtype=np.float32)
+    ctx = rng.standard_normal((3, DIM)).astype(np.float32)
+
+    expected_W, expected_E = W.copy(), E.copy()
+    for row, coef, x in zip(rows, coefs, ctx):
+        expected_E[row] += coef * (x @ W)
+        expected_W += coef * np.outer(x, E[row])
+
+    before = model.scores("TONE", ctx)
+    model.scatter_add("TONE", rows, coefs, ctx)
+    np.testing.assert_allclose(model.W, expected_W, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(model.E["TONE"], expected_E, rtol=1e-5, atol=1e-6)
+    # The cached context factors are not reused after an update
+    assert not np.allclose(model.scores("TONE", ctx), before)
+
+
+def test_save_load_round_trip(tmp_path, rng):
+    model = trained(tmp_path, rng)
+    model.meta = {"cursor": 7}
+    model.save()
+    assert not model.dirty
+
+    loaded = policy(tmp_path)
+    ctx = rng.standard_normal((2, DIM)).astype(np.float32)
+    np.testing.assert_allclose(loaded.scores("TONE", ctx), model.scores("TONE", ctx), rtol=1e-6)
+    assert loaded.version == 1
+    assert loaded.meta == {"cursor": 7}
+
+
+def test_overlapping_saves_keep_both_updates(tmp_path, rng):
+    trained(tmp_path, rng).save()
+    first, second = policy(tmp_path), policy(tmp_path)
+    first.load()
+    second.load()
+    base = first.W.copy()
+    ctx = rng.standard_normal((1, DIM)).astype(np.float32)
+    first.scatter_add("TONE", np.array([0]), np.array([1.0], dtype=np.float32), ctx)
+    second.scatter_add("TONE", np.array([1]), np.array([1.0], dtype=np.float32), ctx)
+    first_delta, second_delta = first.W - base, second.W - base
+    first.save()
+    second.save()
+
+    merged = policy(tmp_path)
+    merged.load()
+    np.testing.assert_allclose(merged.W, base + first_delta + second_delta, rtol=1e-5, atol=1e-6)
+    assert merged.version == 3
+
+
+def test_load_follows_saves_by_other_processes(tmp_path, rng):
+    reader = policy(tmp_path)
+    reader.load()
+    writer = trained(tmp_path, rng)
+    writer.save()
+
+    ctx = rng.standard_normal((2, DIM)).astype(np.float32)
+    assert not reader.scores("TONE", ctx).any()
+    reader.load()
+    assert reader.version == 1
+    np.testing.assert_allclose(reader.scores("TONE", ctx), writer.scores("TONE", ctx), rtol=1e-6)
+
+
+def test_new_values_start_at_the_mean_embedding(tmp_path, rng):
+    model = trained(tmp_path, rng)
+    model.save()
+
+    grown = policy(tmp_path, action_space={**ACTION_SPACE, "TONE": ACTION_SPACE["TONE"] + ["bold"]})
+    grown.load()
+    np.testing.assert_allclose(grown.E["TONE"][3], model.E["TONE"].mean(axis=0), rtol=1e-6)
+    np.testing.assert_allclose(grown.E["TONE"][:3], model.E["TONE"])
+
+
+def test_mismatched_shape_is_rejected(tmp_path, rng):
+    trained(tmp_path, rng).save()
+    with pytest.raises(ValueError):
+        policy(tmp_path, rank=RANK * 2).load()
+    with pytest.raises(ValueError):
+        policy(tmp_path, projection="random:32:0").load()
+
+
+def test_rl_updates_raise_the_chosen_score(tmp_path, rng, monkeypatch):
+    import db
+    import rl_agent
+
+    model = LowRankPolicy(str(tmp_path / "agent.npz"), rl_agent.ACTION_SPACE, rl_agent.EMBEDDING_DIM, rank=RANK)
+    monkeypatch.setattr(rl_agent, "theta", model)
+    monkeypatch.setattr(db, "queue_preference_updates", lambda updates: None)
+    half = rl_agent.EMBEDDING_DIM // 2
+    context = {
+        "platform": "instagram", "time_bucket": "morning",
+        "business_embedding": rng.standard_normal(half).astype(np.float32),
+        "topic_embedding": rng.standard_normal(half).astype(np.float32)
+    }
+    ctx = rl_agent.policy_vector(context)[None, :]
+    action = {dim: values[0] for dim, values in rl_agent.ACTION_SPACE.items()}
+
+    for _ in range(3):
+        rl_agent.update_rl(context, action, ctx[0], reward=1.0, baseline=0.0)
+
+    for dim in rl_agent.ACTION_SPACE:
+        scores = model.scores(dim, ctx)[0]
+        assert scores[0] == scores.max() and scores[0] > 0
+    assert model.version == 3
@@ -0,0 +1,155 @@
+import numpy as np
+import pytest
+
+import rl_agent
+from off_policy_eval import DIMENSIONS, Estimate, accumulate
+
+
+def uniform(dim):
+    return 1.0 / len(rl_agent.ACTION_SPACE[dim])
+
+
+def logged_samples(rng, n):
+    """
+    Samples logged by a uniform policy, with their rewards.
+    """
+    samples = []
+    for _ in range(n):
+        action = {dim: values[rng.integers(len(values))] for dim, values in rl_agent.ACTION_SPACE.items()}
+        samples.append({
+            "action": action,
+            "propensity": {dim: uniform(dim) for dim in DIMENSIONS},
+            "reward": float(rng.random())
+        })
+    return samples
+
+
+def policy(n, probs):
+    return {dim: np.tile(probs[dim], (n, 1)) for dim in DIMENSIONS}
+
+
+def uniform_policy(n):
+    return policy(n, {dim: np.full(len(rl_agent.ACTION_SPACE[dim]), uniform(dim)) for dim in DIMENSIONS})
+
+
+def zero_model():
+    return {dim: np.zeros(len(rl_agent.ACTION_SPACE[dim])) for dim in DIMENSIONS}
+
+
+def estimates():
+    return {dim: Estimate() for dim in DIMENSIONS + ["ALL"]}
+
+
+def test_estimate_by_hand():
+    est = Estimate()
+    w = np.array([2.0, 0.5, 0.0])
+    r = np.array([1.0, 0.4, 0.7])
+    est.add(w, r, q_logged=np.array([0.5, 0.5, 0.5]), q_policy=np.array([0.6, 0.6, 0.6]))
+    report = est.report()
+
+    assert report["n"] == 3
+    assert report["logged"] == pytest.approx(0.7)
+    assert report["ips"] == pytest.approx((2.0 + 0.2) / 3)
+    assert report["snips"] == pytest.approx(2.2 / 2.5)
+    assert report["dr"] == pytest.approx((0.6 + 2.0 * 0.5 + 0.6 + 0.5 * -0.1 + 0.6) / 3)
+    assert report["ess"] == pytest.approx(2.5 ** 2 / 4.25)
+    assert report["max_w"] == 2.0
+
+
+def test_empty_estimate():
+    assert Estimate().report() == {"n": 0}
+
+
+def test_logging_policy_estimates_its_own_reward():
+    rng = np.random.default_rng(3)
+    samples = logged_samples(rng, 50)
+    est = estimates()
+    accumulate(est, samples, uniform_policy(50), zero_model())
+
+    logged = np.mean([s["reward"] for s in samples])
+    for report in (est[dim].report() for dim in DIMENSIONS + ["ALL"]):
+        assert report["n"] == 50
+        assert report["ips"] == pytest.approx(logged)
+        assert report["snips"] == pytest.approx(logged)
+        assert report["dr"] == pytest.approx(logged)
+        assert report["ess"] == pytest.approx(50)
+
+
+def test_deterministic_policy_reweights_matching_samples():
+    rng = np.random.default_rng(5)
+    samples = logged_samples(rng, 200)
+    dim = DIMENSIONS[0]
+    first = rl_agent.ACTION_SPACE[dim][0]
+    probs = uniform_policy(200)
+    probs[dim] = np.zeros_like(probs[dim])
+    probs[dim][:, 0] = 1.0
+
+    est = estimates()
+    accumulate(est, samples, probs, zero_model())
+
+    matching = [s["reward"] for s in samples if s["action"][dim] == first]
+    report = est[dim].report()
+    assert report["ips"] == pytest.approx(sum(matching) / uniform(dim) / 200)
+    assert report["snips"] == pytest.approx(np.mean(matching))
+    assert report["max_w"] == pytest.approx(1 / uniform(dim))
+
+
+def test_dr_uses_the_reward_model():
+    rng = np.random.default_rng(11)
+    samples = logged_samples(rng, 30)
+    model = {dim: np.full(len(rl_agent.ACTION_SPACE[dim]), 0.25) for dim in DIMENSIONS}
+
+    est = estimates()
+    accumulate(est, samples, uniform_policy(30), model)
+    # Exact weights: the model term cancels out of DR
+    assert est[DIMENSIONS[0]].report()["dr"] == pytest.approx(np.mean([s["reward"] for s in samples]))
+
+
+def test_joint_dr_averages_the_per_dimension_models():
+    rng = np.random.default_rng(19)
+    samples = logged_samples(rng, 20)
+    model = {dim: rng.random(len(rl_agent.ACTION_SPACE[dim])) for dim in DIMENSIONS}
+    dim = DIMENSIONS[0]
+    probs = uniform_policy(20)
+    probs[dim] = np.zeros_like(probs[dim])
+    probs[dim][:, 0] = 1.0
+
+    est = estimates()
+    accumulate(est, samples, probs, model)
+
+    expected = []
+    for s in samples:
+        q_logged = np.mean([model[d][rl_agent.ACTION_INDEX[d][s["action"][d]]] for d in DIMENSIONS])
+        q_policy = np.mean([probs[d][0] @ model[d] for d in DIMENSIONS])
+        w = (s["action"][dim] == rl_agent.ACTION_SPACE[dim][0]) / uniform(dim)
+        expected.append(q_policy + w * (s["reward"] - q_logged))
+    assert est["ALL"].report()["dr"] == pytest.approx(np.mean(expected))
+
+
+def test_clip_caps_weights():
+    rng = np.random.default_rng(13)
+    samples = logged_samples(rng, 40)
+    dim = DIMENSIONS[0]
+    probs = uniform_policy(40)
+    probs[dim] = np.zeros_like(probs[dim])
+    probs[dim][:, 0] = 1.0
+
+    est = estimates()
+    accumulate(est, samples, probs, zero_model(), clip=1.5)
+    assert est[dim].report()["max_w"] == pytest.approx(min(1.5, 1 / uniform(dim)))
+    assert est["ALL"].report()["max_w"] <= 1.5
+
+
+def test_samples_without_propensity_are_left_out():
+    rng = np.random.default_rng(17)
+    samples = logged_samples(rng, 10)
+    dim = DIMENSIONS[0]
+    samples[0]["propensity"] = None
+    samples[1]["propensity"] = {d: p for d, p in samples[1]["propensity"].items() if d != dim}
+    samples[2]["action"] = {**samples[2]["action"], dim: "no longer in the action space"}
+
+    est = estimates()
+    accumulate(est, samples, uniform_policy(10), zero_model())
+    assert est[dim].report()["n"] == 7
+    assert est[DIMENSIONS[1]].report()["n"] == 9
+    assert est["ALL"].report()["n"] == 7
@@ -0,0 +1,185 @@
+import threading
+
+import pytest
+
+from preference_cache import GLOBAL_SEGMENT, PreferenceCache
+
+
+class Backend:
+    """
+    rl_preferences rows per (platform, time_bucket); flush() adds the deltas
+    like rl_increment_preferences does, or fails while `down` is set.
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.fetches = 0
+        self.flushed = []
+        self.down = False
+
+    def fetch(self, platform, time_bucket):
+        self.fetches += 1
+        if self.down:
+            raise RuntimeError("database unavailable")
+        return [dict(row) for row in self.rows.get((platform, time_bucket), [])]
+
+    def flush(self, updates):
+        if self.down:
+            raise RuntimeError("database unavailable")
+        self.flushed.append(updates)
+        for u in updates:
+            rows = self.rows.setdefault((u["platform"], u["time_bucket"]), [])
+            row = next((
+                r for r in rows
+                if (r["segment"], r["dimension"], r["action_value"]) == (u["segment"], u["dimension"], u["action_value"])
+            ), None)
+            if row is None:
+                row = {"segment": u["segment"], "dimension": u["dimension"], "action_value": u["action_value"],
+                       "preference_score": 0.0, "num_samples": 0}
+                rows.append(row)
+            row["preference_score"] += u["delta"]
+            row["num_samples"] += u["samples"]
+            row["updated_at"] = f"v{len(self.flushed)}"
+
+
+def delta(value, amount, segment=GLOBAL_SEGMENT, samples=1):
+    return {"segment": segment, "platform": "instagram", "time_bucket": "morning",
+            "dimension": "TONE", "action_value": value, "delta": amount, "samples": samples}
+
+
+@pytest.fixture
+def backend():
+    backend = Backend()
+    backend.rows[("instagram", "morning")] = [
+        {"segment": GLOBAL_SEGMENT, "dimension": "TONE", "action_value": "friendly",
+         "preference_score": 0.5, "num_samples": 40, "updated_at": "v0"},
+        {"segment": 3, "dimension": "TONE", "action_value": "friendly",
+         "preference_score": 0.9, "num_samples": 25, "updated_at": "v0"},
+        {"segment": 4, "dimension": "TONE", "action_value": "friendly",
+         "preference_score": -0.9, "num_samples": 5, "updated_at": "v0"}
+    ]
+    return backend
+
+
+@pytest.fixture
+def cache(backend, clock):
+    return PreferenceCache(backend.fetch, backend.flush, ttl=60.0, flush_interval=30.0,
+                           max_pending=100, min_segment_samples=20, clock=clock)
+
+
+def test_reads_are_cached_until_the_ttl(cache, backend, clock):
+    assert cache.get("instagram", "morning") == {("TONE", "friendly"): 0.5}
+    clock.now = 59.0
+    cache.get("instagram", "morning")
+    assert backend.fetches == 1
+
+    clock.now = 60.0
+    cache.get("instagram", "morning")
+    assert backend.fetches == 2
+    assert cache.stats()["hits"] == 1
+
+
+def test_segments_fall_back_to_global_below_min_samples(cache):
+    assert cache.get("instagram", "morning", segment=3) == {("TONE", "friendly"): 0.9}
+    assert cache.get("instagram", "morning", segment=4) == {("TONE", "friendly"): 0.5}
+
+
+def test_reads_see_buffered_writes(cache, backend):
+    cache.get("instagram", "morning")
+    cache.add([delta("friendly", 0.25), delta("witty", -0.1)])
+
+    assert backend.flushed == []
+    assert cache.get("instagram", "morning") == pytest.approx({("TONE", "friendly"): 0.75, ("TONE", "witty"): -0.1})
+
+
+def test_a_refetch_keeps_unwritten_deltas(cache, clock):
+    cache.add([delta("friendly", 0.25)])
+    clock.now = 10.0
+    cache.invalidate()
+    assert cache.get("instagram", "morning")[("TONE", "friendly")] == pytest.approx(0.75)
+
+
+def test_version_is_pending_until_flushed(cache, backend):
+    assert cache.version("instagram", "morning") == "v0"
+    cache.add([delta("friendly", 0.25)])
+    assert cache.version("instagram", "morning") == "pending"
+
+    assert cache.flush() == 1
+    # The flushed entry is dropped, so the new database version is read
+    assert cache.version("instagram", "morning") == "v1"
+    assert cache.get("instagram", "morning")[("TONE", "friendly")] == pytest.approx(0.75)
+
+
+def test_deltas_are_merged_per_key(cache, backend):
+    cache.add([delta("friendly", 0.25), delta("friendly", 0.5, samples=2)])
+    cache.flush()
+    assert backend.flushed == [[delta("friendly", 0.75, samples=3)]]
+
+
+def test_flushes_when_the_buffer_is_old_or_full(backend, clock):
+    cache = PreferenceCache(backend.fetch, backend.flush, flush_interval=30.0, max_pending=2, clock=clock)
+    cache.add([delta("friendly", 0.1)])
+    assert backend.flushed == []
+
+    cache.add([delta("witty", 0.1)])
+    assert len(backend.flushed) == 1
+
+    cache.add([delta("friendly", 0.1)])
+    clock.now = 30.0
+    cache.add([delta("friendly", 0.1)])
+    assert len(backend.flushed) == 2
+
+
+def test_failed_flush_keeps_deltas_buffered(cache, backend):
+    cache.add([delta("friendly", 0.25)])
+    backend.down = True
+    assert cache.flush() == 0
+    assert cache.stats()["pending"] == 1
+    assert cache.stats()["flush_errors"] == 1
+
+    cache.add([delta("friendly", 0.5)])
+    backend.down = False
+    assert cache.flush() == 1
+    assert backend.flushed[-1][0]["delta"] == pytest.approx(0.75)
+    assert backend.flushed[-1][0]["samples"] == 2
+
+
+def test_stale_entry_beats_a_failed_fetch(cache, backend, clock):
+    cache.get("instagram", "morning")
+    backend.down = True
+    clock.now = 120.0
+    assert cache.get("instagram", "morning") == {("TONE", "friendly"): 0.5}
+    assert cache.get("facebook", "evening") == {}
+    assert cache.stats()["fetch_errors"] == 2
+
+
+def in_thread(func, *args):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(func(*args)))
+    thread.start()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    return result[0]
+
+
+def test_reads_and_writes_do_not_wait_for_a_flush_in_flight(backend, clock):
+    seen = []
+
+    def flush(updates):
+        if seen:
+            return backend.flush(updates)
+        # Other threads read and buffer while this write is on the wire
+        seen.append(in_thread(cache.version, "instagram", "morning"))
+        seen.append(in_thread(cache.get, "instagram", "morning"))
+        in_thread(cache.add, [delta("friendly", 0.5)])
+        raise RuntimeError("database unavailable")
+
+    cache = PreferenceCache(backend.fetch, flush, ttl=60.0, clock=clock)
+    cache.add([delta("friendly", 0.25)])
+    assert cache.flush() == 0
+    assert seen == ["pending", pytest.approx({("TONE", "friendly"): 0.75})]
+
+    # The failed deltas are merged with the ones buffered meanwhile
+    assert cache.flush() == 1
+    assert backend.flushed[-1][0]["delta"] == pytest.approx(0.75)
+    assert backend.flushed[-1][0]["samples"] == 2
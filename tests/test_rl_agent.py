@@ -0,0 +1,344 @@
+import math
+
+import numpy as np
+import pytest
+
+import db
+import rl_agent
+from theta_store import ThetaStore
+
+HALF = rl_agent.EMBEDDING_DIM // 2
+
+
+def make_context(rng, platform="instagram", time_bucket="morning"):
+    return {
+        "platform": platform,
+        "time_bucket": time_bucket,
+        "business_embedding": rng.standard_normal(HALF).astype(np.float32),
+        "topic_embedding": rng.standard_normal(HALF).astype(np.float32)
+    }
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(1)
+
+
+@pytest.fixture
+def prefs(rng, monkeypatch):
+    """
+    Different preferences per (platform, time_bucket).
+    """
+    prefs = {}
+
+    def get_preferences_batch(platform, time_bucket, segment=None):
+        if (platform, time_bucket) not in prefs:
+            prefs[(platform, time_bucket)] = {
+                (dim, value): float(rng.standard_normal())
+                for dim, values in rl_agent.ACTION_SPACE.items()
+                for value in values[::2]
+            }
+        return prefs[(platform, time_bucket)]
+
+    monkeypatch.setattr(db, "get_preferences_batch", get_preferences_batch)
+    return get_preferences_batch
+
+
+@pytest.fixture
+def theta(tmp_path, monkeypatch):
+    theta = ThetaStore(str(tmp_path / "theta.bin"), rl_agent.ACTION_SPACE, rl_agent.EMBEDDING_DIM)
+    monkeypatch.setattr(rl_agent, "theta", theta)
+    return theta
+
+
+def randomize(theta, rng):
+    """
+    Write a random row for every value; returns the dense rows per dimension.
+    """
+    dense = {}
+    for dim, values in rl_agent.ACTION_SPACE.items():
+        dense[dim] = (0.01 * rng.standard_normal((len(values), rl_agent.EMBEDDING_DIM))).astype(np.float32)
+        for row in range(len(values)):
+            theta.add(dim, row, dense[dim][row])
+    return dense
+
+
+def dense(theta, dim):
+    """
+    theta[dim] as a (num_values x EMBEDDING_DIM) matrix, zeros for rows never written.
+    """
+    return theta.scores(dim, np.eye(rl_agent.EMBEDDING_DIM, dtype=np.float32)).T
+
+
+@pytest.fixture
+def written(monkeypatch):
+    """
+    Every preference delta queued, as db.update_preferences_batch rows.
+    """
+    written = []
+    monkeypatch.setattr(db, "queue_preference_updates", written.extend)
+    return written
+
+
+def summed(rows):
+    totals = {}
+    for row in rows:
+        key = (row["platform"], row["time_bucket"], row["dimension"], row["action_value"])
+        delta, samples = totals.get(key, (0.0, 0))
+        totals[key] = (delta + row["delta"], samples + row["samples"])
+    return totals
+
+
+@pytest.fixture
+def drawn(monkeypatch):
+    """
+    Probabilities (softmax of the scores) handed to the sampler, one
+    matrix per dimension; always picks value 0.
+    """
+    drawn = []
+
+    def sample_gumbel_max(scores, noise):
+        drawn.append(rl_agent.softmax(scores))
+        return np.zeros(len(scores), dtype=np.intp)
+
+    monkeypatch.setattr(rl_agent, "sample_gumbel_max", sample_gumbel_max)
+    return drawn
+
+
+def reference_probs(context, prefs, rows, dim):
+    """
+    The pre-vectorized path: one dot product per value, Python softmax.
+    """
+    ctx = np.concatenate([context["business_embedding"], context["topic_embedding"]])
+    all_prefs = prefs(context["platform"], context["time_bucket"])
+    scores = [
+        all_prefs.get((dim, v), 0.0) + float(np.dot(rows[dim][i].astype(np.float64), ctx))
+        for i, v in enumerate(rl_agent.ACTION_SPACE[dim])
+    ]
+    top = max(scores)
+    exp = [math.exp(s - top) for s in scores]
+    return [e / sum(exp) for e in exp]
+
+
+def test_scores_match_per_value_dot_products(rng, prefs, theta, drawn):
+    rows = randomize(theta, rng)
+    context = make_context(rng)
+    action, ctx_vec, propensity = rl_agent.select_action(context)
+
+    np.testing.assert_array_equal(ctx_vec, rl_agent.build_context_vector(context))
+    for dim, probs in zip(rl_agent.ACTION_SPACE, drawn):
+        np.testing.assert_allclose(probs[0], reference_probs(context, prefs, rows, dim), rtol=1e-4, atol=1e-7)
+        assert action[dim] == rl_agent.ACTION_SPACE[dim][0]
+        assert propensity[dim] == pytest.approx(probs[0][0])
+
+
+def test_batch_scores_every_context_like_a_single_one(rng, prefs, theta, drawn):
+    rows = randomize(theta, rng)
+    contexts = [
+        make_context(rng, platform, time_bucket)
+        for platform, time_bucket in [("instagram", "morning"), ("facebook", "evening"), ("instagram", "morning")]
+    ]
+    results = rl_agent.select_actions_batch(contexts)
+
+    assert len(results) == 3
+    for dim, probs in zip(rl_agent.ACTION_SPACE, drawn):
+        assert probs.shape == (3, len(rl_agent.ACTION_SPACE[dim]))
+        for i, context in enumerate(contexts):
+            np.testing.assert_allclose(probs[i], reference_probs(context, prefs, rows, dim), rtol=1e-4, atol=1e-7)
+    for (_, ctx_vec, _), context in zip(results, contexts):
+        np.testing.assert_array_equal(ctx_vec, rl_agent.build_context_vector(context))
+
+
+def test_batch_fetches_preferences_once_per_group(rng, theta, monkeypatch):
+    fetched = []
+    monkeypatch.setattr(db, "get_preferences_batch", lambda platform, time_bucket, segment=None: fetched.append((platform, time_bucket)) or {})
+    contexts = [make_context(rng, "instagram", "morning") for _ in range(4)] + [make_context(rng, "facebook", "morning")]
+    rl_agent.select_actions_batch(contexts)
+    assert sorted(fetched) == [("facebook", "morning"), ("instagram", "morning")]
+
+
+def test_gumbel_max_draws_from_the_softmax():
+    scores = np.array([[0.0, 1.0, -1.0]])
+    rng = np.random.default_rng(0)
+    choices = [int(rl_agent.sample_gumbel_max(scores, rng.gumbel(size=(1, 3)))[0]) for _ in range(20000)]
+    np.testing.assert_allclose(np.bincount(choices, minlength=3) / 20000, rl_agent.softmax(scores)[0], atol=0.01)
+
+
+def test_seeded_selection_replays_exactly(rng, prefs, theta):
+    rows = randomize(theta, rng)
+    context = make_context(rng)
+
+    action, _, propensity = rl_agent.select_action(context, "instagram_1234abcd")
+    assert rl_agent.select_action(context, "instagram_1234abcd")[0] == action
+
+    for dim, values in rl_agent.ACTION_SPACE.items():
+        probs = reference_probs(context, prefs, rows, dim)
+        # The logged propensity is the probability of the logged value
+        assert propensity[dim] == pytest.approx(probs[values.index(action[dim])], rel=1e-4)
+        # ...and the decision can be re-drawn from the scores alone
+        scores = np.log(probs)
+        assert rl_agent.replay_choice("instagram_1234abcd", dim, scores) == action[dim]
+
+
+def test_post_ids_seed_independent_decisions(rng, prefs, theta):
+    context = make_context(rng)
+    actions = [rl_agent.select_action(context, f"post_{i}")[0]["HOOK_TYPE"] for i in range(50)]
+    # Uniform over 20 hooks: 50 seeded draws are not all the same
+    assert len(set(actions)) > 1
+    # A batch draws each row with its own post_id's noise
+    batch = rl_agent.select_actions_batch([context] * 5, [f"post_{i}" for i in range(5)])
+    assert [a["HOOK_TYPE"] for a, _, _ in batch] == actions[:5]
+
+
+def test_update_rl_moves_only_the_chosen_rows(rng, theta, written):
+    context = make_context(rng)
+    action = {dim: values[1] for dim, values in rl_agent.ACTION_SPACE.items()}
+    ctx_vec = rl_agent.build_context_vector(context)
+
+    rl_agent.update_rl(context, action, ctx_vec, reward=0.8, baseline=0.3)
+
+    # Saved, so a fresh store sees the update
+    reloaded = ThetaStore(theta.path, rl_agent.ACTION_SPACE, rl_agent.EMBEDDING_DIM)
+    for dim in rl_agent.ACTION_SPACE:
+        rows = dense(reloaded, dim)
+        np.testing.assert_allclose(rows[1], 0.01 * 0.5 * ctx_vec, rtol=1e-5)
+        assert not rows[0].any()
+    # Only the written rows exist
+    assert reloaded.resident_rows() == len(rl_agent.ACTION_SPACE)
+    assert sorted(w["dimension"] for w in written) == sorted(rl_agent.ACTION_SPACE)
+    assert all(w["delta"] == pytest.approx(0.05 * 0.5) and w["samples"] == 1 for w in written)
+
+
+def test_update_rl_skips_unknown_values(rng, theta, written):
+    before = randomize(theta, rng)
+    context = make_context(rng)
+
+    rl_agent.update_rl(context, {"TONE": "not a tone", "NOT_A_DIMENSION": "x"},
+                       rl_agent.build_context_vector(context), reward=1.0, baseline=0.0)
+
+    assert written == []
+    for dim in rl_agent.ACTION_SPACE:
+        np.testing.assert_allclose(dense(theta, dim), before[dim], rtol=1e-6)
+
+
+def test_update_rl_batch_equals_sequential_updates(rng, tmp_path, written, monkeypatch):
+    samples = []
+    for i in range(12):
+        context = make_context(rng, ("instagram", "facebook")[i % 2], "morning")
+        # few distinct values, so rows and preference keys repeat within the batch
+        action = {dim: values[int(rng.integers(2))] for dim, values in rl_agent.ACTION_SPACE.items()}
+        samples.append({
+            "context": context,
+            "action": action,
+            "ctx_vec": rl_agent.policy_vector(context),
+            "reward": float(rng.random()),
+            "baseline": 0.4
+        })
+
+    sequential = ThetaStore(str(tmp_path / "sequential.bin"), rl_agent.ACTION_SPACE, rl_agent.EMBEDDING_DIM)
+    monkeypatch.setattr(rl_agent, "theta", sequential)
+    for s in samples:
+        rl_agent.update_rl(s["context"], s["action"], s["ctx_vec"], s["reward"], s["baseline"])
+    sequential_prefs = summed(written)
+    written.clear()
+
+    batched = ThetaStore(str(tmp_path / "batched.bin"), rl_agent.ACTION_SPACE, rl_agent.EMBEDDING_DIM)
+    monkeypatch.setattr(rl_agent, "theta", batched)
+    rl_agent.update_rl_batch(samples)
+
+    assert batched.version == 1
+    for dim in rl_agent.ACTION_SPACE:
+        np.testing.assert_allclose(dense(batched, dim), dense(sequential, dim), rtol=1e-5, atol=1e-7)
+    assert summed(written).keys() == sequential_prefs.keys()
+    for key, (delta, count) in summed(written).items():
+        assert delta == pytest.approx(sequential_prefs[key][0])
+        assert count == sequential_prefs[key][1]
+
+
+def test_update_uses_the_stored_context_vector(rng, theta, written):
+    context = make_context(rng)
+    ctx_vec = rl_agent.policy_vector(context)
+    action = {"TONE": rl_agent.ACTION_SPACE["TONE"][0]}
+
+    # Only platform and time_bucket are needed alongside the stored vector
+    rl_agent.update_rl_batch([{
+        "context": {"platform": "instagram", "time_bucket": "morning"},
+        "action": action, "ctx_vec": ctx_vec, "reward": 1.0, "baseline": 0.0
+    }])
+    np.testing.assert_allclose(dense(theta, "TONE")[0], 0.01 * ctx_vec, rtol=1e-5)
+
+
+@pytest.fixture
+def businesses(rng, prefs, monkeypatch):
+    """
+    Two businesses on instagram and facebook, posting in the morning.
+    """
+    businesses = {f"b{i}": rng.standard_normal(rl_agent.BUSINESS_DIM).astype(np.float32) for i in range(2)}
+    monkeypatch.setattr(db, "get_all_profile_ids", lambda: list(businesses))
+    monkeypatch.setattr(db, "get_profile_embeddings", lambda ids: {b: businesses[b] for b in ids})
+    monkeypatch.setattr(db, "get_profile_scheduling_prefs", lambda b: {"time_bucket": "morning"})
+    monkeypatch.setattr(db, "get_connected_platforms", lambda b: ["instagram", "facebook"])
+    monkeypatch.setattr(db, "get_preferences_version", lambda platform, time_bucket: "v1")
+    return businesses
+
+
+def business_context(rng, businesses, business_id, platform):
+    return {
+        "platform": platform,
+        "time_bucket": "morning",
+        "business_id": business_id,
+        "business_embedding": businesses[business_id],
+        "topic_embedding": rng.standard_normal(rl_agent.TOPIC_DIM).astype(np.float32)
+    }
+
+
+def test_logit_tables_select_like_full_scoring(rng, theta, businesses, drawn, tmp_path, monkeypatch):
+    import logit_tables
+
+    randomize(theta, rng)
+    theta.save()
+    contexts = [
+        business_context(rng, businesses, business_id, platform)
+        for business_id in businesses for platform in ("instagram", "facebook")
+    ]
+    contexts.append(business_context(rng, businesses, "b0", "instagram"))
+
+    rl_agent.select_actions_batch(contexts)
+    full, drawn[:] = list(drawn), []
+
+    path = str(tmp_path / "logits.npz")
+    assert logit_tables.build_tables(path) == 4
+    monkeypatch.setattr(rl_agent, "logit_tables", logit_tables.LogitTables(path))
+    monkeypatch.setattr(db, "get_preferences_batch", lambda *args: pytest.fail("table hits need no preferences"))
+    rl_agent.select_actions_batch(contexts)
+
+    for from_tables, from_scoring in zip(drawn, full):
+        np.testing.assert_allclose(from_tables, from_scoring, rtol=1e-4, atol=1e-6)
+
+
+def test_stale_logit_tables_fall_back_to_full_scoring(rng, theta, businesses, prefs, drawn, tmp_path, monkeypatch):
+    import logit_tables
+
+    randomize(theta, rng)
+    theta.save()
+    path = str(tmp_path / "logits.npz")
+    logit_tables.build_tables(path)
+    monkeypatch.setattr(rl_agent, "logit_tables", logit_tables.LogitTables(path))
+
+    # theta moves on after the build
+    theta.add("TONE", 0, np.ones(rl_agent.EMBEDDING_DIM, dtype=np.float32))
+    theta.save()
+    rows = {dim: dense(theta, dim) for dim in rl_agent.ACTION_SPACE}
+
+    context = business_context(rng, businesses, "b1", "facebook")
+    rl_agent.select_actions_batch([context])
+    for dim, probs in zip(rl_agent.ACTION_SPACE, drawn):
+        np.testing.assert_allclose(probs[0], reference_probs(context, prefs, rows, dim), rtol=1e-4, atol=1e-7)
+
+    # ...and so does rl_preferences
+    logit_tables.build_tables(path)
+    monkeypatch.setattr(db, "get_preferences_version", lambda platform, time_bucket: "v2")
+    fetched = []
+    monkeypatch.setattr(db, "get_preferences_batch", lambda platform, time_bucket, segment=None: fetched.append(platform) or {})
+    rl_agent.select_actions_batch([context])
+    assert fetched == ["facebook"]
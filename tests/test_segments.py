@@ -0,0 +1,144 @@
+import threading
+
+import numpy as np
+import pytest
+
+import segments
+
+DIM = 8
+
+
+@pytest.fixture
+def clusters():
+    """
+    Three well separated blobs of 30 points each, with their true labels.
+    """
+    rng = np.random.default_rng(2)
+    centers = np.eye(3, DIM, dtype=np.float32) * 10
+    labels = np.repeat(np.arange(3), 30)
+    return (centers[labels] + rng.standard_normal((90, DIM))).astype(np.float32), labels
+
+
+def same_partition(a, b):
+    return len(set(zip(a.tolist(), b.tolist()))) == len(set(a.tolist())) == len(set(b.tolist()))
+
+
+def test_fit_recovers_separated_clusters(tmp_path, clusters):
+    x, truth = clusters
+    model = segments.SegmentModel(str(tmp_path / "segments.npz"))
+    labels = model.fit(x, k=3, iterations=20)
+
+    assert model.k == 3
+    assert same_partition(labels, truth)
+    np.testing.assert_array_equal(model.assign(x), labels)
+
+
+def test_fit_is_deterministic_for_a_seed(tmp_path, clusters):
+    x, _ = clusters
+    first = segments.SegmentModel(str(tmp_path / "a.npz"))
+    second = segments.SegmentModel(str(tmp_path / "b.npz"))
+    np.testing.assert_array_equal(first.fit(x, k=3, seed=5), second.fit(x, k=3, seed=5))
+    np.testing.assert_allclose(first.centroids, second.centroids)
+
+
+def test_partial_fit_nudges_the_nearest_centroid(tmp_path):
+    model = segments.SegmentModel(str(tmp_path / "segments.npz"))
+    model.centroids = np.array([[0.0, 0.0], [10.0, 10.0]], dtype=np.float32)
+    model.counts = np.array([3.0, 1.0])
+
+    labels = model.partial_fit(np.array([[1.0, 1.0]], dtype=np.float32))
+    assert labels.tolist() == [0]
+    np.testing.assert_allclose(model.centroids[0], [0.25, 0.25])
+    np.testing.assert_allclose(model.centroids[1], [10.0, 10.0])
+    assert model.counts.tolist() == [4.0, 1.0]
+
+
+def test_save_load_round_trip(tmp_path, clusters):
+    x, _ = clusters
+    model = segments.SegmentModel(str(tmp_path / "segments.npz"))
+    model.fit(x, k=3, iterations=5)
+    model.save()
+
+    loaded = segments.SegmentModel(model.path)
+    assert loaded.load()
+    assert loaded.version == 1
+    np.testing.assert_allclose(loaded.centroids, model.centroids)
+    np.testing.assert_array_equal(loaded.assign(x), model.assign(x))
+    assert not segments.SegmentModel(str(tmp_path / "missing.npz")).load()
+
+
+def test_refit_moves_segment_ids_to_a_new_generation(tmp_path, clusters):
+    x, _ = clusters
+    model = segments.SegmentModel(str(tmp_path / "segments.npz"))
+    before = [model.segment_id(label) for label in model.fit(x, k=3, iterations=5)]
+    model.save()
+
+    refit = segments.SegmentModel(model.path)
+    after = [refit.segment_id(label) for label in refit.fit(x, k=3, seed=1, iterations=5)]
+    refit.save()
+
+    assert refit.generation == 1
+    assert not set(before) & set(after)
+    assert not any(refit.current(segment) for segment in before)
+    assert all(refit.current(segment) for segment in after)
+
+    # Long-lived readers follow the refit
+    assert model.load() and model.generation == 1
+
+
+def test_read_only_assignment_is_stable(tmp_path, clusters):
+    x, truth = clusters
+    model = segments.SegmentModel(str(tmp_path / "segments.npz"))
+    model.fit(x, k=3, iterations=5)
+    model.save()
+    centroids = model.centroids.copy()
+    mtime = (tmp_path / "segments.npz").stat().st_mtime_ns
+
+    first = [model.segment_of(row) for row in x]
+    assert first == [model.segment_of(row) for row in x]
+    assert same_partition(np.array(first), truth)
+    np.testing.assert_array_equal(model.centroids, centroids)
+    assert (tmp_path / "segments.npz").stat().st_mtime_ns == mtime
+
+
+def try_lock(lock):
+    if not lock.acquire(blocking=False):
+        return False
+    lock.release()
+    return True
+
+
+def test_segmented_updates_write_global_and_segment_rows(tmp_path, monkeypatch, clusters):
+    import db
+    import rl_agent
+    from theta_store import ThetaStore
+
+    model = segments.SegmentModel(str(tmp_path / "segments.npz"))
+    model.fit(clusters[0], k=3, iterations=5)
+    model.save()
+    monkeypatch.setattr(rl_agent, "segment_model", model)
+    monkeypatch.setattr(rl_agent, "theta", ThetaStore(str(tmp_path / "theta.bin"), rl_agent.ACTION_SPACE, rl_agent.EMBEDDING_DIM))
+    locked = []
+
+    def get_business_segment(business_id):
+        # Looked up before taking policy_lock: another thread can still take it
+        other = threading.Thread(target=lambda: locked.append(not try_lock(rl_agent.policy_lock)))
+        other.start()
+        other.join()
+        return {"b1": 4}.get(business_id)
+
+    monkeypatch.setattr(db, "get_business_segment", get_business_segment)
+    written = []
+    monkeypatch.setattr(db, "queue_preference_updates", written.extend)
+
+    ctx_vec = np.ones(rl_agent.EMBEDDING_DIM, dtype=np.float32)
+    rl_agent.update_rl_batch([
+        {"context": {"platform": "instagram", "time_bucket": "morning", "business_id": business_id},
+         "action": {"TONE": "calm"}, "ctx_vec": ctx_vec, "reward": 1.0, "baseline": 0.0}
+        for business_id in ("b1", "b1", "b2")
+    ])
+
+    by_segment = {row["segment"]: row["samples"] for row in written}
+    # b2 has no segment and no embedding to assign one from: global only
+    assert by_segment == {db.GLOBAL_SEGMENT: 3, 4: 2}
+    assert locked and not any(locked)
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from sharded_theta import SHARD_OVERHEAD_BYTES, ShardedTheta
+
+ACTION_SPACE = {"TONE": ["friendly", "witty", "formal"], "HOOK_TYPE": ["question", "statistic"]}
+DIM = 8
+
+
+def shards(tmp_path, budget_bytes):
+    return ShardedTheta(str(tmp_path / "shards"), ACTION_SPACE, DIM, budget_bytes=budget_bytes)
+
+
+def update(store, key, row=0, scale=1.0):
+    ctx = np.full((1, DIM), scale, dtype=np.float32)
+    store.scatter_add(key, "TONE", np.array([row]), np.array([1.0], dtype=np.float32), ctx)
+
+
+def test_least_recently_used_shard_is_evicted(tmp_path):
+    store = shards(tmp_path, budget_bytes=2 * SHARD_OVERHEAD_BYTES)
+    store.shard("a")
+    store.shard("b")
+    store.shard("a")   # b is now least recently used
+    store.shard("c")
+
+    assert list(store._shards) == ["a", "c"]
+    assert store.stats()["evictions"] == 1
+    assert store.resident_bytes() <= store.budget_bytes
+
+
+def test_dirty_shard_is_saved_before_eviction(tmp_path):
+    store = shards(tmp_path, budget_bytes=SHARD_OVERHEAD_BYTES + DIM * 4)
+    update(store, "a", row=1, scale=0.5)
+    ctx = np.ones((1, DIM), dtype=np.float32)
+    before = store.scores("a", "TONE", ctx)
+
+    store.shard("b")
+    assert "a" not in store._shards
+    assert store.stats()["eviction_saves"] == 1
+
+    # Reloaded from its file with the update intact
+    np.testing.assert_allclose(store.scores("a", "TONE", ctx), before)
+    assert before[0, 1] == pytest.approx(0.5 * DIM)
+
+
+def test_clean_shard_is_dropped_without_a_write(tmp_path):
+    store = shards(tmp_path, budget_bytes=SHARD_OVERHEAD_BYTES)
+    store.shard("a")
+    store.shard("b")
+    assert store.stats()["evictions"] == 1
+    assert store.stats()["eviction_saves"] == 0
+    assert not (tmp_path / "shards" / "a.bin").exists()
+
+
+def test_the_shard_in_use_is_kept_over_budget(tmp_path):
+    store = shards(tmp_path, budget_bytes=1)
+    update(store, "a")
+    update(store, "a", row=2)
+    assert list(store._shards) == ["a"]
+    assert store.resident_bytes() > store.budget_bytes
+
+
+def test_growing_shard_evicts_the_others(tmp_path):
+    store = shards(tmp_path, budget_bytes=3 * SHARD_OVERHEAD_BYTES)
+    for key in ("a", "b", "c"):
+        store.shard(key)
+    assert store.stats()["evictions"] == 0
+
+    update(store, "c")   # c's rows push the total over the budget
+    assert list(store._shards) == ["b", "c"]
+
+
+def test_save_writes_every_dirty_resident_shard(tmp_path):
+    store = shards(tmp_path, budget_bytes=1 << 20)
+    update(store, "a")
+    update(store, "b/1")   # keys are sanitized into file names
+    store.save()
+
+    assert (tmp_path / "shards" / "a.bin").exists()
+    assert (tmp_path / "shards" / "b_1.bin").exists()
+    assert not store._shards["a"].dirty
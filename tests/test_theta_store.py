@@ -0,0 +1,225 @@
+import numpy as np
+import pytest
+
+from theta_store import ThetaStore, dequantize, quantize
+
+ACTION_SPACE = {"TONE": ["friendly", "witty", "formal"], "HOOK_TYPE": ["question", "statistic"]}
+DIM = 16
+
+
+def store(tmp_path, action_space=ACTION_SPACE, embedding_dim=DIM, **kwargs):
+    return ThetaStore(str(tmp_path / "theta.bin"), action_space, embedding_dim, **kwargs)
+
+
+def dense(theta, dim):
+    """
+    theta[dim] as a (num_values x embedding_dim) matrix, zeros for rows never written.
+    """
+    return theta.scores(dim, np.eye(theta.embedding_dim, dtype=np.float32)).T
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(7)
+
+
+def test_missing_file_loads_empty(tmp_path):
+    theta = store(tmp_path)
+    assert not dense(theta, "TONE").any()
+    assert theta.resident_rows() == 0
+    assert theta.version == 0
+    assert not theta.dirty
+
+
+def test_save_load_round_trip(tmp_path, rng):
+    theta = store(tmp_path)
+    tone, hook = rng.standard_normal(DIM), rng.standard_normal(DIM)
+    theta.add("TONE", 1, tone)
+    theta.add("HOOK_TYPE", 0, hook)
+    theta.save()
+    assert not theta.dirty
+
+    loaded = store(tmp_path)
+    np.testing.assert_allclose(dense(loaded, "TONE")[1], tone, rtol=1e-6)
+    np.testing.assert_allclose(dense(loaded, "HOOK_TYPE")[0], hook, rtol=1e-6)
+    assert not dense(loaded, "TONE")[0].any()
+    assert loaded.version == 1
+    # Only written rows are stored
+    assert loaded.resident_rows() == 2
+    assert loaded.resident_bytes() == 2 * DIM * 4
+
+
+def test_meta_is_persisted_without_row_changes(tmp_path):
+    theta = store(tmp_path)
+    theta.meta = {"cursor": 42}
+    theta.save()
+    assert store(tmp_path).resident_rows() == 0
+    assert not (tmp_path / "theta.bin").exists()
+
+    theta.save(force=True)
+    loaded = store(tmp_path)
+    loaded.load()
+    assert loaded.meta == {"cursor": 42}
+    assert loaded.version == 1
+
+
+def test_overlapping_saves_keep_both_updates(tmp_path):
+    first, second = store(tmp_path), store(tmp_path)
+    first.load()
+    second.load()
+    first.add("TONE", 0, np.ones(DIM))
+    second.add("TONE", 0, np.ones(DIM))
+    second.add("TONE", 2, np.ones(DIM))
+    first.save()
+    second.save()
+
+    merged = store(tmp_path)
+    np.testing.assert_allclose(dense(merged, "TONE")[:, 0], [2.0, 0.0, 1.0])
+    assert merged.version == 2
+
+
+def test_load_follows_saves_by_other_processes(tmp_path):
+    reader, writer = store(tmp_path), store(tmp_path)
+    reader.load()
+    writer.add("TONE", 1, np.ones(DIM))
+    writer.save()
+
+    # Scoring alone keeps the attached version until the next load()
+    assert not dense(reader, "TONE").any()
+    reader.load()
+    assert reader.version == 1
+    np.testing.assert_allclose(dense(reader, "TONE")[1], np.ones(DIM))
+
+    # Unsaved writes are kept rather than reloaded over
+    reader.add("TONE", 0, np.ones(DIM))
+    writer.add("TONE", 2, np.ones(DIM))
+    writer.save()
+    reader.load()
+    assert reader.version == 1
+    reader.save()
+    np.testing.assert_allclose(dense(store(tmp_path), "TONE")[:, 0], [1.0, 1.0, 1.0])
+
+
+def test_rows_follow_their_values_when_the_action_space_changes(tmp_path):
+    theta = store(tmp_path)
+    theta.add("TONE", 2, np.ones(DIM))   # "formal"
+    theta.save()
+
+    changed = store(tmp_path, action_space={"TONE": ["formal", "bold"], "HOOK_TYPE": ["question"]})
+    np.testing.assert_allclose(dense(changed, "TONE")[:, 0], [1.0, 0.0])
+
+
+def test_mismatched_embedding_dim_is_rejected(tmp_path):
+    theta = store(tmp_path)
+    theta.add("TONE", 0, np.ones(DIM))
+    theta.save()
+
+    with pytest.raises(ValueError):
+        store(tmp_path, embedding_dim=DIM * 2).load()
+
+
+def test_scatter_add_equals_one_add_per_sample(tmp_path, rng):
+    rows = np.array([2, 0, 2, 2, 1])
+    coefs = rng.standard_normal(len(rows)).astype(np.float32)
+    ctx_mat = rng.standard_normal((len(rows), DIM)).astype(np.float32)
+
+    batched = store(tmp_path)
+    batched.scatter_add("TONE", rows, coefs, ctx_mat)
+    looped = ThetaStore(str(tmp_path / "looped.bin"), ACTION_SPACE, DIM)
+    for row, coef, ctx in zip(rows, coefs, ctx_mat):
+        looped.add("TONE", row, coef * ctx)
+
+    np.testing.assert_allclose(dense(batched, "TONE"), dense(looped, "TONE"), rtol=1e-5, atol=1e-6)
+    assert batched.resident_rows() == 3
+
+
+def test_mismatched_projection_is_rejected(tmp_path):
+    theta = store(tmp_path, projection="random:16:0")
+    theta.add("TONE", 0, np.ones(DIM))
+    theta.save()
+
+    assert store(tmp_path, projection="random:16:0").resident_rows() == 1
+    with pytest.raises(ValueError):
+        store(tmp_path).load()
+    with pytest.raises(ValueError):
+        store(tmp_path, projection="random:16:1").load()
+
+
+def test_repeated_writes_accumulate_in_one_row(tmp_path):
+    theta = store(tmp_path)
+    theta.add("TONE", 1, np.ones(DIM))
+    theta.add("TONE", 1, np.ones(DIM))
+    assert theta.resident_rows() == 1
+    np.testing.assert_allclose(dense(theta, "TONE")[1], 2.0)
+
+
+@pytest.mark.parametrize("dtype, tolerance", [("float16", 1e-3), ("int8", 1 / 127)])
+def test_quantize_round_trip(rng, dtype, tolerance):
+    rows = rng.standard_normal((5, DIM)).astype(np.float32)
+    stored, scales = quantize(rows, dtype)
+    assert stored.dtype == np.dtype(dtype)
+    error = np.abs(dequantize(stored, scales) - rows).max(axis=1)
+    assert (error <= tolerance * np.abs(rows).max(axis=1)).all()
+
+
+def test_int8_keeps_zero_rows():
+    stored, scales = quantize(np.zeros((2, DIM), dtype=np.float32), "int8")
+    assert not dequantize(stored, scales).any()
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_quantized_serving_copy(tmp_path, rng, dtype):
+    writer = store(tmp_path, dtype=dtype, requantize_every=2)
+    writer.add("TONE", 1, rng.standard_normal(DIM))
+    writer.save()
+    assert (tmp_path / f"theta.bin.{dtype}").exists()
+
+    ctx = rng.standard_normal((4, DIM)).astype(np.float32)
+    master = store(tmp_path).scores("TONE", ctx)
+    served = store(tmp_path, dtype=dtype).scores("TONE", ctx)
+    np.testing.assert_allclose(served, master, atol=0.05 * np.abs(master).max())
+
+    # Not due yet: the serving copy stays at the version it was written with
+    writer.add("TONE", 1, rng.standard_normal(DIM))
+    writer.save()
+    served = store(tmp_path, dtype=dtype)
+    served.load()
+    assert served.version == 1
+
+    writer.add("TONE", 1, rng.standard_normal(DIM))
+    writer.save()
+    served = store(tmp_path, dtype=dtype)
+    served.load()
+    assert served.version == 3
+
+
+def test_updates_accumulate_in_float32_from_the_master(tmp_path, rng):
+    delta = rng.standard_normal(DIM)
+    writer = store(tmp_path, dtype="int8", requantize_every=1)
+    writer.add("TONE", 0, delta)
+    writer.save()
+
+    # A later writer serving the (lossy) int8 copy still adds to the exact master rows
+    again = store(tmp_path, dtype="int8", requantize_every=1)
+    again.add("TONE", 0, delta)
+    again.save()
+
+    master = store(tmp_path)
+    np.testing.assert_allclose(dense(master, "TONE")[0], 2 * delta, rtol=1e-6)
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_writer_serves_the_quantized_copy_after_saving(tmp_path, rng, dtype):
+    writer = store(tmp_path, dtype=dtype, requantize_every=2)
+    writer.add("TONE", 1, rng.standard_normal(DIM))
+    writer.save()
+
+    ctx = rng.standard_normal((4, DIM)).astype(np.float32)
+    np.testing.assert_array_equal(writer.scores("TONE", ctx), store(tmp_path, dtype=dtype).scores("TONE", ctx))
+    assert writer.resident_bytes() == store(tmp_path, dtype=dtype).resident_bytes()
+
+    # Between requantizations the writer keeps serving the older copy too
+    writer.add("TONE", 1, rng.standard_normal(DIM))
+    writer.save()
+    assert writer.version == 1
+    np.testing.assert_array_equal(writer.scores("TONE", ctx), store(tmp_path, dtype=dtype).scores("TONE", ctx))
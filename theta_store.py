@@ -0,0 +1,661 @@
+"""
+theta_store.py
+--------------
+File-backed store for the continuous part of the RL policy (theta).
+
+Layout of a theta file (little endian):
+
+    magic        8 bytes   b"RLTHETA\\0"
+    format       u32       FORMAT_VERSION
+    header_len   u32       length of the JSON header in bytes
+    header       JSON      {"version", "embedding_dim", "dtype", "projection",
+                            "dimensions", "scales_offset", "meta"}
+    padding      -         up to a 64 byte boundary
+    rows         dtype     (total_rows x embedding_dim)
+    padding      -         up to a 64 byte boundary (int8 only)
+    scales       float32   (total_rows,) per-row scales (int8 only)
+
+header["dimensions"] maps every dimension to {"offset", "values"}: the row
+of (dimension, value) is offset + values.index(value). header["projection"]
+is the id of the context projection (projection.py) the rows were trained
+in, or null for raw contexts; header["meta"] is free-form JSON owned by
+the writer (e.g. a trainer's resume cursor). Loading is lazy and zero-copy
+(rows are read straight out of an mmap); load() reattaches when another
+process has replaced the file since. Only rows that have been written
+are stored; the first write to a dimension copies its resident rows into
+memory. save() merges the in-memory deltas into the latest file on disk
+and swaps it in with write-and-rename, so overlapping cron runs do not
+drop each other's updates.
+
+Quantized serving: the master file at `path` is always float32. With
+dtype="float16" or "int8" selection reads `path.<dtype>` instead, a copy
+that is regenerated from the master every `requantize_every` saves.
+Scoring dequantizes BLOCK_ROWS rows at a time; updates always accumulate
+in float32 rows taken from the master. After a save the writer serves
+the quantized copy again, like every other process.
+
+Shared serving: with a shared_theta.SharedTheta attached, load() maps the
+serving image from shared memory instead of the file and save() publishes
+the new image there, so all workers on a host share one copy.
+"""
+
+import os
+import json
+import mmap
+import struct
+import tempfile
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locking, last writer wins
+    fcntl = None
+
+MAGIC = b"RLTHETA\0"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+BLOCK_ROWS = 256
+DTYPES = ("float32", "float16", "int8")
+_PREAMBLE = struct.Struct("<8sII")
+
+
+def _pad(n):
+    return (ALIGNMENT - n % ALIGNMENT) % ALIGNMENT
+
+
+# ---------------- QUANTIZATION ----------------
+
+def quantize(rows, dtype):
+    """
+    float32 rows -> (stored rows, per-row scales or None)
+    """
+    rows = np.asarray(rows, dtype=np.float32)
+    if dtype == "float32":
+        return rows, None
+    if dtype == "float16":
+        return rows.astype(np.float16), None
+    if dtype == "int8":
+        scales = np.abs(rows).max(axis=1) / 127.0 if len(rows) else np.empty(0, dtype=np.float32)
+        scales = np.where(scales > 0, scales, 1.0).astype(np.float32)
+        q = np.clip(np.rint(rows / scales[:, None]), -127, 127).astype(np.int8)
+        return q, scales
+    raise ValueError(f"Unsupported theta dtype: {dtype}")
+
+
+def dequantize(rows, scales):
+    rows = np.asarray(rows, dtype=np.float32)
+    return rows if scales is None else rows * scales[:, None]
+
+
+# ---------------- FILE FORMAT ----------------
+
+def read_theta_file(path):
+    """
+    Map a theta file read-only.
+    Returns (header, {dim: (values, rows, scales)}, mmap) or None if missing.
+    """
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    return parse_theta_buffer(buf, path)
+
+
+def parse_theta_buffer(buf, source):
+    """
+    Parse a theta file image held in any buffer (mmap, shared memory) without copying.
+    Returns (header, {dim: (values, rows, scales)}, buf).
+    """
+    magic, fmt, header_len = _PREAMBLE.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError(f"Not a theta file: {source}")
+    if fmt != FORMAT_VERSION:
+        raise ValueError(f"Unsupported theta file format {fmt} in {source}")
+
+    start = _PREAMBLE.size
+    header = json.loads(bytes(buf[start:start + header_len]).decode("utf-8"))
+    data_offset = start + header_len + _pad(start + header_len)
+    width = header["embedding_dim"]
+    dtype = np.dtype(header.get("dtype", "float32"))
+    row_bytes = width * dtype.itemsize
+
+    blocks = {}
+    for dim, meta in header["dimensions"].items():
+        n = len(meta["values"])
+        rows = np.frombuffer(
+            buf,
+            dtype=dtype,
+            count=n * width,
+            offset=data_offset + meta["offset"] * row_bytes
+        ).reshape(n, width)
+
+        scales = None
+        if header.get("scales_offset") is not None:
+            scales = np.frombuffer(
+                buf,
+                dtype=np.float32,
+                count=n,
+                offset=data_offset + header["scales_offset"] + meta["offset"] * 4
+            )
+        blocks[dim] = (meta["values"], rows, scales)
+
+    return header, blocks, buf
+
+
+def write_theta_file(path, blocks, embedding_dim, version, projection=None, dtype="float32", meta=None):
+    """
+    Atomically write float32 {dim: (values, rows)} to path (write temp file + rename),
+    stored as dtype.
+    """
+    dimensions = {}
+    stored_rows, stored_scales = [], []
+    offset = 0
+    for dim, (values, rows) in blocks.items():
+        dimensions[dim] = {"offset": offset, "values": list(values)}
+        offset += len(values)
+        q, scales = quantize(rows, dtype)
+        stored_rows.append(np.ascontiguousarray(q))
+        if scales is not None:
+            stored_scales.append(scales)
+
+    rows_bytes = offset * embedding_dim * np.dtype(dtype).itemsize
+    scales_offset = rows_bytes + _pad(rows_bytes) if dtype == "int8" else None
+
+    header = json.dumps({
+        "version": version,
+        "embedding_dim": embedding_dim,
+        "dtype": dtype,
+        "projection": projection,
+        "scales_offset": scales_offset,
+        "meta": meta or {},
+        "dimensions": dimensions
+    }).encode("utf-8")
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".theta_", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+            f.write(header)
+            f.write(b"\0" * _pad(_PREAMBLE.size + len(header)))
+            for rows in stored_rows:
+                f.write(rows.tobytes())
+            if scales_offset is not None:
+                f.write(b"\0" * _pad(rows_bytes))
+                for scales in stored_scales:
+                    f.write(np.asarray(scales, dtype=np.float32).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# ---------------- STORE ----------------
+
+class ThetaStore:
+    """
+    Sparse theta: only rows that update_rl has written are stored.
+
+    Per dimension the resident rows are kept as one contiguous block
+    (index, rows, scales) where rows[j] belongs to action_space[dim][index[j]]
+    and scales is None unless the rows are int8. Rows that were never
+    written contribute an implicit zero score and take no memory.
+    """
+
+    def __init__(self, path, action_space, embedding_dim, projection=None,
+                 dtype="float32", requantize_every=20, shared=None):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported theta dtype: {dtype}")
+
+        self.path = path
+        self.action_space = action_space
+        self.embedding_dim = embedding_dim
+        self.projection = projection    # projection id, None for raw contexts
+        self.dtype = dtype
+        self.requantize_every = requantize_every
+        self.serving_path = path if dtype == "float32" else f"{path}.{dtype}"
+        self.version = 0
+        self.meta = {}         # persisted in the file header, see write_theta_file
+        self._position = {
+            dim: {v: i for i, v in enumerate(values)}
+            for dim, values in action_space.items()
+        }
+        self._blocks = None    # dim -> (index, rows, scales), resident rows only
+        self._base = {}        # dim -> float32 (index, rows) from the master, for dims written since
+        self._master = None    # master blocks when serving from a quantized copy
+        self._mmap = None
+        self._stamp = None     # (path, inode, mtime) of the file the blocks were read from
+        self.shared = shared   # optional SharedTheta holding the serving image
+        self._shared_slot = None   # (slot, seq) the resident blocks were read from
+        self._shared_stale = None  # (slot, seq) found older than our own theta, see _poll_shared
+
+    # ---------------- LOADING ----------------
+
+    def _empty(self):
+        return (
+            np.empty(0, dtype=np.intp),
+            np.empty((0, self.embedding_dim), dtype=np.float32),
+            None
+        )
+
+    def _resident(self, blocks, dim):
+        """
+        Resident (index, rows, scales) for dim. Zero-copy unless the file
+        holds values that are no longer part of the action space.
+        """
+        if dim not in blocks:
+            return self._empty()
+
+        file_values, file_rows, file_scales = blocks[dim]
+        position = self._position[dim]
+        keep = [i for i, v in enumerate(file_values) if v in position]
+        index = np.array([position[file_values[i]] for i in keep], dtype=np.intp)
+        if len(keep) == len(file_values):
+            return index, file_rows, file_scales
+        return index, file_rows[keep], None if file_scales is None else file_scales[keep]
+
+    def _load_blocks(self, path=None, loaded=None):
+        path = path or self.path
+        loaded = loaded or read_theta_file(path)
+        if loaded is None:
+            return {"version": 0}, {}, None
+
+        header, blocks, buf = loaded
+        if header["embedding_dim"] != self.embedding_dim:
+            raise ValueError(
+                f"Theta file {path} has embedding_dim={header['embedding_dim']}, "
+                f"expected {self.embedding_dim}"
+            )
+        if header.get("projection") != self.projection:
+            raise ValueError(
+                f"Theta file {path} was trained with projection {header.get('projection')!r}, "
+                f"configured projection is {self.projection!r}"
+            )
+        return header, blocks, buf
+
+    def _load_shared(self):
+        """
+        (source, header, blocks, buf) from the active shared slot, seeding
+        the segment from disk if nothing has been published yet.
+        """
+        snap = self.shared.snapshot()
+        if snap is None and self._try_publish():
+            snap = self.shared.snapshot()
+        if snap is None:
+            return None
+
+        slot, seq, view = snap
+        source = f"shared memory {self.shared.shm.name}"
+        try:
+            header, blocks, buf = self._load_blocks(source, parse_theta_buffer(view, source))
+        except (ValueError, struct.error, json.JSONDecodeError):
+            if self.shared.valid(slot, seq):
+                raise
+            return self._load_shared()   # slot recycled mid-read
+
+        self._shared_slot = (slot, seq)
+        return source, header, blocks, buf
+
+    def _open_serving(self):
+        """
+        (source, header, resident blocks, buf) of the serving image: the
+        shared segment when attached and published, the file otherwise.
+        """
+        loaded = self._load_shared() if self.shared is not None else None
+        if loaded is not None:
+            path, header, blocks, buf = loaded
+        else:
+            self._stamp = self._file_stamp()   # taken first: a save racing the read only causes a reload
+            path = self.serving_path if os.path.exists(self.serving_path) else self.path
+            header, blocks, buf = self._load_blocks(path)
+        return path, header, {dim: self._resident(blocks, dim) for dim in self.action_space}, buf
+
+    def _attach(self, path, header, blocks, buf):
+        self.version = header["version"]
+        self.meta = header.get("meta") or {}
+        self._mmap = buf
+        # swapped in whole: a concurrent reader sees the old or the new blocks, never None
+        self._blocks = blocks
+        if self.version:
+            print(f"Loaded theta v{self.version} from {path} ({self.resident_rows()} rows)")
+
+    def _file_stamp(self):
+        path = self.serving_path if os.path.exists(self.serving_path) else self.path
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return path, stat.st_ino, stat.st_mtime_ns
+
+    def load(self):
+        """
+        Attach the serving image, or reattach if another process saved a new
+        one since (shared memory is followed by scores() instead). Callers
+        check once per batch; scores() and writes only attach on first use,
+        so one batch never mixes two versions. Unsaved writes pin the
+        loaded rows until save() merges them.
+        """
+        if self._blocks is not None and (self.shared is not None or self._base or self._file_stamp() == self._stamp):
+            return
+        self._master = None
+        self._attach(*self._open_serving())
+
+    def _ensure_loaded(self):
+        if self._blocks is None:
+            self.load()
+
+    def _master_block(self, dim):
+        """
+        float32 (index, rows) for dim from the master file
+        """
+        index, rows, scales = self._blocks[dim]
+        if scales is None and rows.dtype == np.float32:
+            return index, rows
+
+        if self._master is None:
+            _, self._master, _ = self._load_blocks(self.path)
+        index, rows, _ = self._resident(self._master, dim)
+        return index, rows
+
+    # ---------------- ACCESS ----------------
+
+    def _reload_shared(self):
+        """
+        Re-attach to the active shared slot, keeping locally written dims.
+        """
+        written = {dim: self._blocks[dim] for dim in self._base}
+        self._shared_slot = None
+        path, header, blocks, buf = self._open_serving()
+        blocks.update(written)
+        self._attach(path, header, blocks, buf)
+
+    def _poll_shared(self):
+        """
+        Attach to the shared segment once something is published there.
+        Covers readers that loaded before the first publish (empty segment,
+        no file) or from disk while a writer held the lock. An image older
+        than the resident theta (e.g. our own save did not fit the slot)
+        is remembered and skipped.
+        """
+        snap = self.shared.snapshot()
+        if snap is None or snap[:2] == self._shared_stale:
+            return
+
+        previous = (self._blocks, self.version, self.meta, self._mmap)
+        self._reload_shared()
+        if self.version < previous[1]:
+            self._shared_stale = self._shared_slot
+            self._shared_slot = None
+            self._blocks, self.version, self.meta, self._mmap = previous
+
+    def scores(self, dim, ctx_mat):
+        """
+        (n x num_values) continuous scores for a (n x embedding_dim) context matrix.
+        Quantized rows are dequantized BLOCK_ROWS at a time.
+        """
+        self._ensure_loaded()
+        if self.shared is not None:
+            if self._shared_slot is None:
+                self._poll_shared()
+            elif not self.shared.current(*self._shared_slot):
+                self._reload_shared()   # pick up the newest published theta
+
+        out = self._scores(dim, ctx_mat)
+        while self._shared_slot is not None and not self.shared.valid(*self._shared_slot):
+            self._reload_shared()   # slot was rewritten while we read it
+            out = self._scores(dim, ctx_mat)
+        return out
+
+    def _scores(self, dim, ctx_mat):
+        index, rows, scales = self._blocks[dim]
+        out = np.zeros((ctx_mat.shape[0], len(self.action_space[dim])), dtype=np.float32)
+        if rows.dtype == np.float32:
+            if len(index):
+                out[:, index] = ctx_mat @ rows.T
+            return out
+
+        for start in range(0, len(index), BLOCK_ROWS):
+            end = start + BLOCK_ROWS
+            block = ctx_mat @ rows[start:end].astype(np.float32).T
+            if scales is not None:
+                block *= scales[start:end]
+            out[:, index[start:end]] = block
+        return out
+
+    def add(self, dim, row, delta):
+        """
+        theta[dim][row] += delta, creating the row on first write.
+        """
+        self.add_rows(dim, np.array([row], dtype=np.intp), np.asarray(delta, dtype=np.float32)[None, :])
+
+    def add_rows(self, dim, rows, deltas):
+        """
+        theta[dim][rows[j]] += deltas[j] for unique rows, creating missing rows.
+        Writes always go to a float32 copy of the master rows.
+        """
+        self._ensure_loaded()
+        if dim not in self._base:
+            index, block = self._master_block(dim)
+            if self._shared_slot is not None:
+                # shared slots get recycled by other writers; deltas need a stable base
+                index, block = index.copy(), np.array(block)
+            self._base[dim] = (index, block)
+            self._blocks[dim] = (index.copy(), np.array(block, dtype=np.float32), None)
+
+        index, block, _ = self._blocks[dim]
+        slot = np.full(len(self.action_space[dim]), -1, dtype=np.intp)
+        slot[index] = np.arange(len(index))
+
+        hit = slot[rows] >= 0
+        block[slot[rows[hit]]] += deltas[hit]
+        if not hit.all():
+            self._blocks[dim] = (
+                np.concatenate([index, rows[~hit]]),
+                np.vstack([block, np.asarray(deltas[~hit], dtype=np.float32)]),
+                None
+            )
+
+    def scatter_add(self, dim, rows, coefs, ctx_mat):
+        """
+        theta[dim][rows[i]] += coefs[i] * ctx_mat[i] for every i (rows may repeat).
+        Per-row sums are one (unique_rows x n) @ (n x embedding_dim) product.
+        """
+        unique, inverse = np.unique(rows, return_inverse=True)
+        weights = np.zeros((len(unique), len(rows)), dtype=np.float32)
+        weights[inverse, np.arange(len(rows))] = coefs
+        self.add_rows(dim, unique, weights @ ctx_mat)
+
+    @property
+    def dirty(self):
+        return bool(self._base)
+
+    def resident_rows(self):
+        self._ensure_loaded()
+        return sum(len(index) for index, _, _ in self._blocks.values())
+
+    def resident_bytes(self):
+        self._ensure_loaded()
+        return sum(
+            rows.nbytes + (0 if scales is None else scales.nbytes)
+            for _, rows, scales in self._blocks.values()
+        )
+
+    # ---------------- PERSISTENCE ----------------
+
+    def _deltas(self, dim):
+        """
+        {row: delta} written to dim since it was loaded
+        """
+        base_index, base_rows = self._base[dim]
+        base = {int(i): base_rows[j] for j, i in enumerate(base_index)}
+        index, rows, _ = self._blocks[dim]
+        return {
+            int(i): rows[j] - base[int(i)] if int(i) in base else rows[j]
+            for j, i in enumerate(index)
+        }
+
+    def _serving_image(self):
+        path = self.serving_path if os.path.exists(self.serving_path) else self.path
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def _try_publish(self):
+        """
+        Seed an empty shared segment from disk if no writer holds the lock.
+        """
+        with open(self.path + ".lock", "a") as lock:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return False   # a writer is saving and will publish
+            try:
+                image = self._serving_image()
+                return self.shared.snapshot() is None and image is not None and self.shared.publish(image)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _requantize_due(self, version):
+        if self.dtype == "float32":
+            return False
+        loaded = read_theta_file(self.serving_path)
+        if loaded is None:
+            return True
+        return version - loaded[0]["version"] >= self.requantize_every
+
+    def save(self, force=False):
+        """
+        Merge local deltas into the latest master file and atomically replace it;
+        regenerate the quantized serving copy when it is due.
+        force=True writes even without row changes (e.g. to persist meta).
+        """
+        if not self.dirty and not force:
+            return
+
+        lock_path = self.path + ".lock"
+        with open(lock_path, "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                header, blocks, buf = self._load_blocks()
+                version = header["version"]
+                merged, written = {}, {}
+                for dim, values in self.action_space.items():
+                    index, rows, _ = self._resident(blocks, dim)
+                    latest = {int(i): np.array(rows[j]) for j, i in enumerate(index)}
+                    if dim in self._base:
+                        for i, delta in self._deltas(dim).items():
+                            latest[i] = latest[i] + delta if i in latest else np.array(delta)
+
+                    order = sorted(latest)
+                    rows = np.stack([latest[i] for i in order]) if order else self._empty()[1]
+                    merged[dim] = (np.array(order, dtype=np.intp), rows, None)
+                    written[dim] = ([values[i] for i in order], rows)
+
+                version += 1
+                write_theta_file(
+                    self.path, written, self.embedding_dim, version,
+                    self.projection, meta=self.meta
+                )
+                requantize = self._requantize_due(version)
+                if requantize:
+                    write_theta_file(
+                        self.serving_path, written, self.embedding_dim, version,
+                        self.projection, self.dtype, meta=self.meta
+                    )
+                    print(f"Requantized theta v{version} to {self.serving_path} ({self.dtype})")
+
+                # Published under the file lock, so there is one writer at a time
+                stamp = self._file_stamp()
+                published = False
+                if self.shared is not None and (self.dtype == "float32" or requantize):
+                    published = self.shared.publish(self._serving_image())
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+        self.version = version
+        self._blocks = merged
+        self._base = {}
+        self._master = None
+        self._mmap = None
+        self._shared_slot = None
+        self._stamp = stamp
+        print(f"Saved theta v{self.version} to {self.path} ({self.resident_rows()} rows, {self.resident_bytes()} bytes)")
+        if published or self.dtype != "float32":
+            # serve the same image as every other process (shared memory, or the
+            # quantized copy rather than the float32 master just merged), swapping
+            # the blocks rather than clearing them
+            self._attach(*self._open_serving())
+
+
+# ---------------- ACCURACY REPORT ----------------
+
+def _softmax(scores):
+    exp = np.exp(scores - scores.max(axis=1, keepdims=True))
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+def quantization_report(store, ctx_mat, prefs=None, modes=("float16", "int8")):
+    """
+    Compare action probabilities of the float32 master theta against
+    quantized copies on logged (already projected) context vectors.
+
+    prefs: optional {dim: (n x num_values)} discrete scores added to both sides.
+    Returns {mode: {dim: {"max_abs_diff", "mean_tv", "argmax_agreement"}}}.
+    """
+    full = ThetaStore(store.path, store.action_space, store.embedding_dim, store.projection)
+    full.load()
+    ctx_mat = np.asarray(ctx_mat, dtype=np.float32)
+    report = {}
+
+    for mode in modes:
+        report[mode] = {}
+        for dim in store.action_space:
+            index, rows, _ = full._blocks[dim]
+            base = full.scores(dim, ctx_mat)
+            quant = np.zeros_like(base)
+            if len(index):
+                quant[:, index] = ctx_mat @ dequantize(*quantize(rows, mode)).T
+
+            if prefs is not None:
+                base = base + prefs[dim]
+                quant = quant + prefs[dim]
+
+            p, p_q = _softmax(base), _softmax(quant)
+            report[mode][dim] = {
+                "max_abs_diff": float(np.abs(p - p_q).max()),
+                "mean_tv": float(0.5 * np.abs(p - p_q).sum(axis=1).mean()),
+                "argmax_agreement": float((p.argmax(axis=1) == p_q.argmax(axis=1)).mean())
+            }
+
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    import rl_agent
+
+    parser = argparse.ArgumentParser(description="Quantized vs float32 theta accuracy report")
+    parser.add_argument("--contexts", required=True, help=".npy matrix of logged raw context vectors")
+    parser.add_argument("--modes", nargs="+", default=["float16", "int8"], choices=DTYPES[1:])
+    args = parser.parse_args()
+
+    ctx_mat = rl_agent.project(np.load(args.contexts).astype(np.float32))
+    for mode, dims in quantization_report(rl_agent.theta, ctx_mat, modes=args.modes).items():
+        print(f"\n{mode}")
+        for dim, stats in dims.items():
+            print(
+                f"   {dim:<20} max|dp|={stats['max_abs_diff']:.6f} "
+                f"TV={stats['mean_tv']:.6f} argmax agree={stats['argmax_agreement']:.2%}"
+            )